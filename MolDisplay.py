@@ -1,16 +1,103 @@
 import molecule
+import ctypes
+import io
 import math
+import mmap
+import os
+import metrics
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
-radius = {}
-element_name = {}
-header = """<svg version="1.1" width="1000" height="1000" viewBox="0 0 1000 1000" preserveAspectRatio="xMidYMid meet"
-xmlns="http://www.w3.org/2000/svg">""";
 footer = """</svg>""";
-offsetx = 500;
-offsety = 500;
-render_scale = 100.0
-render_offsetx = offsetx
-render_offsety = offsety
+
+# Extra distance (angstroms) allowed beyond the sum of covalent radii when perceiving bonds.
+BOND_TOLERANCE = 0.45
+
+# Structured dtypes mirroring the C atom and bond structs (natural alignment, like the C compiler).
+if np is not None:
+    ATOM_DTYPE = np.dtype([('element', 'S3'), ('x', 'f8'), ('y', 'f8'), ('z', 'f8')], align=True)
+    BOND_DTYPE = np.dtype([
+        ('a1', 'u4'), ('a2', 'u4'), ('epairs', 'u1'), ('atoms', np.uintp),
+        ('x1', 'f8'), ('x2', 'f8'), ('y1', 'f8'), ('y2', 'f8'),
+        ('z', 'f8'), ('len', 'f8'), ('dx', 'f8'), ('dy', 'f8'),
+    ], align=True)
+    if ATOM_DTYPE.itemsize != molecule.sizeof_atom() or BOND_DTYPE.itemsize != molecule.sizeof_bond():
+        raise ImportError("NumPy dtypes do not match the compiled atom/bond layout")
+
+class LevelOfDetail:
+    # Native render options for very large molecules. Atoms and bonds hidden behind nearer atoms
+    # (checked on a screen-space grid) are skipped; bonds in the farthest merge_far fraction of
+    # the depth range are merged into one <path>; at most budget elements are drawn, nearest
+    # first (0 means no budget).
+    def __init__(self, budget=0, merge_far=0.0):
+        self.budget = budget
+        self.merge_far = merge_far
+
+class RenderContext:
+    # Everything a render needs: element styles, canvas size and the fitted projection.
+    # Style maps are shared read-only; fit() returns a fresh context per render so
+    # concurrent renders never see each other's scale or offsets.
+    # An optional C palette of the same styles lets Molecule.svg use the native renderer.
+    def __init__(self, radius=None, element_name=None, gradients=None, width=1000, height=1000, palette=None, lod=None):
+        self.radius = radius if radius is not None else {}
+        self.element_name = element_name if element_name is not None else {}
+        self.gradients = gradients if gradients is not None else {}
+        self.palette = palette
+        self.lod = lod
+        self.width = width
+        self.height = height
+        self.scale = 100.0
+        self.offsetx = width / 2.0
+        self.offsety = height / 2.0
+
+    def fit(self, atoms):
+        context = RenderContext(self.radius, self.element_name, self.gradients, self.width, self.height, self.palette, self.lod)
+        if not atoms:
+            return context
+
+        min_x = min(a.atom.x for a in atoms)
+        max_x = max(a.atom.x for a in atoms)
+        min_y = min(a.atom.y for a in atoms)
+        max_y = max(a.atom.y for a in atoms)
+        max_r = max(self.radius.get(a.atom.element, 0) for a in atoms)
+
+        #Scale the molecule to fill 90% of the canvas, leaving room for the outermost atoms
+        span_x = max(max_x - min_x, 1e-6)
+        span_y = max(max_y - min_y, 1e-6)
+        scale_x = (0.9 * self.width - (2.0 * max_r)) / span_x
+        scale_y = (0.9 * self.height - (2.0 * max_r)) / span_y
+        context.scale = min(max(20.0, min(scale_x, scale_y)), 180.0)
+
+        center_x = (min_x + max_x) / 2.0
+        center_y = (min_y + max_y) / 2.0
+        context.offsetx = (self.width / 2.0) - (center_x * context.scale)
+        context.offsety = (self.height / 2.0) - (center_y * context.scale)
+        return context
+
+    def native_palette(self):
+        # The C palette, built from the style maps when the context was created without one.
+        if self.palette is None:
+            self.palette = molecule.palette()
+            for code, radius in self.radius.items():
+                self.palette.add(code, float(radius), f"{radius}", f"{self.element_name.get(code)}")
+        return self.palette
+
+    def header(self, elements=None):
+        svg_head = (
+            f'<svg version="1.1" width="{self.width}" height="{self.height}" '
+            f'viewBox="0 0 {self.width} {self.height}" preserveAspectRatio="xMidYMid meet" '
+            'xmlns="http://www.w3.org/2000/svg">'
+        )
+        # Only ship gradients for the elements this molecule actually uses.
+        if self.gradients:
+            defs = self.gradients.values() if elements is None else (
+                g for code, g in self.gradients.items() if code in elements
+            )
+            svg_head += '<defs>' + ''.join(defs) + '</defs>'
+        return svg_head
 
 class Atom: 
     def __init__(self,c_atom, index=-1):
@@ -21,17 +108,17 @@ class Atom:
     def __str__(self):
         return f"Atom({self.atom.element}, x={self.atom.x}, y={self.atom.y}, z={self.z})"
 
-    def svg(self): 
+    def svg(self, context): 
         #Compute x and y coordinates
 
-        cx = self.atom.x * render_scale + render_offsetx
-        cy = self.atom.y * render_scale + render_offsety
+        cx = self.atom.x * context.scale + context.offsetx
+        cy = self.atom.y * context.scale + context.offsety
 
         #Get radius from dictionary
-        r = radius.get(self.atom.element, 0)
+        r = context.radius.get(self.atom.element, 0)
 
         #Colour of circle
-        colour = element_name.get(self.atom.element)
+        colour = context.element_name.get(self.atom.element)
 
         #Return svg string
         return (
@@ -49,11 +136,11 @@ class Bond:
     def __str__(self):
         return f"Bond({self.bond.a1}, {self.bond.a2}, {self.bond.len})"
     
-    def svg(self):
-        x1 = (self.bond.x1 * render_scale) + render_offsetx
-        y1 = (self.bond.y1 * render_scale) + render_offsety
-        x2 = (self.bond.x2 * render_scale) + render_offsetx
-        y2 = (self.bond.y2 * render_scale) + render_offsety
+    def svg(self, context):
+        x1 = (self.bond.x1 * context.scale) + context.offsetx
+        y1 = (self.bond.y1 * context.scale) + context.offsety
+        x2 = (self.bond.x2 * context.scale) + context.offsetx
+        y2 = (self.bond.y2 * context.scale) + context.offsety
         p1 = (x1 + (self.bond.dy * 10), y1 - (self.bond.dx * 10))
         p2 = (x1 - (self.bond.dy * 10), y1 + (self.bond.dx * 10))
         p3 = (x2 - (self.bond.dy * 10), y2 + (self.bond.dx * 10))
@@ -69,26 +156,49 @@ class Bond:
             p1[0], p1[1], p2[0], p2[1], p3[0], p3[1], p4[0], p4[1]
         )
 
+def _sdf_buffer(file_obj):
+    if isinstance(file_obj, (bytes, bytearray, memoryview, mmap.mmap)):
+        return file_obj
+
+    # Map regular files read from the start instead of copying them into Python strings.
+    try:
+        if file_obj.tell() == 0:
+            size = os.fstat(file_obj.fileno()).st_size
+            if size > 0:
+                return mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, io.UnsupportedOperation, ValueError):
+        pass
+
+    data = file_obj.read()
+    return data.encode('utf-8') if isinstance(data, str) else bytes(data)
+
 class Molecule(molecule.molecule):
     def __init__(self, c_molecule=None):
         super().__init__()
         # Preserve compatibility with older code that expects a wrapped C molecule at .molecule.
         self.molecule = self
         if c_molecule:
-            for i in range(c_molecule.atom_no):
-                atom = c_molecule.get_atom(i)
-                self.append_atom(atom.element, atom.x, atom.y, atom.z)
-            for i in range(c_molecule.bond_no):
-                bond = c_molecule.get_bond(i)
-                self.append_bond(bond.a1, bond.a2, bond.epairs)
+            self.copy_from(c_molecule)
+
+    def copy(self):
+        # Duplicate atoms and bonds in C so callers can rotate without touching the original.
+        return Molecule(self)
 
     def __str__(self):
         atom_strings = [str(atom) for atom in self.atoms]
         bond_strings = [str(bond) for bond in self.bonds]
         return "Molecule(\n" + ",\n".join(atom_strings + bond_strings)+ "\n)"
 
-    def svg(self):
-        global render_scale, render_offsetx, render_offsety
+    @metrics.stage('svg')
+    def svg(self, context=None, order=None):
+        # order: a molecule.depth_order kept across frames of this molecule (see RenderSession);
+        # only native renders use it.
+        if context is None:
+            context = RenderContext()
+        if context.lod is not None:
+            return self.svg_lod(context, order)
+        if context.palette is not None:
+            return self.svg_native(context, order)
 
         atoms = []
         bonds = []
@@ -101,38 +211,119 @@ class Molecule(molecule.molecule):
             bond = Bond(self.get_bond(i), i)
             bonds.append(bond)
 
-        if atoms:
-            min_x = min(a.atom.x for a in atoms)
-            max_x = max(a.atom.x for a in atoms)
-            min_y = min(a.atom.y for a in atoms)
-            max_y = max(a.atom.y for a in atoms)
-            max_r = max(radius.get(a.atom.element, 0) for a in atoms)
-
-            span_x = max(max_x - min_x, 1e-6)
-            span_y = max(max_y - min_y, 1e-6)
-            usable = 900.0 - (2.0 * max_r)
-            scale_x = usable / span_x
-            scale_y = usable / span_y
-            render_scale = min(max(20.0, min(scale_x, scale_y)), 180.0)
-
-            center_x = (min_x + max_x) / 2.0
-            center_y = (min_y + max_y) / 2.0
-            render_offsetx = 500.0 - (center_x * render_scale)
-            render_offsety = 500.0 - (center_y * render_scale)
-        else:
-            render_scale = 100.0
-            render_offsetx = 500.0
-            render_offsety = 500.0
+        context = context.fit(atoms)
         
         objects = atoms + bonds
         objects.sort(key=lambda obj: obj.z)
         
-        svg_strs = [obj.svg() for obj in objects]
+        svg_strs = [obj.svg(context) for obj in objects]
         svg_str = ''.join(svg_strs)
-        
-        return header + svg_str + footer
+
+        used = {a.atom.element for a in atoms}
+        return context.header(used) + svg_str + footer
+
+    def svg_chunks(self, context=None, chunk_items=1024):
+        # Same document as svg(), yielded in depth order a slice of chunk_items elements
+        # at a time, so the whole SVG never has to exist as one string.
+        if context is None:
+            context = RenderContext()
+
+        if context.palette is not None:
+            # Fit and depth sort happen once in C; each chunk is formatted on demand.
+            view = molecule.svg_view(context.width, context.height)
+            stream = molecule.svg_stream(self, context.palette, view)
+            yield context.header(set(self.element_codes().split()))
+            chunk = stream.next_chunk(chunk_items)
+            while chunk is not None:
+                yield chunk
+                chunk = stream.next_chunk(chunk_items)
+            yield footer
+            return
+
+        atoms = [Atom(self.get_atom(i), i) for i in range(self.atom_no)]
+        bonds = [Bond(self.get_bond(i), i) for i in range(self.bond_no)]
+        context = context.fit(atoms)
+
+        objects = atoms + bonds
+        objects.sort(key=lambda obj: obj.z)
+
+        yield context.header({a.atom.element for a in atoms})
+        for start in range(0, len(objects), chunk_items):
+            yield ''.join(obj.svg(context) for obj in objects[start:start + chunk_items])
+        yield footer
+
+    def _c_array(self, address, count, dtype):
+        if np is None:
+            raise RuntimeError("NumPy is required for array views")
+        if count == 0:
+            return np.empty(0, dtype=dtype)
+        # The ctypes wrapper keeps this molecule alive for as long as any view exists.
+        raw = (ctypes.c_char * (count * dtype.itemsize)).from_address(address)
+        raw._owner = self
+        return np.frombuffer(raw, dtype=dtype)
+
+    # Zero-copy views of the C arrays. Writes go straight to C memory; call
+    # refresh_bonds() after moving atoms. Views are invalid once atoms or bonds are appended.
+    def atom_array(self):
+        return self._c_array(self.atoms_address(), self.atom_no, ATOM_DTYPE)
+
+    def bond_array(self):
+        return self._c_array(self.bonds_address(), self.bond_no, BOND_DTYPE)
+
+    def coords(self):
+        # (atom_no, 3) float64 view over the x, y, z fields.
+        atoms = self.atom_array()
+        return np.ndarray(
+            (len(atoms), 3), dtype=np.float64, buffer=atoms,
+            offset=ATOM_DTYPE.fields['x'][1], strides=(ATOM_DTYPE.itemsize, 8)
+        )
+
+    def refresh_bonds(self):
+        molecule.molcompute_bonds(self)
+
+    def svg_native(self, context, order=None):
+        # Fit, depth sort and format the whole body in one C call; same markup as the Python path.
+        view = molecule.svg_view(context.width, context.height)
+        body = self.svg_body(context.palette, view, order)
+        used = set(self.element_codes().split())
+        return context.header(used) + body + footer
     
-    def parse(self,file_obj):
+    def pick_at(self, context, x, y, tolerance=4.0):
+        # Topmost atom or bond drawn at canvas point (x, y) for svg(context) of this molecule:
+        # ('atom', index), ('bond', index) or None. Uses a 2D grid over the projected atoms.
+        view = molecule.svg_view(context.width, context.height)
+        return self.pick(context.native_palette(), view, x, y, tolerance)
+
+    def svg_lod(self, context, order=None):
+        # Level-of-detail render (see LevelOfDetail); always native.
+        view = molecule.svg_view(context.width, context.height)
+        body = self.svg_body_lod(context.native_palette(), view, context.lod.budget, context.lod.merge_far, order)
+        used = set(self.element_codes().split())
+        return context.header(used) + body + footer
+    
+    def parse(self, file_obj):
+        # Fixed-column V2000 parsing happens in C over one buffer: real files are memory-mapped,
+        # other streams are read once. Files that only line up when split on whitespace
+        # still go through the original Python parser.
+        data = _sdf_buffer(file_obj)
+        try:
+            error = self.parse_v2000(data)
+            if error is not None:
+                try:
+                    self.parse_split(io.StringIO(bytes(data).decode('utf-8', errors='replace')))
+                except (ValueError, IndexError, StopIteration):
+                    line, reason = error
+                    raise ValueError(f"SDF line {line}: {reason}") from None
+        finally:
+            if isinstance(data, mmap.mmap) and data is not file_obj:
+                data.close()
+
+        # Files without a bond block get bonds from interatomic distances (grid search in C).
+        if self.bond_no == 0 and self.atom_no > 1:
+            self.perceive_bonds(BOND_TOLERANCE)
+        return self
+
+    def parse_split(self,file_obj):
         
         #Skip first 3 lines 
         for i in range(3):
@@ -141,56 +332,59 @@ class Molecule(molecule.molecule):
         #Parse number of atoms and bonds 
         line = next(file_obj).split()
         num_atoms, num_bonds = int(line[0]), int (line[1])
+        self.reserve(num_atoms, num_bonds)
 
         #Parse Atom Information
 
         for i in range(num_atoms):
             line = next(file_obj).split()
             x, y, z, element = float(line[0]), float(line[1]), float(line[2]), line[3]
+            if not all(math.isfinite(v) for v in (x, y, z)):
+                raise ValueError(f"Non-finite atom coordinates: {x}, {y}, {z}")
             self.append_atom(element, x, y, z)
         
         #Parse Bond Information
         for i in range(num_bonds):
             line = next(file_obj).split()
             a1, a2, epairs = int(line[0]), int(line[1]), int (line[2])
+            if not (1 <= a1 <= num_atoms and 1 <= a2 <= num_atoms):
+                raise ValueError(f"Bond refers to a missing atom: {a1}, {a2}")
             # SDF files use 1-based atom indices; C code expects 0-based indices.
             self.append_bond(a1 - 1, a2 - 1, epairs)
         
         return self
 
+    @metrics.stage('rotate')
     def rotate(self, phi_x=0, phi_y=0, phi_z=0):
-        if self.atom_no == 0:
-            return
+        # Centroid, composed rotation matrix and bond refresh all happen in one C pass.
+        molecule.molrotate(self, phi_x, phi_y, phi_z)
 
-        rx = math.radians(phi_x)
-        ry = math.radians(phi_y)
-        rz = math.radians(phi_z)
-        sx, cx = math.sin(rx), math.cos(rx)
-        sy, cy = math.sin(ry), math.cos(ry)
-        sz, cz = math.sin(rz), math.cos(rz)
 
-        # Rotate around molecule centroid so the model stays in frame.
-        cx0 = sum(self.get_atom(i).x for i in range(self.atom_no)) / self.atom_no
-        cy0 = sum(self.get_atom(i).y for i in range(self.atom_no)) / self.atom_no
-        cz0 = sum(self.get_atom(i).z for i in range(self.atom_no)) / self.atom_no
+class RenderSession:
+    # Successive frames of one molecule at nearby angles, e.g. while it is dragged. The depth order
+    # of the last frame is kept in C and only repaired for the next one, which is close to linear
+    # for small rotations. Not thread-safe: one frame at a time per session.
+    def __init__(self, mol, context):
+        self.base = mol
+        self.context = context
+        self.order = molecule.depth_order()
+        self.frame = None
+        self.angles = None
 
-        for i in range(self.atom_no):
-            atom = self.get_atom(i)
-            x = atom.x - cx0
-            y = atom.y - cy0
-            z = atom.z - cz0
-
-            if phi_x:
-                y, z = (y * cx) - (z * sx), (y * sx) + (z * cx)
-            if phi_y:
-                x, z = (x * cy) + (z * sy), (-x * sy) + (z * cy)
-            if phi_z:
-                x, y = (x * cz) - (y * sz), (x * sz) + (y * cz)
-
-            atom.x = x + cx0
-            atom.y = y + cy0
-            atom.z = z + cz0
+    def frame_at(self, phi_x=0, phi_y=0, phi_z=0):
+        # The base molecule rotated to these angles. The last frame is kept, so a pick on the frame
+        # just drawn reuses its rotation and the pick grid C caches on it.
+        angles = (phi_x, phi_y, phi_z)
+        if angles != self.angles:
+            frame = Molecule(self.base)
+            frame.rotate(*angles)
+            self.frame, self.angles = frame, angles
+        return self.frame
 
-        for i in range(self.bond_no):
-            molecule.compute_coords(self.get_bond(i))
-        
+    def svg(self, phi_x=0, phi_y=0, phi_z=0):
+        return self.frame_at(phi_x, phi_y, phi_z).svg(self.context, self.order)
+
+    def pick_at(self, x, y, phi_x=0, phi_y=0, phi_z=0, tolerance=4.0):
+        # (frame, hit) for canvas point (x, y) of svg() at these angles; see Molecule.pick_at.
+        frame = self.frame_at(phi_x, phi_y, phi_z)
+        return frame, frame.pick_at(self.context, x, y, tolerance)
@@ -0,0 +1,205 @@
+import bisect
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+# Seconds; from frame cache hits (well under a millisecond) to large streamed renders.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Bytes; 256 B to 64 MiB in powers of four.
+SIZE_BUCKETS = tuple(256 * 4 ** i for i in range(10))
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    escaped = (
+        str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{_labels(self.labels, labels)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    # Per label set: a count per bucket (not cumulative until rendered), the sum and the count.
+
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labels = labels
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = sorted((labels, (list(counts), total, count)) for labels, (counts, total, count) in self.series.items())
+        for labels, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket
+                bucket_labels = _labels(self.labels + ('le',), labels + (_number(bound),))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labels, labels)} {count}")
+        return lines
+
+
+class Gauge:
+    # Read when /metrics is scraped; read() returns the current value.
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {_number(self.read())}"]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = OrderedDict()
+
+    def counter(self, name, help, labels=()):
+        return self.metrics.setdefault(name, Counter(name, help, labels))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        return self.metrics.setdefault(name, Histogram(name, help, buckets, labels))
+
+    def gauge(self, name, help, read):
+        return self.metrics.setdefault(name, Gauge(name, help, read))
+
+    def render(self):
+        # Prometheus text exposition format (version 0.0.4).
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+stage_seconds = registry.histogram(
+    'molview_stage_duration_seconds', "Time spent in each stage of request handling", LATENCY_BUCKETS, ('stage',)
+)
+cache_lookups = registry.counter('molview_cache_lookups_total', "Cache lookups by cache and result", ('cache', 'result'))
+rows_read = registry.counter('molview_db_rows_read_total', "Rows read from SQLite by query", ('query',))
+
+
+class RequestTiming:
+    # Stage durations and notes of the request being handled on this thread, for its Server-Timing header.
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = OrderedDict()
+        self.notes = OrderedDict()
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def header(self):
+        parts = [f"{stage};dur={seconds * 1000:.3f}" for stage, seconds in self.stages.items()]
+        parts.extend(f'{name};desc="{value}"' for name, value in self.notes.items())
+        parts.append(f"total;dur={self.elapsed * 1000:.3f}")
+        return ', '.join(parts)
+
+
+_local = threading.local()
+
+
+def begin():
+    timing = RequestTiming()
+    _local.timing = timing
+    return timing
+
+
+def end():
+    _local.timing = None
+
+
+def current():
+    return getattr(_local, 'timing', None)
+
+
+def note(name, value):
+    # A named value (e.g. a cache result) for the current request's Server-Timing header.
+    timing = getattr(_local, 'timing', None)
+    if timing is not None:
+        timing.notes[name] = value
+
+
+class Timer:
+    # Times one stage: always into stage_seconds, and into the current request's timing if there is one.
+    # Stages should not nest, or the inner time is counted twice in Server-Timing.
+    __slots__ = ('stage', 'started')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.started
+        stage_seconds.observe(elapsed, self.stage)
+        timing = getattr(_local, 'timing', None)
+        if timing is not None:
+            timing.add(self.stage, elapsed)
+        return False
+
+
+def timed(stage):
+    return Timer(stage)
+
+
+def stage(name):
+    # Decorator form of timed().
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -1,4 +1,10 @@
 #include "mol.h"
+#include <stdarg.h>
+
+//Keep a*b+c as two roundings so native SVG coordinates match the Python renderer
+#ifdef __clang__
+#pragma STDC FP_CONTRACT OFF
+#endif
 
 
 void atomset( atom *atom, char element[3], double *x, double *y, double *z ) {
@@ -21,7 +27,7 @@ void atomget( atom *atom, char element[3], double *x, double *y, double *z ) {
     *y = atom->y;
     *z = atom->z;
 }
-void bondset(bond* bond, unsigned short* a1, unsigned short* a2, atom** atoms, unsigned char* epairs) {
+void bondset(bond* bond, unsigned int* a1, unsigned int* a2, atom** atoms, unsigned char* epairs) {
     bond->a1 = *a1;
     bond->a2 = *a2;
     bond->atoms = *atoms;
@@ -29,13 +35,13 @@ void bondset(bond* bond, unsigned short* a1, unsigned short* a2, atom** atoms, u
     
     compute_coords(bond);
 }
-void bondget( bond *bond, unsigned short *a1, unsigned short *a2, atom **atoms, unsigned char *epairs ) {
+void bondget( bond *bond, unsigned int *a1, unsigned int *a2, atom **atoms, unsigned char *epairs ) {
     *a1 = bond->a1;
     *a2 = bond->a2;
     *atoms = bond->atoms;
     *epairs = bond->epairs;
 }
-molecule *molmalloc( unsigned short atom_max, unsigned short bond_max ) { 
+molecule *molmalloc( unsigned int atom_max, unsigned int bond_max ) { 
    
     molecule *ptr;
 
@@ -71,6 +77,9 @@ molecule *molmalloc( unsigned short atom_max, unsigned short bond_max ) {
 
     ptr->bond_no = 0;
 
+    ptr->pick_grid = NULL;
+    ptr->pick_half = 0;
+
     //Allocating memory for bond structures
     ptr->bonds = malloc(sizeof(bond)*bond_max);
     if (ptr->bonds == NULL) { 
@@ -105,107 +114,141 @@ molecule *molcopy( molecule *src ) {
     }
 
     //Copying atoms and bonds in the src to new molecule
-    for (int i = 0; i < src->atom_no;i++) {
-        molappend_atom(ptr, &src->atoms[i]);
-    }
-    for (int i = 0; i < src->bond_no; i++) {
-        molappend_bond(ptr, &src->bonds[i]);
-    }
+    molcopy_into(ptr, src);
+
     //Return pointer to new molecule
     return ptr;
 }
+void molcopy_into( molecule *dst, molecule *src ) {
+    struct bond copy;
+
+    //Size the destination once instead of growing it per element
+    molreserve(dst, dst->atom_no + src->atom_no, dst->bond_no + src->bond_no);
+
+    //Copying atoms first so the bonds can point at the final atom array
+    for (unsigned int i = 0; i < src->atom_no; i++) {
+        molappend_atom(dst, &src->atoms[i]);
+    }
+
+    //Copied bonds must reference the destination atoms, not the source ones
+    for (unsigned int i = 0; i < src->bond_no; i++) {
+        copy = src->bonds[i];
+        copy.atoms = dst->atoms;
+        molappend_bond(dst, &copy);
+    }
+}
 void molfree( molecule *ptr ) { 
 
     //Freeing memory of molecule struct
+    molinvalidate(ptr);
     free(ptr->bond_ptrs);
     free(ptr->atom_ptrs);
     free(ptr->bonds);
     free(ptr->atoms);
     free(ptr);
 }
-void molappend_atom( molecule *molecule, atom *atom ) {
-    //Check if the number of atoms in molecule has reached max 
-    if (molecule->atom_no == molecule->atom_max) {
-        molecule->atom_max *= 2;
-        if (molecule->atom_max == 0) { 
-            molecule->atom_max = 1;
-        }
+void molgrow_atoms( molecule *molecule, unsigned int atom_max ) {
+    struct atom *old_atoms = molecule->atoms;
 
-        // Store old atoms pointer to check if it changes
-        struct atom *old_atoms = molecule->atoms;
+    //Reallocate memory for array of atoms
+    void *temp_ptr = realloc(molecule->atoms, atom_max * sizeof(struct atom));
+    //Check if realloc failed
+    if (temp_ptr == NULL) {
+        fprintf(stderr, "Memory Allocation failed, exiting program.\n");
+        exit(EXIT_FAILURE);
+    }
+    //Assign pointer to the atoms array
+    molecule->atoms = temp_ptr;
 
-        //Reallocate memory for array of atoms
-        void *temp_ptr = realloc(molecule->atoms, molecule->atom_max * sizeof(struct atom)); 
-        //Check if realloc failed
-        if (temp_ptr == NULL) {
-            fprintf(stderr, "Memory Allocation failed, exiting program.\n");
-            exit(EXIT_FAILURE);
-        }
-        //Assign pointer to the atoms array
-        molecule->atoms = temp_ptr;
+    //Reallocate memory for array of pointers to the atoms
+    temp_ptr = realloc(molecule->atom_ptrs, atom_max * sizeof(struct atom*));
+    //Check if realloc failed
+    if (temp_ptr == NULL) {
+        fprintf(stderr, "Memory Allocation failed, exiting program.\n");
+        exit(EXIT_FAILURE);
+    }
+    //Assign pointer to the atom_ptrs array
+    molecule->atom_ptrs = temp_ptr;
+    molecule->atom_max = atom_max;
 
-        // If the address of atoms changed, update all bond pointers
-        if (molecule->atoms != old_atoms) {
-            for (int i = 0; i < molecule->bond_no; i++) {
-                molecule->bonds[i].atoms = molecule->atoms;
-            }
+    // If the address of atoms changed, rebase bonds and atom pointers (keeping any sorted order)
+    if (molecule->atoms != old_atoms) {
+        for (unsigned int i = 0; i < molecule->bond_no; i++) {
+            molecule->bonds[i].atoms = molecule->atoms;
         }
+        for (unsigned int i = 0; i < molecule->atom_no; i++) {
+            molecule->atom_ptrs[i] = molecule->atoms + (molecule->atom_ptrs[i] - old_atoms);
+        }
+    }
+}
+void molgrow_bonds( molecule *molecule, unsigned int bond_max ) {
+    struct bond *old_bonds = molecule->bonds;
 
-        //Reallocate memory for array of pointers to the atoms
-        temp_ptr = realloc(molecule->atom_ptrs, molecule->atom_max * sizeof(struct atom*));
-        //Check if realloc failed
-        if (temp_ptr == NULL) {
-            fprintf(stderr, "Memory Allocation failed, exiting program.\n");
-            exit(EXIT_FAILURE);
+    //Reallocate memory for array of bonds
+    void *temp_ptr = realloc(molecule->bonds, bond_max * sizeof(struct bond));
+    //Check if realloc failed
+    if (temp_ptr == NULL) { 
+        fprintf(stderr, "Memory Allocation failed, exiting program.\n");
+        exit(EXIT_FAILURE);            
+    }
+    //Assign pointer to the bonds array
+    molecule->bonds = temp_ptr;
+
+    //Reallocate memory for array of pointers to the bonds
+    temp_ptr = realloc(molecule->bond_ptrs, bond_max * sizeof(struct bond*));
+    //Check if realloc failed
+    if (temp_ptr == NULL) {
+        fprintf(stderr, "Memory Allocation failed, exiting program.\n");
+        exit(EXIT_FAILURE);             
+    }
+    //Assign pointer to the bond_ptrs array
+    molecule->bond_ptrs = temp_ptr;
+    molecule->bond_max = bond_max;
+
+    // If the address of bonds changed, rebase the bond pointers (keeping any sorted order)
+    if (molecule->bonds != old_bonds) {
+        for (unsigned int i = 0; i < molecule->bond_no; i++) {
+            molecule->bond_ptrs[i] = molecule->bonds + (molecule->bond_ptrs[i] - old_bonds);
         }
-        //Assign pointer to the atom_ptrs array
-        molecule->atom_ptrs = temp_ptr;
     }
+}
+void molreserve( molecule *molecule, unsigned int atom_max, unsigned int bond_max ) {
+    //Grow capacity up front when the final counts are known; never shrinks
+    if (atom_max > molecule->atom_max) {
+        molgrow_atoms(molecule, atom_max);
+    }
+    if (bond_max > molecule->bond_max) {
+        molgrow_bonds(molecule, bond_max);
+    }
+}
+void molappend_atom( molecule *molecule, atom *atom ) {
+    //Double the capacity when full so appends are amortized O(1)
+    if (molecule->atom_no == molecule->atom_max) {
+        molgrow_atoms(molecule, molecule->atom_max ? molecule->atom_max * 2 : 1);
+    }
+    molinvalidate(molecule);
+
     //Adding atom to array of atoms in molecule
     molecule->atoms[molecule->atom_no] = *atom;
 
-    //Updating array of pointers to add new atom
-    for (int i = 0; i < molecule->atom_no + 1;i++) { 
-        molecule->atom_ptrs[i] = &molecule->atoms[i];
-    }
+    //Only the new atom needs a pointer; existing ones are still valid
+    molecule->atom_ptrs[molecule->atom_no] = &molecule->atoms[molecule->atom_no];
+
     //Increment number of atoms 
     molecule->atom_no++;
 }
 void molappend_bond( molecule *molecule, bond *bond ) {
-    //Check if the number of bonds in molecule has reached max 
+    //Double the capacity when full so appends are amortized O(1)
     if (molecule->bond_no == molecule->bond_max) { 
-        molecule->bond_max *= 2;
-        if (molecule->bond_max == 0) {
-        
-            molecule->bond_max = 1;
-        }
-        //Reallocate memory for array of bonds
-        void *temp_ptr = realloc(molecule->bonds, molecule->bond_max * sizeof(struct bond));
-        //Check if realloc failed
-        if (temp_ptr == NULL) { 
-            fprintf(stderr, "Memory Allocation failed, exiting program.\n");
-            exit(EXIT_FAILURE);            
-        }
-        //Assign pointer to the bonds array
-        molecule->bonds = temp_ptr;
-
-        //Reallocate memory for array of pointers to the bonds
-        temp_ptr = realloc(molecule->bond_ptrs, molecule->bond_max * sizeof(struct bond*));
-        //Check if realloc failed
-        if (temp_ptr == NULL) {
-            fprintf(stderr, "Memory Allocation failed, exiting program.\n");
-            exit(EXIT_FAILURE);             
-        }
-        //Assign pointer to the bond_ptrs array
-        molecule->bond_ptrs = temp_ptr;
+        molgrow_bonds(molecule, molecule->bond_max ? molecule->bond_max * 2 : 1);
     }
+    molinvalidate(molecule);
+
     //Adding bond to array of bonds in molecule
     molecule->bonds[molecule->bond_no] = *bond;
 
-    //Updating array of pointers to add new bond
-    for (int i = 0; i < molecule->bond_no + 1; i++) {
-        molecule->bond_ptrs[i] = &molecule->bonds[i];
-    }
+    //Only the new bond needs a pointer; existing ones are still valid
+    molecule->bond_ptrs[molecule->bond_no] = &molecule->bonds[molecule->bond_no];
 
     //Increment number of bonds 
     molecule->bond_no++;
@@ -227,9 +270,9 @@ int compare_atoms(const void *a, const void *b) {
     }
 }
 int bond_comp(const void* a, const void* b) {
-    // Cast pointers to bonds
-    bond* bond1 = (bond*)a;
-    bond* bond2 = (bond*)b;
+    // Elements of bond_ptrs are bond pointers, like atom_ptrs in compare_atoms
+    bond* bond1 = *(bond**)a;
+    bond* bond2 = *(bond**)b;
 
     // Compare z values of bonds
     if (bond1->z > bond2->z) {
@@ -242,12 +285,18 @@ int bond_comp(const void* a, const void* b) {
         return 0;
     }
 }
+void molinvalidate( molecule *molecule ) {
+    //Drop the cached pick grid; the next molpick rebuilds it from the current atoms and bonds
+    gridfree(molecule->pick_grid);
+    molecule->pick_grid = NULL;
+    molecule->pick_half = 0;
+}
 void molsort( molecule *molecule ) { 
     //Sort atoms and bonds based on return vals from compar functions
     qsort(molecule->atom_ptrs, molecule->atom_no, sizeof(struct atom*), compare_atoms);
     qsort(molecule->bond_ptrs, molecule->bond_no, sizeof(struct bond*), bond_comp);
 }
-void xrotation( xform_matrix xform_matrix, unsigned short deg ) { 
+void xrotation( xform_matrix xform_matrix, double deg ) { 
     //Convert degrees to rad
     double rad = deg * (M_PI / 180);
 
@@ -264,7 +313,7 @@ void xrotation( xform_matrix xform_matrix, unsigned short deg ) {
         }
     }
 }
-void yrotation( xform_matrix xform_matrix, unsigned short deg ) {
+void yrotation( xform_matrix xform_matrix, double deg ) {
     //Convert degrees to rad
     double rad = deg * (M_PI / 180);  
 
@@ -281,7 +330,7 @@ void yrotation( xform_matrix xform_matrix, unsigned short deg ) {
         }
     }    
 }
-void zrotation( xform_matrix xform_matrix, unsigned short deg ) {
+void zrotation( xform_matrix xform_matrix, double deg ) {
     //Convert degrees to rad 
     double rad = deg * (M_PI / 180);  
 
@@ -301,13 +350,8 @@ void zrotation( xform_matrix xform_matrix, unsigned short deg ) {
 void mol_xform(molecule *molecule, xform_matrix matrix) {
     double result[3];
 
-    // Loop through each bond and apply compute_coords
-    for (int i = 0; i < molecule->bond_no; i++) {
-        compute_coords(&molecule->bonds[i]);
-    }
-
     // Loop through each atom and apply the transformation matrix
-    for (int i = 0; i < molecule->atom_no; i++) {
+    for (unsigned int i = 0; i < molecule->atom_no; i++) {
         result[0] = matrix[0][0] * molecule->atoms[i].x + matrix[0][1] * molecule->atoms[i].y + matrix[0][2] * molecule->atoms[i].z;
         result[1] = matrix[1][0] * molecule->atoms[i].x + matrix[1][1] * molecule->atoms[i].y + matrix[1][2] * molecule->atoms[i].z;
         result[2] = matrix[2][0] * molecule->atoms[i].x + matrix[2][1] * molecule->atoms[i].y + matrix[2][2] * molecule->atoms[i].z;
@@ -317,6 +361,64 @@ void mol_xform(molecule *molecule, xform_matrix matrix) {
         molecule->atoms[i].y = result[1];
         molecule->atoms[i].z = result[2];
     }
+
+    // Bond geometry is derived from the atoms, so refresh it after they move
+    molcompute_bonds(molecule);
+}
+void xform_multiply( xform_matrix result, xform_matrix a, xform_matrix b ) {
+    //result = a * b
+    for (int i = 0; i < 3; i++) {
+        for (int j = 0; j < 3; j++) {
+            result[i][j] = a[i][0] * b[0][j] + a[i][1] * b[1][j] + a[i][2] * b[2][j];
+        }
+    }
+}
+void molrotate( molecule *molecule, double phi_x, double phi_y, double phi_z ) {
+    xform_matrix rx, ry, rz, ryx, matrix;
+    double cx = 0, cy = 0, cz = 0, x, y, z;
+
+    if (molecule->atom_no == 0) {
+        return;
+    }
+
+    //Compose x, then y, then z rotation into one matrix: Rz * Ry * Rx
+    xrotation(rx, phi_x);
+    yrotation(ry, phi_y);
+    zrotation(rz, phi_z);
+    xform_multiply(ryx, ry, rx);
+    xform_multiply(matrix, rz, ryx);
+
+    //Rotate around the centroid so the model stays in frame
+    for (unsigned int i = 0; i < molecule->atom_no; i++) {
+        cx += molecule->atoms[i].x;
+        cy += molecule->atoms[i].y;
+        cz += molecule->atoms[i].z;
+    }
+    cx /= molecule->atom_no;
+    cy /= molecule->atom_no;
+    cz /= molecule->atom_no;
+
+    for (unsigned int i = 0; i < molecule->atom_no; i++) {
+        x = molecule->atoms[i].x - cx;
+        y = molecule->atoms[i].y - cy;
+        z = molecule->atoms[i].z - cz;
+
+        molecule->atoms[i].x = matrix[0][0] * x + matrix[0][1] * y + matrix[0][2] * z + cx;
+        molecule->atoms[i].y = matrix[1][0] * x + matrix[1][1] * y + matrix[1][2] * z + cy;
+        molecule->atoms[i].z = matrix[2][0] * x + matrix[2][1] * y + matrix[2][2] * z + cz;
+    }
+
+    //Refresh bond geometry for the moved atoms
+    molcompute_bonds(molecule);
+}
+void molcompute_bonds( molecule *molecule ) {
+    //Atoms moved, so the pick grid no longer matches them
+    molinvalidate(molecule);
+
+    //Recompute the derived geometry of every bond from its atoms
+    for (unsigned int i = 0; i < molecule->bond_no; i++) {
+        compute_coords(&molecule->bonds[i]);
+    }
 }
 
 
@@ -338,3 +440,1158 @@ void compute_coords( bond *bond ) {
     bond->dy = (bond->y2 - bond->y1)/bond->len;
 
 }
+
+char *copy_text( const char *text ) {
+    //Duplicate a string (strdup is not part of C99)
+    size_t len = strlen(text);
+    char *copy = malloc(len + 1);
+    if (copy == NULL) {
+        fprintf(stderr, "Memory Allocation failed, exiting program.\n");
+        exit(EXIT_FAILURE);
+    }
+    memcpy(copy, text, len + 1);
+    return copy;
+}
+palette *palmalloc( void ) {
+    palette *ptr;
+
+    //Allocating memory for an empty palette
+    ptr = malloc(sizeof(palette));
+    if (ptr == NULL) {
+        return NULL;
+    }
+    ptr->style_max = 0;
+    ptr->style_no = 0;
+    ptr->styles = NULL;
+    return ptr;
+}
+void palfree( palette *ptr ) {
+    //Freeing the strings owned by each style, then the palette itself
+    for (unsigned int i = 0; i < ptr->style_no; i++) {
+        free(ptr->styles[i].radius_text);
+        free(ptr->styles[i].name);
+    }
+    free(ptr->styles);
+    free(ptr);
+}
+int style_comp( const void *a, const void *b ) {
+    //Order styles by element code so lookups can binary search
+    return strncmp(((const style *)a)->element, ((const style *)b)->element, 3);
+}
+void palappend( palette *palette, char element[3], double radius, char *radius_text, char *name ) {
+    style *existing = palfind(palette, element);
+
+    //Replace an existing style for the same element
+    if (existing != NULL) {
+        free(existing->radius_text);
+        free(existing->name);
+        existing->radius = radius;
+        existing->radius_text = copy_text(radius_text);
+        existing->name = copy_text(name);
+        return;
+    }
+
+    //Grow the styles array when full
+    if (palette->style_no == palette->style_max) {
+        palette->style_max = palette->style_max ? palette->style_max * 2 : 16;
+        void *temp_ptr = realloc(palette->styles, palette->style_max * sizeof(style));
+        if (temp_ptr == NULL) {
+            fprintf(stderr, "Memory Allocation failed, exiting program.\n");
+            exit(EXIT_FAILURE);
+        }
+        palette->styles = temp_ptr;
+    }
+
+    style *entry = &palette->styles[palette->style_no++];
+    memset(entry->element, 0, sizeof(entry->element));
+    strncpy(entry->element, element, 3);
+    entry->radius = radius;
+    entry->radius_text = copy_text(radius_text);
+    entry->name = copy_text(name);
+
+    //Keep the palette sorted by element code
+    qsort(palette->styles, palette->style_no, sizeof(style), style_comp);
+}
+style *palfind( palette *palette, char element[3] ) {
+    style key;
+
+    if (palette == NULL || palette->style_no == 0) {
+        return NULL;
+    }
+    memset(key.element, 0, sizeof(key.element));
+    strncpy(key.element, element, 3);
+    return bsearch(&key, palette->styles, palette->style_no, sizeof(style), style_comp);
+}
+void molfit( molecule *molecule, palette *palette, svg_view *view ) {
+    double min_x, max_x, min_y, max_y, max_r, span_x, span_y, scale_x, scale_y, scale;
+
+    //Defaults used for an empty molecule
+    view->scale = 100.0;
+    view->offsetx = view->width / 2.0;
+    view->offsety = view->height / 2.0;
+    if (molecule->atom_no == 0) {
+        return;
+    }
+
+    //Bounding box of the projected atoms and the largest radius drawn
+    min_x = max_x = molecule->atoms[0].x;
+    min_y = max_y = molecule->atoms[0].y;
+    max_r = 0;
+    for (unsigned int i = 0; i < molecule->atom_no; i++) {
+        atom *a = &molecule->atoms[i];
+        style *s = palfind(palette, a->element);
+        double r = s ? s->radius : 0;
+
+        if (a->x < min_x) min_x = a->x;
+        if (a->x > max_x) max_x = a->x;
+        if (a->y < min_y) min_y = a->y;
+        if (a->y > max_y) max_y = a->y;
+        if (i == 0 || r > max_r) max_r = r;
+    }
+
+    //Scale the molecule to fill 90% of the canvas, leaving room for the outermost atoms
+    span_x = fmax(max_x - min_x, 1e-6);
+    span_y = fmax(max_y - min_y, 1e-6);
+    scale_x = (0.9 * view->width - (2.0 * max_r)) / span_x;
+    scale_y = (0.9 * view->height - (2.0 * max_r)) / span_y;
+    scale = scale_x < scale_y ? scale_x : scale_y;
+    if (scale < 20.0) scale = 20.0;
+    if (scale > 180.0) scale = 180.0;
+    view->scale = scale;
+
+    view->offsetx = (view->width / 2.0) - (((min_x + max_x) / 2.0) * scale);
+    view->offsety = (view->height / 2.0) - (((min_y + max_y) / 2.0) * scale);
+}
+
+typedef struct svgbuf
+{
+char *data;
+size_t len, max;
+} svgbuf;
+
+void svgbuf_printf( svgbuf *buf, const char *format, ... ) {
+    va_list args;
+    int needed;
+
+    //Try to format in place, growing the buffer and retrying if it did not fit
+    for (;;) {
+        va_start(args, format);
+        needed = vsnprintf(buf->data + buf->len, buf->max - buf->len, format, args);
+        va_end(args);
+        if (needed < 0) {
+            fprintf(stderr, "SVG formatting failed, exiting program.\n");
+            exit(EXIT_FAILURE);
+        }
+        if (buf->len + needed < buf->max) {
+            buf->len += needed;
+            return;
+        }
+        while (buf->len + needed >= buf->max) {
+            buf->max *= 2;
+        }
+        void *temp_ptr = realloc(buf->data, buf->max);
+        if (temp_ptr == NULL) {
+            fprintf(stderr, "Memory Allocation failed, exiting program.\n");
+            exit(EXIT_FAILURE);
+        }
+        buf->data = temp_ptr;
+    }
+}
+
+int depth_comp( const void *a, const void *b ) {
+    const depth_item *item1 = a;
+    const depth_item *item2 = b;
+
+    //Sort by z, breaking ties by draw index so the order matches a stable sort
+    if (item1->z > item2->z) return 1;
+    if (item1->z < item2->z) return -1;
+    if (item1->item > item2->item) return 1;
+    if (item1->item < item2->item) return -1;
+    return 0;
+}
+double svg_num( double value ) {
+    //printf can print NaN as "-nan"; Python always prints "nan"
+    return isnan(value) ? fabs(value) : value;
+}
+void svg_atom( svgbuf *buf, molecule *molecule, palette *palette, svg_view *view, unsigned int i ) {
+    atom *a = &molecule->atoms[i];
+    style *s = palfind(palette, a->element);
+    double cx = a->x * view->scale + view->offsetx;
+    double cy = a->y * view->scale + view->offsety;
+
+    svgbuf_printf(buf,
+        "  <circle class=\"atom\" data-atom-index=\"%u\" data-element=\"%.3s\" cx=\"%.2f\" cy=\"%.2f\" "
+        "r=\"%s\" fill=\"url(#%s)\"/>\n",
+        i, a->element, svg_num(cx), svg_num(cy), s ? s->radius_text : "0", s ? s->name : "None");
+}
+void svg_bond( svgbuf *buf, molecule *molecule, svg_view *view, unsigned int i ) {
+    bond *b = &molecule->bonds[i];
+    double x1 = (b->x1 * view->scale) + view->offsetx;
+    double y1 = (b->y1 * view->scale) + view->offsety;
+    double x2 = (b->x2 * view->scale) + view->offsetx;
+    double y2 = (b->y2 * view->scale) + view->offsety;
+
+    //Four corners of a 20px wide band along the bond
+    svgbuf_printf(buf,
+        "  <polygon class=\"bond\" data-bond-index=\"%u\" data-a1=\"%u\" data-a2=\"%u\" "
+        "data-epairs=\"%d\" points=\"%.2f,%.2f %.2f,%.2f %.2f,%.2f %.2f,%.2f\" fill=\"#16a34a\"/>\n",
+        i, b->a1, b->a2, b->epairs,
+        svg_num(x1 + (b->dy * 10)), svg_num(y1 - (b->dx * 10)),
+        svg_num(x1 - (b->dy * 10)), svg_num(y1 + (b->dx * 10)),
+        svg_num(x2 - (b->dy * 10)), svg_num(y2 + (b->dx * 10)),
+        svg_num(x2 + (b->dy * 10)), svg_num(y2 - (b->dx * 10)));
+}
+depth_item *svg_order( molecule *molecule ) {
+    unsigned int count = molecule->atom_no + molecule->bond_no;
+    depth_item *items = malloc(sizeof(depth_item) * (count ? count : 1));
+
+    if (items == NULL) {
+        return NULL;
+    }
+
+    //Collect atoms (first) and bonds with their depths, then sort back to front
+    for (unsigned int i = 0; i < molecule->atom_no; i++) {
+        items[i].z = molecule->atoms[i].z;
+        items[i].item = i;
+    }
+    for (unsigned int i = 0; i < molecule->bond_no; i++) {
+        items[molecule->atom_no + i].z = molecule->bonds[i].z;
+        items[molecule->atom_no + i].item = molecule->atom_no + i;
+    }
+    qsort(items, count, sizeof(depth_item), depth_comp);
+    return items;
+}
+depth_order *depth_order_malloc( void ) {
+    return calloc(1, sizeof(depth_order));
+}
+void depth_order_free( depth_order *order ) {
+    if (order == NULL) {
+        return;
+    }
+    free(order->items);
+    free(order->scratch);
+    free(order);
+}
+int depth_before( const depth_item *a, const depth_item *b ) {
+    //Same order as depth_comp, inlined for the repair sort
+    return a->z < b->z || (!(a->z > b->z) && a->item < b->item);
+}
+unsigned long depth_merge( depth_item *items, depth_item *scratch, unsigned int lo, unsigned int mid, unsigned int hi ) {
+    unsigned int start, end, low, high, i, j, k;
+
+    //Neighbouring runs that are already in order cost one comparison
+    if (!depth_before(&items[mid], &items[mid - 1])) {
+        return 0;
+    }
+
+    //Only the overlap needs merging: left items after items[mid], right items before items[mid - 1]
+    low = lo;
+    high = mid;
+    while (low < high) {
+        unsigned int half = low + (high - low) / 2;
+        if (depth_before(&items[mid], &items[half])) high = half; else low = half + 1;
+    }
+    start = low;
+
+    low = mid;
+    high = hi;
+    while (low < high) {
+        unsigned int half = low + (high - low) / 2;
+        if (depth_before(&items[half], &items[mid - 1])) low = half + 1; else high = half;
+    }
+    end = low;
+
+    memcpy(scratch, &items[start], sizeof(depth_item) * (mid - start));
+    i = 0;
+    j = mid;
+    k = start;
+    while (i < mid - start && j < end) {
+        items[k++] = depth_before(&items[j], &scratch[i]) ? items[j++] : scratch[i++];
+    }
+    while (i < mid - start) {
+        items[k++] = scratch[i++];
+    }
+    return end - start;
+}
+unsigned long depth_sort( depth_item *items, depth_item *scratch, unsigned int count ) {
+    unsigned long moves = 0;
+
+    //Insertion sort short runs, then merge runs pairwise; on the last frame's order most
+    //merges touch only a few items at the seam, so a small rotation costs close to O(n)
+    for (unsigned int lo = 0; lo < count; lo += DEPTH_RUN) {
+        unsigned int hi = lo + DEPTH_RUN < count ? lo + DEPTH_RUN : count;
+        for (unsigned int i = lo + 1; i < hi; i++) {
+            depth_item current = items[i];
+            unsigned int j = i;
+
+            while (j > lo && depth_before(&current, &items[j - 1])) {
+                items[j] = items[j - 1];
+                j--;
+            }
+            items[j] = current;
+            moves += i - j;
+        }
+    }
+    for (unsigned int width = DEPTH_RUN; width < count; width *= 2) {
+        for (unsigned int lo = 0; lo + width < count; lo += 2 * width) {
+            unsigned int hi = lo + 2 * width < count ? lo + 2 * width : count;
+            moves += depth_merge(items, scratch, lo, lo + width, hi);
+        }
+    }
+    return moves;
+}
+depth_item *depth_order_update( depth_order *order, molecule *molecule ) {
+    unsigned int count = molecule->atom_no + molecule->bond_no;
+
+    //First frame, or the molecule changed size: start from drawing order
+    if (order->items == NULL || order->count != count) {
+        free(order->items);
+        free(order->scratch);
+        order->items = malloc(sizeof(depth_item) * (count ? count : 1));
+        order->scratch = malloc(sizeof(depth_item) * (count ? count : 1));
+        if (order->items == NULL || order->scratch == NULL) {
+            free(order->items);
+            free(order->scratch);
+            order->items = order->scratch = NULL;
+            order->count = 0;
+            return NULL;
+        }
+        for (unsigned int i = 0; i < count; i++) {
+            order->items[i].item = i;
+        }
+        order->count = count;
+        order->frames = 0;
+    }
+
+    //Refresh depths in the previous frame's order, then repair it
+    for (unsigned int i = 0; i < count; i++) {
+        unsigned int item = order->items[i].item;
+        order->items[i].z = item < molecule->atom_no ? molecule->atoms[item].z : molecule->bonds[item - molecule->atom_no].z;
+    }
+    order->moves = depth_sort(order->items, order->scratch, count);
+    order->frames++;
+    return order->items;
+}
+char *svg_items( molecule *molecule, palette *palette, svg_view *view, depth_item *items, unsigned int start, unsigned int end ) {
+    svgbuf buf;
+
+    //Roughly 160 bytes per element is enough to avoid most regrowth
+    buf.len = 0;
+    buf.max = 160 * (size_t)(end - start) + 1;
+    buf.data = malloc(buf.max);
+    if (buf.data == NULL) {
+        return NULL;
+    }
+    buf.data[0] = '\0';
+
+    for (unsigned int i = start; i < end; i++) {
+        if (items[i].item < molecule->atom_no) {
+            svg_atom(&buf, molecule, palette, view, items[i].item);
+        }
+        else {
+            svg_bond(&buf, molecule, view, items[i].item - molecule->atom_no);
+        }
+    }
+    return buf.data;
+}
+char *molsvg( molecule *molecule, palette *palette, svg_view *view ) {
+    return molsvg_ordered(molecule, palette, view, NULL);
+}
+char *molsvg_ordered( molecule *molecule, palette *palette, svg_view *view, depth_order *order ) {
+    depth_item *items;
+    char *svg;
+
+    //Fit the view, then write every element back to front in a single buffer;
+    //with an order kept from the previous frame the sort is only a repair
+    molfit(molecule, palette, view);
+    items = order ? depth_order_update(order, molecule) : svg_order(molecule);
+    if (items == NULL) {
+        return NULL;
+    }
+    svg = svg_items(molecule, palette, view, items, 0, molecule->atom_no + molecule->bond_no);
+
+    if (order == NULL) {
+        free(items);
+    }
+    return svg;
+}
+void lod_bounds( molecule *molecule, palette *palette, svg_view *view, unsigned int item, double box[4] ) {
+    //Screen space bounding box (x0, y0, x1, y1) of an atom's circle or a bond's band
+    if (item < molecule->atom_no) {
+        atom *a = &molecule->atoms[item];
+        style *s = palfind(palette, a->element);
+        double r = s ? s->radius : 0;
+        double cx = a->x * view->scale + view->offsetx;
+        double cy = a->y * view->scale + view->offsety;
+        box[0] = cx - r;
+        box[1] = cy - r;
+        box[2] = cx + r;
+        box[3] = cy + r;
+    }
+    else {
+        bond *b = &molecule->bonds[item - molecule->atom_no];
+        double x1 = (b->x1 * view->scale) + view->offsetx;
+        double y1 = (b->y1 * view->scale) + view->offsety;
+        double x2 = (b->x2 * view->scale) + view->offsetx;
+        double y2 = (b->y2 * view->scale) + view->offsety;
+        double ex = fabs(b->dy * 10), ey = fabs(b->dx * 10);
+        box[0] = (x1 < x2 ? x1 : x2) - ex;
+        box[1] = (y1 < y2 ? y1 : y2) - ey;
+        box[2] = (x1 > x2 ? x1 : x2) + ex;
+        box[3] = (y1 > y2 ? y1 : y2) + ey;
+    }
+}
+int lod_covered( unsigned char *grid, unsigned int cols, unsigned int rows, double box[4] ) {
+    unsigned int c0, c1, r0, r1;
+
+    //Degenerate geometry (e.g. a bond seen end-on) has NaN points and never renders anyway
+    if (isnan(box[0]) || isnan(box[1]) || isnan(box[2]) || isnan(box[3])) {
+        return 1;
+    }
+    //Nothing outside the canvas is visible
+    if (box[2] < 0 || box[3] < 0 || box[0] >= cols * LOD_CELL || box[1] >= rows * LOD_CELL) {
+        return 1;
+    }
+
+    //Hidden only when every cell the box touches is already covered by something nearer
+    c0 = box[0] < 0 ? 0 : (unsigned int)(box[0] / LOD_CELL);
+    r0 = box[1] < 0 ? 0 : (unsigned int)(box[1] / LOD_CELL);
+    c1 = box[2] / LOD_CELL >= cols ? cols - 1 : (unsigned int)(box[2] / LOD_CELL);
+    r1 = box[3] / LOD_CELL >= rows ? rows - 1 : (unsigned int)(box[3] / LOD_CELL);
+    for (unsigned int r = r0; r <= r1; r++) {
+        for (unsigned int c = c0; c <= c1; c++) {
+            if (!grid[r * cols + c]) {
+                return 0;
+            }
+        }
+    }
+    return 1;
+}
+void lod_cover( unsigned char *grid, unsigned int cols, unsigned int rows, double cx, double cy, double r, double box[4] ) {
+    unsigned int c0, c1, r0, r1;
+
+    if (isnan(cx) || isnan(cy) || r <= 0 || box[2] < 0 || box[3] < 0 ||
+        box[0] >= cols * LOD_CELL || box[1] >= rows * LOD_CELL) {
+        return;
+    }
+
+    //Mark the cells that lie entirely inside the circle: their farthest corner is within r
+    c0 = box[0] < 0 ? 0 : (unsigned int)(box[0] / LOD_CELL);
+    r0 = box[1] < 0 ? 0 : (unsigned int)(box[1] / LOD_CELL);
+    c1 = box[2] / LOD_CELL >= cols ? cols - 1 : (unsigned int)(box[2] / LOD_CELL);
+    r1 = box[3] / LOD_CELL >= rows ? rows - 1 : (unsigned int)(box[3] / LOD_CELL);
+    for (unsigned int row = r0; row <= r1; row++) {
+        double dy = fmax(fabs(cy - row * LOD_CELL), fabs(cy - (row + 1) * LOD_CELL));
+        for (unsigned int c = c0; c <= c1; c++) {
+            double dx = fmax(fabs(cx - c * LOD_CELL), fabs(cx - (c + 1) * LOD_CELL));
+            if (dx * dx + dy * dy <= r * r) {
+                grid[row * cols + c] = 1;
+            }
+        }
+    }
+}
+char *molsvg_lod( molecule *molecule, palette *palette, svg_view *view, unsigned int budget, double merge_far ) {
+    return molsvg_lod_ordered(molecule, palette, view, budget, merge_far, NULL);
+}
+char *molsvg_lod_ordered( molecule *molecule, palette *palette, svg_view *view, unsigned int budget, double merge_far, depth_order *order ) {
+    unsigned int count = molecule->atom_no + molecule->bond_no;
+    unsigned int cols, rows, kept = 0, merged = 0;
+    unsigned char *grid, *keep;
+    depth_item *items;
+    double far_z = 0, box[4];
+    svgbuf buf;
+
+    molfit(molecule, palette, view);
+    items = order ? depth_order_update(order, molecule) : svg_order(molecule);
+    if (items == NULL) {
+        return NULL;
+    }
+    cols = view->width > LOD_CELL ? (unsigned int)ceil(view->width / LOD_CELL) : 1;
+    rows = view->height > LOD_CELL ? (unsigned int)ceil(view->height / LOD_CELL) : 1;
+    grid = calloc((size_t)cols * rows, 1);
+    keep = calloc(count ? count : 1, 1);
+    if (grid == NULL || keep == NULL) {
+        if (order == NULL) {
+            free(items);
+        }
+        free(grid);
+        free(keep);
+        return NULL;
+    }
+    if (count > 0) {
+        far_z = items[0].z + merge_far * (items[count - 1].z - items[0].z);
+    }
+
+    //Walk front to back: skip anything already hidden, let drawn atoms cover the grid,
+    //fold far bonds into one path and stop drawing once the budget is spent (keep: 1 draw, 2 merge)
+    for (unsigned int i = count; i-- > 0;) {
+        unsigned int item = items[i].item;
+
+        lod_bounds(molecule, palette, view, item, box);
+        if (lod_covered(grid, cols, rows, box)) {
+            continue;
+        }
+        if (item >= molecule->atom_no && merge_far > 0 && items[i].z < far_z) {
+            keep[i] = 2;
+            merged++;
+            continue;
+        }
+        if (budget > 0 && kept >= budget) {
+            continue;
+        }
+        keep[i] = 1;
+        kept++;
+        if (item < molecule->atom_no) {
+            atom *a = &molecule->atoms[item];
+            style *s = palfind(palette, a->element);
+            lod_cover(grid, cols, rows, a->x * view->scale + view->offsetx,
+                a->y * view->scale + view->offsety, s ? s->radius : 0, box);
+        }
+    }
+
+    buf.len = 0;
+    buf.max = 160 * (size_t)kept + 64 * (size_t)merged + 1;
+    buf.data = malloc(buf.max);
+    if (buf.data == NULL) {
+        if (order == NULL) {
+            free(items);
+        }
+        free(grid);
+        free(keep);
+        return NULL;
+    }
+    buf.data[0] = '\0';
+
+    //Far bonds go first as one path, behind everything else
+    if (merged > 0) {
+        svgbuf_printf(&buf, "  <path class=\"bond-lod\" d=\"");
+        for (unsigned int i = 0; i < count; i++) {
+            if (keep[i] == 2) {
+                bond *b = &molecule->bonds[items[i].item - molecule->atom_no];
+                double x1 = (b->x1 * view->scale) + view->offsetx;
+                double y1 = (b->y1 * view->scale) + view->offsety;
+                double x2 = (b->x2 * view->scale) + view->offsetx;
+                double y2 = (b->y2 * view->scale) + view->offsety;
+                svgbuf_printf(&buf, "M%.2f,%.2fL%.2f,%.2fL%.2f,%.2fL%.2f,%.2fZ",
+                    svg_num(x1 + (b->dy * 10)), svg_num(y1 - (b->dx * 10)),
+                    svg_num(x1 - (b->dy * 10)), svg_num(y1 + (b->dx * 10)),
+                    svg_num(x2 - (b->dy * 10)), svg_num(y2 + (b->dx * 10)),
+                    svg_num(x2 + (b->dy * 10)), svg_num(y2 - (b->dx * 10)));
+            }
+        }
+        svgbuf_printf(&buf, "\" fill=\"#16a34a\"/>\n");
+    }
+
+    //Then the surviving elements back to front, with the same markup as molsvg
+    for (unsigned int i = 0; i < count; i++) {
+        if (keep[i] != 1) {
+            continue;
+        }
+        if (items[i].item < molecule->atom_no) {
+            svg_atom(&buf, molecule, palette, view, items[i].item);
+        }
+        else {
+            svg_bond(&buf, molecule, view, items[i].item - molecule->atom_no);
+        }
+    }
+
+    if (order == NULL) {
+        free(items);
+    }
+    free(grid);
+    free(keep);
+    return buf.data;
+}
+svg_stream *molsvg_open( molecule *molecule, palette *palette, svg_view *view ) {
+    svg_stream *stream = malloc(sizeof(svg_stream));
+
+    if (stream == NULL) {
+        return NULL;
+    }
+
+    //Fit and depth sort once; molsvg_next then formats the sorted elements a slice at a time.
+    //The molecule and palette must outlive the stream and stay unchanged while it is open.
+    stream->view = *view;
+    molfit(molecule, palette, &stream->view);
+    *view = stream->view;
+    stream->items = svg_order(molecule);
+    if (stream->items == NULL) {
+        free(stream);
+        return NULL;
+    }
+    stream->molecule = molecule;
+    stream->palette = palette;
+    stream->count = molecule->atom_no + molecule->bond_no;
+    stream->next = 0;
+    return stream;
+}
+char *molsvg_next( svg_stream *stream, unsigned int max_items ) {
+    unsigned int start = stream->next, end;
+
+    //NULL once every element has been written
+    if (start >= stream->count) {
+        return NULL;
+    }
+    end = (max_items > 0 && stream->count - start > max_items) ? start + max_items : stream->count;
+    stream->next = end;
+    return svg_items(stream->molecule, stream->palette, &stream->view, stream->items, start, end);
+}
+void molsvg_close( svg_stream *stream ) {
+    free(stream->items);
+    free(stream);
+}
+char *molelements( molecule *molecule ) {
+    //Space separated list of the distinct element codes in the molecule
+    char *codes = malloc(4 * (size_t)molecule->atom_no + 1);
+    unsigned int distinct = 0;
+    size_t len = 0;
+
+    if (codes == NULL) {
+        return NULL;
+    }
+
+    //Collect each distinct code into its own 4 byte slot
+    for (unsigned int i = 0; i < molecule->atom_no; i++) {
+        int seen = 0;
+        for (unsigned int j = 0; j < distinct && !seen; j++) {
+            seen = (strncmp(codes + 4 * j, molecule->atoms[i].element, 3) == 0);
+        }
+        if (!seen) {
+            memset(codes + 4 * distinct, 0, 4);
+            strncpy(codes + 4 * distinct, molecule->atoms[i].element, 3);
+            distinct++;
+        }
+    }
+
+    //Pack the slots together in place, separated by spaces
+    for (unsigned int j = 0; j < distinct; j++) {
+        size_t n = strlen(codes + 4 * j);
+        memmove(codes + len, codes + 4 * j, n);
+        len += n;
+        codes[len++] = ' ';
+    }
+    codes[len ? len - 1 : 0] = '\0';
+    return codes;
+}
+void molpack( molecule *molecule, char *elements, char *coords, char *bonds ) {
+    //Write element codes, xyz and (a1, a2, epairs) into caller-sized packed buffers
+    for (unsigned int i = 0; i < molecule->atom_no; i++) {
+        atom *a = &molecule->atoms[i];
+        double xyz[3] = { a->x, a->y, a->z };
+
+        memcpy(elements + i * PACKED_ELEMENT_SIZE, a->element, PACKED_ELEMENT_SIZE);
+        memcpy(coords + i * PACKED_COORD_SIZE, xyz, PACKED_COORD_SIZE);
+    }
+    for (unsigned int i = 0; i < molecule->bond_no; i++) {
+        bond *b = &molecule->bonds[i];
+        unsigned int row[3] = { b->a1, b->a2, b->epairs };
+
+        memcpy(bonds + i * PACKED_BOND_SIZE, row, PACKED_BOND_SIZE);
+    }
+}
+int molunpack( molecule *molecule, const char *elements, const char *coords, unsigned int atom_no, const char *bonds, unsigned int bond_no ) {
+    atom a;
+    bond b;
+    unsigned int row[3];
+    double xyz[3];
+    unsigned int base = molecule->atom_no;
+
+    //Validate every bond before touching the molecule
+    for (unsigned int i = 0; i < bond_no; i++) {
+        memcpy(row, bonds + i * PACKED_BOND_SIZE, PACKED_BOND_SIZE);
+        if (row[0] >= atom_no || row[1] >= atom_no) {
+            return -1;
+        }
+    }
+
+    molreserve(molecule, base + atom_no, molecule->bond_no + bond_no);
+
+    //Append atoms straight from the packed buffers (memcpy, as blobs need not be aligned)
+    for (unsigned int i = 0; i < atom_no; i++) {
+        memcpy(a.element, elements + i * PACKED_ELEMENT_SIZE, PACKED_ELEMENT_SIZE);
+        a.element[2] = '\0';
+        memcpy(xyz, coords + i * PACKED_COORD_SIZE, PACKED_COORD_SIZE);
+        a.x = xyz[0];
+        a.y = xyz[1];
+        a.z = xyz[2];
+        molappend_atom(molecule, &a);
+    }
+
+    //Append bonds, offset past any atoms the molecule already had
+    for (unsigned int i = 0; i < bond_no; i++) {
+        memcpy(row, bonds + i * PACKED_BOND_SIZE, PACKED_BOND_SIZE);
+        b.a1 = base + row[0];
+        b.a2 = base + row[1];
+        b.epairs = (unsigned char)row[2];
+        b.atoms = molecule->atoms;
+        compute_coords(&b);
+        molappend_bond(molecule, &b);
+    }
+    return 0;
+}
+
+typedef struct sdf_line
+{
+const char *start;
+size_t len;
+unsigned int number;
+} sdf_line;
+
+int sdf_next_line( const char **cursor, const char *end, sdf_line *line ) {
+    const char *newline;
+
+    //Split off the next line, dropping the '\n' and any '\r' before it
+    if (*cursor >= end) {
+        return 0;
+    }
+    newline = memchr(*cursor, '\n', end - *cursor);
+    line->start = *cursor;
+    line->len = (newline ? newline : end) - *cursor;
+    if (line->len > 0 && line->start[line->len - 1] == '\r') {
+        line->len--;
+    }
+    line->number++;
+    *cursor = newline ? newline + 1 : end;
+    return 1;
+}
+int sdf_field( sdf_line *line, size_t column, size_t width, char *field ) {
+    //Copy the fixed-width field starting at a 0-based column, trimmed; 0 if blank or missing
+    size_t start = column, stop = column + width;
+
+    if (start >= line->len) {
+        field[0] = '\0';
+        return 0;
+    }
+    if (stop > line->len) {
+        stop = line->len;
+    }
+    while (start < stop && line->start[start] == ' ') start++;
+    while (stop > start && line->start[stop - 1] == ' ') stop--;
+    memcpy(field, line->start + start, stop - start);
+    field[stop - start] = '\0';
+    return stop > start;
+}
+int sdf_long( sdf_line *line, size_t column, size_t width, long *value ) {
+    char field[16], *rest;
+
+    if (!sdf_field(line, column, width, field)) {
+        return 0;
+    }
+    *value = strtol(field, &rest, 10);
+    return *rest == '\0';
+}
+int sdf_double( sdf_line *line, size_t column, size_t width, double *value ) {
+    char field[16], *rest;
+
+    if (!sdf_field(line, column, width, field)) {
+        return 0;
+    }
+    *value = strtod(field, &rest);
+    return *rest == '\0';
+}
+unsigned int sdf_fail( molecule *molecule, unsigned int atom_no, unsigned int bond_no, sdf_line *line, char *error, size_t error_len, const char *message ) {
+    //Roll the molecule back to its state before the parse and report the line
+    molinvalidate(molecule);
+    molecule->atom_no = atom_no;
+    molecule->bond_no = bond_no;
+    snprintf(error, error_len, "%s", message);
+    return line->number ? line->number : 1;
+}
+unsigned int molparse_v2000( molecule *molecule, const char *buffer, size_t length, char *error, size_t error_len ) {
+    const char *cursor = buffer, *end = buffer + length;
+    unsigned int atom_no = molecule->atom_no, bond_no = molecule->bond_no;
+    sdf_line line;
+    long num_atoms, num_bonds, a1, a2, epairs;
+    char version[8];
+    atom a;
+    bond b;
+
+    line.number = 0;
+    error[0] = '\0';
+
+    //Header block: name, program and comment lines
+    for (int i = 0; i < 3; i++) {
+        if (!sdf_next_line(&cursor, end, &line)) {
+            return sdf_fail(molecule, atom_no, bond_no, &line, error, error_len, "missing header block");
+        }
+    }
+
+    //Counts line: aaabbb...vvvvvv with the atom and bond counts in columns 1-3 and 4-6
+    if (!sdf_next_line(&cursor, end, &line)) {
+        return sdf_fail(molecule, atom_no, bond_no, &line, error, error_len, "missing counts line");
+    }
+    if (!sdf_long(&line, 0, 3, &num_atoms) || !sdf_long(&line, 3, 3, &num_bonds) || num_atoms < 0 || num_bonds < 0) {
+        return sdf_fail(molecule, atom_no, bond_no, &line, error, error_len, "invalid counts line");
+    }
+    if (sdf_field(&line, 33, 6, version) && strcmp(version, "V2000") != 0) {
+        return sdf_fail(molecule, atom_no, bond_no, &line, error, error_len, "only V2000 records are supported");
+    }
+    molreserve(molecule, atom_no + (unsigned int)num_atoms, bond_no + (unsigned int)num_bonds);
+
+    //Atom block: x, y, z in 10 column fields, then the symbol in columns 32-34
+    for (long i = 0; i < num_atoms; i++) {
+        if (!sdf_next_line(&cursor, end, &line)) {
+            return sdf_fail(molecule, atom_no, bond_no, &line, error, error_len, "atom block ended early");
+        }
+        if (!sdf_double(&line, 0, 10, &a.x) || !sdf_double(&line, 10, 10, &a.y) || !sdf_double(&line, 20, 10, &a.z)) {
+            return sdf_fail(molecule, atom_no, bond_no, &line, error, error_len, "invalid atom coordinates");
+        }
+        if (!isfinite(a.x) || !isfinite(a.y) || !isfinite(a.z)) {
+            return sdf_fail(molecule, atom_no, bond_no, &line, error, error_len, "non-finite atom coordinates");
+        }
+        char symbol[4];
+        if (!sdf_field(&line, 31, 3, symbol) || strlen(symbol) >= sizeof(a.element)) {
+            return sdf_fail(molecule, atom_no, bond_no, &line, error, error_len, "invalid atom symbol");
+        }
+        memset(a.element, 0, sizeof(a.element));
+        memcpy(a.element, symbol, strlen(symbol));
+        molappend_atom(molecule, &a);
+    }
+
+    //Bond block: 1-based atom numbers in columns 1-3 and 4-6, bond type in 7-9
+    for (long i = 0; i < num_bonds; i++) {
+        if (!sdf_next_line(&cursor, end, &line)) {
+            return sdf_fail(molecule, atom_no, bond_no, &line, error, error_len, "bond block ended early");
+        }
+        if (!sdf_long(&line, 0, 3, &a1) || !sdf_long(&line, 3, 3, &a2) || !sdf_long(&line, 6, 3, &epairs)) {
+            return sdf_fail(molecule, atom_no, bond_no, &line, error, error_len, "invalid bond line");
+        }
+        if (a1 < 1 || a1 > num_atoms || a2 < 1 || a2 > num_atoms || epairs < 0 || epairs > 255) {
+            return sdf_fail(molecule, atom_no, bond_no, &line, error, error_len, "bond refers to a missing atom");
+        }
+        b.a1 = atom_no + (unsigned int)(a1 - 1);
+        b.a2 = atom_no + (unsigned int)(a2 - 1);
+        b.epairs = (unsigned char)epairs;
+        b.atoms = molecule->atoms;
+        compute_coords(&b);
+        molappend_bond(molecule, &b);
+    }
+    return 0;
+}
+
+unsigned int gridaxis( double value, double min, double cell, unsigned int n ) {
+    //Cell coordinate along one axis, clamped to the grid (NaN lands in cell 0)
+    double c = floor((value - min) / cell);
+    if (!(c > 0)) return 0;
+    if (c >= n) return n - 1;
+    return (unsigned int)c;
+}
+size_t gridcell( spatial_grid *grid, double x, double y, double z ) {
+    return ((size_t)gridaxis(z, grid->minz, grid->cell, grid->nz) * grid->ny +
+            gridaxis(y, grid->miny, grid->cell, grid->ny)) * grid->nx +
+            gridaxis(x, grid->minx, grid->cell, grid->nx);
+}
+double gridextent( double span, double cell ) {
+    //Cells along one axis; a span too wide to divide (overflow to infinity) gets a single cell
+    double n = floor(span / cell) + 1;
+    return (n >= 1 && n <= (double)GRID_MAX_AXIS) ? n : 1;
+}
+spatial_grid *gridbuild( const double *points, unsigned int count, double cell ) {
+    spatial_grid *grid;
+    double maxx, maxy, maxz, cells, span, limit;
+    unsigned int *fill;
+
+    //Uniform grid (cell list) over count x, y, z triples, stored as a counting sort:
+    //the points in cell c are index[start[c]] .. index[start[c + 1] - 1]
+    grid = malloc(sizeof(spatial_grid));
+    if (grid == NULL) {
+        return NULL;
+    }
+    //Bounds of the finite points only; NaN and infinite points are clamped into edge cells by gridaxis
+    grid->minx = grid->miny = grid->minz = 0;
+    maxx = maxy = maxz = 0;
+    for (unsigned int i = 0, seen = 0; i < count; i++) {
+        const double *p = points + 3 * (size_t)i;
+        if (!isfinite(p[0]) || !isfinite(p[1]) || !isfinite(p[2])) {
+            continue;
+        }
+        if (!seen || p[0] < grid->minx) grid->minx = p[0];
+        if (!seen || p[1] < grid->miny) grid->miny = p[1];
+        if (!seen || p[2] < grid->minz) grid->minz = p[2];
+        if (!seen || p[0] > maxx) maxx = p[0];
+        if (!seen || p[1] > maxy) maxy = p[1];
+        if (!seen || p[2] > maxz) maxz = p[2];
+        seen = 1;
+    }
+
+    //Coarsen sparse grids so memory stays linear in the number of points. Starting no finer than
+    //span / limit per axis leaves at most limit^3 cells, so the doubling ends within GRID_COARSEN steps.
+    limit = 4.0 * count + 64;
+    span = fmax(fmax(maxx - grid->minx, maxy - grid->miny), maxz - grid->minz);
+    grid->cell = cell > 0 && isfinite(cell) ? cell : 1.0;
+    if (span / grid->cell > limit) {
+        grid->cell = span / limit;
+    }
+    for (int step = 0; step < GRID_COARSEN; step++) {
+        cells = gridextent(maxx - grid->minx, grid->cell) *
+                gridextent(maxy - grid->miny, grid->cell) *
+                gridextent(maxz - grid->minz, grid->cell);
+        if (cells <= limit) {
+            break;
+        }
+        grid->cell *= 2;
+    }
+    grid->nx = (unsigned int)gridextent(maxx - grid->minx, grid->cell);
+    grid->ny = (unsigned int)gridextent(maxy - grid->miny, grid->cell);
+    grid->nz = (unsigned int)gridextent(maxz - grid->minz, grid->cell);
+
+    grid->start = calloc((size_t)grid->nx * grid->ny * grid->nz + 1, sizeof(unsigned int));
+    grid->index = malloc(sizeof(unsigned int) * (count ? count : 1));
+    fill = calloc((size_t)grid->nx * grid->ny * grid->nz, sizeof(unsigned int));
+    if (grid->start == NULL || grid->index == NULL || fill == NULL) {
+        free(fill);
+        gridfree(grid);
+        return NULL;
+    }
+
+    //Count per cell, prefix sum, then scatter the point indices
+    for (unsigned int i = 0; i < count; i++) {
+        const double *p = points + 3 * (size_t)i;
+        grid->start[gridcell(grid, p[0], p[1], p[2]) + 1]++;
+    }
+    for (size_t c = 0; c < (size_t)grid->nx * grid->ny * grid->nz; c++) {
+        grid->start[c + 1] += grid->start[c];
+    }
+    for (unsigned int i = 0; i < count; i++) {
+        const double *p = points + 3 * (size_t)i;
+        size_t c = gridcell(grid, p[0], p[1], p[2]);
+        grid->index[grid->start[c] + fill[c]++] = i;
+    }
+
+    free(fill);
+    return grid;
+}
+void gridfree( spatial_grid *grid ) {
+    if (grid == NULL) {
+        return;
+    }
+    free(grid->start);
+    free(grid->index);
+    free(grid);
+}
+double *molpoints( molecule *molecule ) {
+    //Atom coordinates as a flat x, y, z array for gridbuild
+    double *points = malloc(sizeof(double) * 3 * (molecule->atom_no ? molecule->atom_no : 1));
+    if (points == NULL) {
+        return NULL;
+    }
+    for (unsigned int i = 0; i < molecule->atom_no; i++) {
+        points[3 * (size_t)i] = molecule->atoms[i].x;
+        points[3 * (size_t)i + 1] = molecule->atoms[i].y;
+        points[3 * (size_t)i + 2] = molecule->atoms[i].z;
+    }
+    return points;
+}
+
+typedef struct covalent
+{
+char element[3];
+double radius;
+} covalent;
+
+//Single-bond covalent radii in angstroms (Cordero et al., 2008)
+covalent covalent_radii[] = {
+    {"H", 0.31}, {"He", 0.28}, {"Li", 1.28}, {"Be", 0.96}, {"B", 0.84}, {"C", 0.76},
+    {"N", 0.71}, {"O", 0.66}, {"F", 0.57}, {"Ne", 0.58}, {"Na", 1.66}, {"Mg", 1.41},
+    {"Al", 1.21}, {"Si", 1.11}, {"P", 1.07}, {"S", 1.05}, {"Cl", 1.02}, {"Ar", 1.06},
+    {"K", 2.03}, {"Ca", 1.76}, {"Mn", 1.39}, {"Fe", 1.32}, {"Co", 1.26}, {"Ni", 1.24},
+    {"Cu", 1.32}, {"Zn", 1.22}, {"Ga", 1.22}, {"Ge", 1.20}, {"As", 1.19}, {"Se", 1.20},
+    {"Br", 1.20}, {"Kr", 1.16}, {"Ag", 1.45}, {"Sn", 1.39}, {"I", 1.39}, {"Pt", 1.36},
+    {"Au", 1.36}, {"Hg", 1.32},
+};
+
+double covalent_radius( const char element[3] ) {
+    for (size_t i = 0; i < sizeof(covalent_radii) / sizeof(covalent_radii[0]); i++) {
+        if (strncmp(covalent_radii[i].element, element, 3) == 0) {
+            return covalent_radii[i].radius;
+        }
+    }
+    //Unlisted elements are treated like a typical metal
+    return 1.5;
+}
+unsigned int molperceive_bonds( molecule *molecule, double tolerance ) {
+    unsigned int atom_no = molecule->atom_no, added = 0;
+    double *points, *radii, max_r = 0;
+    spatial_grid *grid;
+    bond b;
+
+    //Bond every pair closer than the sum of their covalent radii plus tolerance.
+    //With cells at least that wide, each atom only checks the 27 cells around it.
+    points = molpoints(molecule);
+    radii = malloc(sizeof(double) * (atom_no ? atom_no : 1));
+    if (points == NULL || radii == NULL) {
+        free(points);
+        free(radii);
+        return 0;
+    }
+    for (unsigned int i = 0; i < atom_no; i++) {
+        radii[i] = covalent_radius(molecule->atoms[i].element);
+        if (radii[i] > max_r) max_r = radii[i];
+    }
+    grid = gridbuild(points, atom_no, 2 * max_r + tolerance);
+    if (grid == NULL) {
+        free(points);
+        free(radii);
+        return 0;
+    }
+
+    for (unsigned int i = 0; i < atom_no; i++) {
+        unsigned int cx = gridaxis(points[3 * (size_t)i], grid->minx, grid->cell, grid->nx);
+        unsigned int cy = gridaxis(points[3 * (size_t)i + 1], grid->miny, grid->cell, grid->ny);
+        unsigned int cz = gridaxis(points[3 * (size_t)i + 2], grid->minz, grid->cell, grid->nz);
+
+        for (unsigned int z = cz ? cz - 1 : 0; z <= cz + 1 && z < grid->nz; z++) {
+            for (unsigned int y = cy ? cy - 1 : 0; y <= cy + 1 && y < grid->ny; y++) {
+                for (unsigned int x = cx ? cx - 1 : 0; x <= cx + 1 && x < grid->nx; x++) {
+                    size_t c = ((size_t)z * grid->ny + y) * grid->nx + x;
+                    for (unsigned int k = grid->start[c]; k < grid->start[c + 1]; k++) {
+                        unsigned int j = grid->index[k];
+                        double dx, dy, dz, d2, limit;
+                        if (j <= i) {
+                            continue;
+                        }
+                        dx = points[3 * (size_t)j] - points[3 * (size_t)i];
+                        dy = points[3 * (size_t)j + 1] - points[3 * (size_t)i + 1];
+                        dz = points[3 * (size_t)j + 2] - points[3 * (size_t)i + 2];
+                        d2 = dx * dx + dy * dy + dz * dz;
+                        limit = radii[i] + radii[j] + tolerance;
+                        //Coincident atoms (closer than 0.4 A) are duplicates, not bonds
+                        if (d2 > 0.16 && d2 <= limit * limit) {
+                            b.a1 = i;
+                            b.a2 = j;
+                            b.epairs = 1;
+                            b.atoms = molecule->atoms;
+                            compute_coords(&b);
+                            molappend_bond(molecule, &b);
+                            added++;
+                        }
+                    }
+                }
+            }
+        }
+    }
+
+    gridfree(grid);
+    free(points);
+    free(radii);
+    return added;
+}
+double pick_band( double px, double py, double x1, double y1, double x2, double y2, double half ) {
+    //Distance from a point to the drawn bond: a band half px either side of the segment, flat ends
+    double dx = x2 - x1, dy = y2 - y1, len = hypot(dx, dy), along, across;
+    if (!(len > 0)) {
+        return INFINITY;
+    }
+    along = ((px - x1) * dx + (py - y1) * dy) / len;
+    across = fabs((py - y1) * dx - (px - x1) * dy) / len;
+    along = along < 0 ? -along : (along > len ? along - len : 0);
+    across = across > half ? across - half : 0;
+    return hypot(along, across);
+}
+int molpick( molecule *molecule, palette *palette, svg_view *view, double x, double y, double tolerance, unsigned int *index ) {
+    double *points, max_r = 0, max_half = 0, mx, my, reach;
+    double best_distance = INFINITY, best_z = -INFINITY;
+    unsigned int best_item = 0, atom_no = molecule->atom_no;
+    int found = 0;
+    spatial_grid *grid;
+
+    //Fit exactly like molsvg so (x, y) is in the same canvas coordinates as the SVG
+    molfit(molecule, palette, view);
+    if (atom_no == 0 || view->scale <= 0) {
+        return PICK_NONE;
+    }
+
+    for (unsigned int i = 0; i < atom_no; i++) {
+        style *s = palfind(palette, molecule->atoms[i].element);
+        if (s && s->radius > max_r) max_r = s->radius;
+    }
+
+    //Anything that can be within tolerance of the point has its atom centre or bond midpoint within reach
+    grid = molecule->pick_grid;
+    if (grid == NULL) {
+        //Index atoms and bond midpoints together in the projected (x, y) plane; z is flattened
+        points = malloc(sizeof(double) * 3 * ((size_t)atom_no + molecule->bond_no));
+        if (points == NULL) {
+            return PICK_NONE;
+        }
+        for (unsigned int i = 0; i < atom_no; i++) {
+            points[3 * (size_t)i] = molecule->atoms[i].x;
+            points[3 * (size_t)i + 1] = molecule->atoms[i].y;
+            points[3 * (size_t)i + 2] = 0;
+        }
+        for (unsigned int i = 0; i < molecule->bond_no; i++) {
+            bond *b = &molecule->bonds[i];
+            double *p = points + 3 * ((size_t)atom_no + i);
+            p[0] = (b->x1 + b->x2) / 2;
+            p[1] = (b->y1 + b->y2) / 2;
+            p[2] = 0;
+            if (!isnan(b->len) && b->len / 2 > max_half) max_half = b->len / 2;
+        }
+        reach = (fmax(max_r, 10) + tolerance) / view->scale + max_half;
+        grid = gridbuild(points, atom_no + molecule->bond_no, reach);
+        free(points);
+        if (grid == NULL) {
+            return PICK_NONE;
+        }
+
+        //Kept until the geometry changes; the scan below covers reach whatever cell size the grid has
+        molecule->pick_grid = grid;
+        molecule->pick_half = max_half;
+    }
+    max_half = molecule->pick_half;
+    reach = (fmax(max_r, 10) + tolerance) / view->scale + max_half;
+    mx = (x - view->offsetx) / view->scale;
+    my = (y - view->offsety) / view->scale;
+
+    unsigned int cx0 = gridaxis(mx - reach, grid->minx, grid->cell, grid->nx);
+    unsigned int cx1 = gridaxis(mx + reach, grid->minx, grid->cell, grid->nx);
+    unsigned int cy0 = gridaxis(my - reach, grid->miny, grid->cell, grid->ny);
+    unsigned int cy1 = gridaxis(my + reach, grid->miny, grid->cell, grid->ny);
+    for (unsigned int cy = cy0; cy <= cy1; cy++) {
+        for (unsigned int cx = cx0; cx <= cx1; cx++) {
+            size_t c = (size_t)cy * grid->nx + cx;
+            for (unsigned int k = grid->start[c]; k < grid->start[c + 1]; k++) {
+                unsigned int item = grid->index[k];
+                double distance, z;
+
+                //Screen distance to the drawn shape: 0 inside it
+                if (item < atom_no) {
+                    atom *a = &molecule->atoms[item];
+                    style *s = palfind(palette, a->element);
+                    distance = hypot(a->x * view->scale + view->offsetx - x, a->y * view->scale + view->offsety - y);
+                    distance = fmax(distance - (s ? s->radius : 0), 0);
+                    z = a->z;
+                }
+                else {
+                    bond *b = &molecule->bonds[item - atom_no];
+                    distance = pick_band(x, y,
+                        b->x1 * view->scale + view->offsetx, b->y1 * view->scale + view->offsety,
+                        b->x2 * view->scale + view->offsetx, b->y2 * view->scale + view->offsety, 10);
+                    z = b->z;
+                }
+                if (distance > tolerance) {
+                    continue;
+                }
+
+                //Closest shape wins; among shapes under the point, the one drawn last (on top)
+                if (distance < best_distance ||
+                    (distance == best_distance && (z > best_z || (z == best_z && item > best_item)))) {
+                    best_distance = distance;
+                    best_z = z;
+                    best_item = item;
+                    found = 1;
+                }
+            }
+        }
+    }
+
+    if (!found) {
+        return PICK_NONE;
+    }
+    if (best_item < atom_no) {
+        *index = best_item;
+        return PICK_ATOM;
+    }
+    *index = best_item - atom_no;
+    return PICK_BOND;
+}
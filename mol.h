@@ -19,50 +19,183 @@ double x, y, z;
 
 typedef struct bond
 {
-unsigned short a1, a2;
+unsigned int a1, a2;
 unsigned char epairs;
 atom *atoms;
 double x1, x2, y1, y2, z, len, dx, dy;
 } bond;
 
+struct spatial_grid;
+
 typedef struct molecule
 {
-unsigned short atom_max, atom_no;
+unsigned int atom_max, atom_no;
 atom *atoms, **atom_ptrs;       
-unsigned short bond_max, bond_no;
+unsigned int bond_max, bond_no;
 bond *bonds, **bond_ptrs;
+//Spatial index reused by molpick until the atoms or bonds change (see molinvalidate)
+struct spatial_grid *pick_grid;
+double pick_half;
 } molecule;
 
 typedef double xform_matrix[3][3];
 
+typedef struct style
+{
+char element[3];
+double radius;
+char *radius_text, *name;
+} style;
+
+typedef struct palette
+{
+unsigned int style_max, style_no;
+style *styles;
+} palette;
+
+typedef struct svg_view
+{
+double width, height, scale, offsetx, offsety;
+} svg_view;
+
+#define LOD_CELL 4.0
+
+typedef struct depth_item
+{
+double z;
+unsigned int item;
+} depth_item;
+
+//Depth order kept between frames of one molecule; moves counts items the last update shifted
+#define DEPTH_RUN 32
+
+typedef struct depth_order
+{
+depth_item *items, *scratch;
+unsigned int count, frames;
+unsigned long moves;
+} depth_order;
+
+typedef struct spatial_grid
+{
+double cell, minx, miny, minz;
+unsigned int nx, ny, nz;
+unsigned int *start, *index;
+} spatial_grid;
+
+//At most this many cells along an axis, and this many doublings while coarsening a grid
+#define GRID_MAX_AXIS 1048576
+#define GRID_COARSEN 64
+
+#define PICK_NONE 0
+#define PICK_ATOM 1
+#define PICK_BOND 2
+
+typedef struct svg_stream
+{
+molecule *molecule;
+palette *palette;
+svg_view view;
+depth_item *items;
+unsigned int count, next;
+} svg_stream;
+
 void atomset( atom *atom, char element[3], double *x, double *y, double *z );
 
 void atomget( atom *atom, char element[3], double *x, double *y, double *z );
 
-void bondset( bond *bond, unsigned short *a1, unsigned short *a2, atom**atoms, unsigned char *epairs );
+void bondset( bond *bond, unsigned int *a1, unsigned int *a2, atom**atoms, unsigned char *epairs );
 
-void bondget( bond *bond, unsigned short *a1, unsigned short *a2, atom**atoms, unsigned char *epairs );
+void bondget( bond *bond, unsigned int *a1, unsigned int *a2, atom**atoms, unsigned char *epairs );
 
-molecule *molmalloc( unsigned short atom_max, unsigned short bond_max );
+molecule *molmalloc( unsigned int atom_max, unsigned int bond_max );
 
 molecule *molcopy( molecule *src );
 
+void molcopy_into( molecule *dst, molecule *src );
+
 void molfree( molecule *ptr );
 
+void molreserve( molecule *molecule, unsigned int atom_max, unsigned int bond_max );
+
 void molappend_atom( molecule *molecule, atom *atom );
 
 void molappend_bond( molecule *molecule, bond *bond );
 
 void molsort( molecule *molecule );
 
-void xrotation( xform_matrix xform_matrix, unsigned short deg );
+void xrotation( xform_matrix xform_matrix, double deg );
 
-void yrotation( xform_matrix xform_matrix, unsigned short deg );
+void yrotation( xform_matrix xform_matrix, double deg );
 
-void zrotation( xform_matrix xform_matrix, unsigned short deg );
+void zrotation( xform_matrix xform_matrix, double deg );
 
 void mol_xform( molecule *molecule, xform_matrix matrix );
 
+void xform_multiply( xform_matrix result, xform_matrix a, xform_matrix b );
+
+void molrotate( molecule *molecule, double phi_x, double phi_y, double phi_z );
+
+void molcompute_bonds( molecule *molecule );
+
+void molinvalidate( molecule *molecule );
+
+#define PACKED_ELEMENT_SIZE 3
+#define PACKED_COORD_SIZE (3 * sizeof(double))
+#define PACKED_BOND_SIZE (3 * sizeof(unsigned int))
+
+void molpack( molecule *molecule, char *elements, char *coords, char *bonds );
+
+int molunpack( molecule *molecule, const char *elements, const char *coords, unsigned int atom_no, const char *bonds, unsigned int bond_no );
+
+unsigned int molparse_v2000( molecule *molecule, const char *buffer, size_t length, char *error, size_t error_len );
+
 void compute_coords( bond *bond );
 
+palette *palmalloc( void );
+
+void palfree( palette *ptr );
+
+void palappend( palette *palette, char element[3], double radius, char *radius_text, char *name );
+
+style *palfind( palette *palette, char element[3] );
+
+void molfit( molecule *molecule, palette *palette, svg_view *view );
+
+char *molsvg( molecule *molecule, palette *palette, svg_view *view );
+
+depth_order *depth_order_malloc( void );
+
+void depth_order_free( depth_order *order );
+
+unsigned long depth_sort( depth_item *items, depth_item *scratch, unsigned int count );
+
+depth_item *depth_order_update( depth_order *order, molecule *molecule );
+
+char *molsvg_ordered( molecule *molecule, palette *palette, svg_view *view, depth_order *order );
+
+char *molsvg_lod( molecule *molecule, palette *palette, svg_view *view, unsigned int budget, double merge_far );
+
+char *molsvg_lod_ordered( molecule *molecule, palette *palette, svg_view *view, unsigned int budget, double merge_far, depth_order *order );
+
+svg_stream *molsvg_open( molecule *molecule, palette *palette, svg_view *view );
+
+char *molsvg_next( svg_stream *stream, unsigned int max_items );
+
+void molsvg_close( svg_stream *stream );
+
+char *molelements( molecule *molecule );
+
+double gridextent( double span, double cell );
+
+spatial_grid *gridbuild( const double *points, unsigned int count, double cell );
+
+void gridfree( spatial_grid *grid );
+
+double covalent_radius( const char element[3] );
+
+unsigned int molperceive_bonds( molecule *molecule, double tolerance );
+
+int molpick( molecule *molecule, palette *palette, svg_view *view, double x, double y, double tolerance, unsigned int *index );
+
 #endif
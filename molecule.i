@@ -4,8 +4,47 @@
   #include "mol.h"
 %}
 
+%newobject molsvg;
+%newobject molelements;
+%newobject molecule::svg_body;
+%newobject molecule::svg_body_lod;
+%newobject molsvg_lod;
+%newobject molsvg_ordered;
+%newobject molsvg_lod_ordered;
+%newobject molecule::element_codes;
+%newobject molsvg_next;
+%newobject svg_stream::next_chunk;
+
+/* Accept any bytes-like object (bytes, bytearray, memoryview, SQLite blobs) without copying. */
+%typemap(in) (char *BUFFER, size_t LENGTH) (Py_buffer view) {
+  if ( PyObject_GetBuffer( $input, &view, PyBUF_SIMPLE ) != 0 ) SWIG_fail;
+  $1 = (char *)view.buf;
+  $2 = (size_t)view.len;
+}
+%typemap(freearg) (char *BUFFER, size_t LENGTH) {
+  if ( view$argnum.obj ) PyBuffer_Release( &view$argnum );
+}
+%typemap(arginit) (char *BUFFER, size_t LENGTH) {
+  view$argnum.obj = NULL;
+}
+
+%apply (char *BUFFER, size_t LENGTH) { (char *elements, size_t elements_len) };
+%apply (char *BUFFER, size_t LENGTH) { (char *coords, size_t coords_len) };
+%apply (char *BUFFER, size_t LENGTH) { (char *bonds, size_t bonds_len) };
+%apply (char *BUFFER, size_t LENGTH) { (char *buffer, size_t buffer_len) };
+
+//Cache owned by the C code (see molinvalidate)
+%ignore molecule::pick_grid;
+%ignore molecule::pick_half;
+
 %include "mol.h"
 
+%inline %{
+  /* Struct sizes so Python can check its NumPy dtypes mirror the C layout. */
+  size_t sizeof_atom( void ) { return sizeof(atom); }
+  size_t sizeof_bond( void ) { return sizeof(bond); }
+%}
+
 %extend atom {
   atom( char element[3], double x, double y, double z )
   {
@@ -44,7 +83,9 @@
   void append_atom( char element[3], double x, double y, double z )
   {
     atom a1;
-    strcpy( a1.element, element );
+    /* Zero the code first so array views never see stale bytes after the terminator. */
+    memset( a1.element, 0, sizeof(a1.element) );
+    strncpy( a1.element, element, sizeof(a1.element) - 1 );
     a1.x = x;
     a1.y = y;
     a1.z = z;
@@ -52,7 +93,7 @@
     molappend_atom( $self, &a1 );
   }
 
-  void append_bond( unsigned short a1, unsigned short a2, unsigned char epairs )
+  void append_bond( unsigned int a1, unsigned int a2, unsigned char epairs )
   {
     bond b1;
     b1.a1 = a1;
@@ -65,12 +106,12 @@
     molappend_bond( $self, &b1 );
   }
 
-  atom *get_atom( unsigned short i )
+  atom *get_atom( unsigned int i )
   {
     return $self->atom_ptrs[i];
   }
 
-  bond *get_bond( unsigned short i )
+  bond *get_bond( unsigned int i )
   {
     return $self->bond_ptrs[i];
   }
@@ -79,6 +120,169 @@
   {
     molsort( $self );
   }
+
+  void reserve( unsigned int atom_max, unsigned int bond_max )
+  {
+    molreserve( $self, atom_max, bond_max );
+  }
+
+  /* Packed (elements, coords, bonds) bytes for compact storage. */
+  PyObject *pack()
+  {
+    PyObject *elements = PyBytes_FromStringAndSize( NULL, (Py_ssize_t)($self->atom_no * PACKED_ELEMENT_SIZE) );
+    PyObject *coords = PyBytes_FromStringAndSize( NULL, (Py_ssize_t)($self->atom_no * PACKED_COORD_SIZE) );
+    PyObject *bonds = PyBytes_FromStringAndSize( NULL, (Py_ssize_t)($self->bond_no * PACKED_BOND_SIZE) );
+    if ( !elements || !coords || !bonds )
+    {
+      Py_XDECREF( elements );
+      Py_XDECREF( coords );
+      Py_XDECREF( bonds );
+      return NULL;
+    }
+    molpack( $self, PyBytes_AS_STRING(elements), PyBytes_AS_STRING(coords), PyBytes_AS_STRING(bonds) );
+    return Py_BuildValue( "(NNN)", elements, coords, bonds );
+  }
+
+  /* Append atoms and bonds from packed bytes; returns -1 if the buffers are inconsistent. */
+  int unpack( char *elements, size_t elements_len, char *coords, size_t coords_len, char *bonds, size_t bonds_len )
+  {
+    size_t atom_no = elements_len / PACKED_ELEMENT_SIZE;
+    if ( elements_len % PACKED_ELEMENT_SIZE || coords_len != atom_no * PACKED_COORD_SIZE || bonds_len % PACKED_BOND_SIZE )
+    {
+      return -1;
+    }
+    return molunpack( $self, elements, coords, (unsigned int)atom_no, bonds, (unsigned int)(bonds_len / PACKED_BOND_SIZE) );
+  }
+
+  /* Parse the first V2000 record in buffer; None on success, else (line number, reason). */
+  PyObject *parse_v2000( char *buffer, size_t buffer_len )
+  {
+    char error[128];
+    unsigned int line = molparse_v2000( $self, buffer, buffer_len, error, sizeof(error) );
+    if ( line == 0 )
+    {
+      Py_RETURN_NONE;
+    }
+    return Py_BuildValue( "(Is)", line, error );
+  }
+
+  void copy_from( molecule *src )
+  {
+    molcopy_into( $self, src );
+  }
+
+  /* With a depth_order from the previous frame, the depth sort only repairs that order. */
+  char *svg_body( palette *palette, svg_view *view, depth_order *order = NULL )
+  {
+    return molsvg_ordered( $self, palette, view, order );
+  }
+
+  char *svg_body_lod( palette *palette, svg_view *view, unsigned int budget, double merge_far, depth_order *order = NULL )
+  {
+    return molsvg_lod_ordered( $self, palette, view, budget, merge_far, order );
+  }
+
+  /* Add bonds from covalent radii (for inputs without a bond block); returns how many were added. */
+  unsigned int perceive_bonds( double tolerance )
+  {
+    return molperceive_bonds( $self, tolerance );
+  }
+
+  /* Topmost atom or bond at canvas point (x, y) within tolerance pixels: None, ('atom', i) or ('bond', i). */
+  PyObject *pick( palette *palette, svg_view *view, double x, double y, double tolerance )
+  {
+    unsigned int index = 0;
+    int kind = molpick( $self, palette, view, x, y, tolerance, &index );
+    if ( kind == PICK_ATOM )
+    {
+      return Py_BuildValue( "(sI)", "atom", index );
+    }
+    if ( kind == PICK_BOND )
+    {
+      return Py_BuildValue( "(sI)", "bond", index );
+    }
+    Py_RETURN_NONE;
+  }
+
+  char *element_codes()
+  {
+    return molelements( $self );
+  }
+
+  /* Raw addresses of the atom and bond arrays for zero-copy views; invalid once the molecule grows. */
+  size_t atoms_address()
+  {
+    return (size_t)$self->atoms;
+  }
+
+  size_t bonds_address()
+  {
+    return (size_t)$self->bonds;
+  }
 };
 
+%extend palette {
+  palette()
+  {
+    return palmalloc();
+  }
+
+  ~palette()
+  {
+    palfree($self);
+  }
 
+  void add( char element[3], double radius, char *radius_text, char *name )
+  {
+    palappend( $self, element, radius, radius_text, name );
+  }
+};
+
+%extend svg_view {
+  svg_view( double width, double height )
+  {
+    svg_view *view;
+    view = (svg_view *)malloc( sizeof(svg_view) );
+    view->width = width;
+    view->height = height;
+    view->scale = 100.0;
+    view->offsetx = width / 2.0;
+    view->offsety = height / 2.0;
+    return view;
+  }
+
+  ~svg_view()
+  {
+    free($self);
+  }
+};
+
+%extend depth_order {
+  depth_order()
+  {
+    return depth_order_malloc();
+  }
+
+  ~depth_order()
+  {
+    depth_order_free($self);
+  }
+};
+
+%extend svg_stream {
+  svg_stream( molecule *molecule, palette *palette, svg_view *view )
+  {
+    return molsvg_open( molecule, palette, view );
+  }
+
+  ~svg_stream()
+  {
+    molsvg_close($self);
+  }
+
+  /* The next max_items elements in depth order as SVG markup, or None when done. */
+  char *next_chunk( unsigned int max_items )
+  {
+    return molsvg_next( $self, max_items );
+  }
+};
@@ -0,0 +1,370 @@
+import argparse
+import io
+import itertools
+import mmap
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import molsql
+from MolDisplay import Molecule
+
+
+def read_records(fp):
+    # Stream (index, title, text) for each record of a multi-record SDF, split on '$$$$'.
+    lines = []
+    index = 0
+    for line in fp:
+        if line.startswith('$$$$'):
+            if any(l.strip() for l in lines):
+                yield index, lines[0].strip(), ''.join(lines)
+                index += 1
+            lines = []
+        else:
+            lines.append(line)
+
+    # A trailing record without a closing '$$$$'
+    if any(l.strip() for l in lines):
+        yield index, lines[0].strip(), ''.join(lines)
+
+
+def record_spans(fp):
+    # (start, end) byte offsets of each record of a binary SDF stream read from its start. Only one
+    # line is held at a time, so huge records can be located without copying them.
+    start = position = 0
+    blank = True
+    for line in fp:
+        if line.startswith(b'$$$$'):
+            if not blank:
+                yield start, position
+            position += len(line)
+            start = position
+            blank = True
+        else:
+            position += len(line)
+            blank = blank and not line.strip()
+
+    # A trailing record without a closing '$$$$'
+    if not blank:
+        yield start, position
+
+
+def parse_record(record):
+    # Runs in a worker process: parse one record into its packed geometry, or report why it failed.
+    index, name, text = record
+    return _parse(index, name, io.StringIO(text))
+
+
+def parse_file_record(fp, start, end, index, name):
+    # parse_record for a record still in a real file: the C parser reads it from a memory map.
+    with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        view = memoryview(data)[start:end]
+        try:
+            return _parse(index, name, view)
+        finally:
+            view.release()
+
+
+def _parse(index, name, source):
+    try:
+        mol = Molecule()
+        mol.parse(source)
+        if mol.atom_no == 0:
+            raise ValueError("record did not contain any atoms")
+        return index, name, molsql.PackedMolecule.from_molecule(name, mol), None
+    except Exception as e:
+        return index, name, None, str(e) or type(e).__name__
+
+
+class ImportStats:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.records = 0
+        self.imported = 0
+        self.unchanged = 0
+        self.errors = []
+
+    @property
+    def seconds(self):
+        return time.monotonic() - self.started
+
+    @property
+    def records_per_second(self):
+        return self.records / self.seconds if self.seconds > 0 else 0.0
+
+    def as_dict(self):
+        return {
+            "records": self.records,
+            "imported": self.imported,
+            "unchanged": self.unchanged,
+            "failed": len(self.errors),
+            "seconds": round(self.seconds, 3),
+            "records_per_second": round(self.records_per_second, 1),
+            "errors": [{"index": i, "name": n, "error": e} for i, n, e in self.errors],
+        }
+
+
+def _named(records, prefix):
+    # Untitled records get '<prefix>-<n>' so every molecule has a unique, stable name.
+    for index, title, text in records:
+        yield index, title or f"{prefix}-{index + 1}", text
+
+
+def _insert_batch(db, parsed, stats):
+    # Later duplicates of a name in the same batch win, matching replace-on-upload.
+    batch = {}
+    for index, name, packed, error in parsed:
+        stats.records += 1
+        if error is not None:
+            stats.errors.append((index, name, error))
+        else:
+            batch[packed.name] = (index, packed)
+    if not batch:
+        return
+
+    try:
+        written = db.add_packed_molecules([packed for _, packed in batch.values()])
+        stats.imported += len(batch)
+        stats.unchanged += len(batch) - written
+    except Exception:
+        # Isolate the offending records instead of dropping the whole batch.
+        for index, packed in batch.values():
+            try:
+                written = db.add_packed_molecules([packed])
+                stats.imported += 1
+                stats.unchanged += 1 - written
+            except Exception as e:
+                stats.errors.append((index, packed.name, str(e)))
+
+
+def bulk_import(db, fp, batch_size=500, workers=None, prefix='molecule', progress=None):
+    return import_records(db, _named(read_records(fp), prefix), batch_size, workers, progress)
+
+
+def import_records(db, records, batch_size=500, workers=None, progress=None, pool=None):
+    # Parse records in a process pool and insert them in batched transactions. The next batch
+    # is parsing while the current one is written, and only two batches are held in memory.
+    # A long-lived caller passes its own pool; otherwise one is started for this import.
+    stats = ImportStats()
+
+    def batches():
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                return
+            yield batch
+
+    if workers == 0 and pool is None:
+        for batch in batches():
+            _insert_batch(db, [parse_record(r) for r in batch], stats)
+            if progress:
+                progress(stats)
+        return stats
+
+    if pool is None:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return import_records(db, records, batch_size, workers, progress, pool)
+
+    chunksize = max(1, batch_size // (4 * (workers or os.cpu_count() or 1)))
+    pending = None
+    for batch in batches():
+        submitted = pool.map(parse_record, batch, chunksize=chunksize)
+        if pending is not None:
+            _insert_batch(db, pending, stats)
+            if progress:
+                progress(stats)
+        pending = submitted
+    if pending is not None:
+        _insert_batch(db, pending, stats)
+        if progress:
+            progress(stats)
+    return stats
+
+
+def ingest_upload(db, fp, name, library=False, batch_size=500, workers=None, progress=None, pool=None):
+    # fp: a binary file at its start. As a plain upload always was, the first record is stored under
+    # the uploaded name, parsed straight from the file. With library=True a multi-record file is
+    # imported like the CLI does instead: titled records keep their titles.
+    head = list(itertools.islice(record_spans(fp), 2 if library else 1))
+    if len(head) < 2:
+        stats = ImportStats()
+        if head:
+            parsed = parse_file_record(fp, *head[0], 0, name)
+        else:
+            parsed = (0, name, None, "SDF did not contain any records")
+        _insert_batch(db, [parsed], stats)
+        if progress:
+            progress(stats)
+        return stats
+
+    fp.seek(0)
+    text = io.TextIOWrapper(fp, encoding='utf-8', errors='replace', newline='')
+    return import_records(db, _named(read_records(text), name), batch_size, workers, progress, pool)
+
+
+def _exit_with(pid):
+    # Pool initializer. Pool processes wait for work forever, so one whose owner was killed (e.g. a
+    # server stopped with SIGTERM) would never end; this one exits once process pid is gone.
+    def watch():
+        while True:
+            time.sleep(1)
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                os._exit(0)
+            except PermissionError:
+                pass
+
+    threading.Thread(target=watch, daemon=True).start()
+
+
+class IngestJob:
+    def __init__(self, name, spool, size, library=False):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.library = library
+        self.spool = spool
+        self.size = size
+        self.state = 'queued'
+        self.position = 0
+        self.stats = None
+        self.error = None
+
+    def as_dict(self):
+        progress = 1.0 if self.state == 'done' else (self.position / self.size if self.size else 0.0)
+        job = {
+            "id": self.id,
+            "name": self.name,
+            "library": self.library,
+            "state": self.state,
+            "bytes": self.size,
+            "progress": round(min(progress, 1.0), 3),
+        }
+        if self.stats is not None:
+            job.update(self.stats.as_dict())
+            # A failing library should not turn every poll into a huge response.
+            job["errors"] = job["errors"][:20]
+        if self.error is not None:
+            job["error"] = self.error
+        return job
+
+
+class IngestQueue:
+    # Background ingest for uploaded SDF files. Uploads are spooled to disk by the caller and parsed
+    # and stored here, so the request that delivered the file returns right away with a job id.
+
+    def __init__(self, connect, threads=1, workers=None, keep=1000):
+        self.connect = connect
+        self.workers = workers
+        self.keep = keep
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pending = queue.Queue()
+        for _ in range(threads):
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, name, spool, size, library=False):
+        # Takes ownership of spool, a binary file positioned anywhere; it is closed when the job ends.
+        job = IngestJob(name, spool, size, library)
+        with self.lock:
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.keep:
+                oldest = next(iter(self.jobs.values()))
+                if oldest.state in ('queued', 'running'):
+                    break
+                self.jobs.popitem(last=False)
+        self.pending.put(job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def pool(self):
+        # One parser pool shared by every job, started with the first one. Its processes
+        # come from a fork server: forking the threaded server directly could copy a lock some
+        # other thread holds and leave the child waiting on it forever.
+        if self.workers == 0:
+            return None
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('forkserver'),
+                    initializer=_exit_with, initargs=(os.getpid(),)
+                )
+            return self.executor
+
+    def _discard_pool(self, executor):
+        # After a worker dies the pool refuses new work; the next job starts a fresh one.
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False)
+
+    def _run(self):
+        db = self.connect()
+        while True:
+            job = self.pending.get()
+            job.state = 'running'
+            try:
+                job.spool.seek(0)
+
+                def progress(stats):
+                    job.stats = stats
+                    job.position = job.spool.tell()
+
+                executor = self.pool()
+                try:
+                    job.stats = ingest_upload(db, job.spool, job.name, job.library, workers=self.workers, progress=progress, pool=executor)
+                except BrokenProcessPool:
+                    self._discard_pool(executor)
+                    raise
+                job.state = 'done' if job.stats.imported or not job.stats.errors else 'failed'
+            except Exception as e:
+                job.error = str(e) or type(e).__name__
+                job.state = 'failed'
+            finally:
+                job.spool.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import a (multi-record) SDF file into molecules.db")
+    parser.add_argument('sdf', help="SDF file; records are separated by $$$$ lines")
+    parser.add_argument('--batch-size', type=int, default=500, help="records per insert transaction")
+    parser.add_argument('--workers', type=int, default=None, help="parser processes (0 parses in-process)")
+    parser.add_argument('--prefix', default=None, help="name prefix for records without a title line")
+    args = parser.parse_args(argv)
+
+    db = molsql.Database()
+    db.create_tables()
+
+    def report(stats):
+        print(
+            f"\r{stats.records} records, {stats.imported} imported, {len(stats.errors)} failed "
+            f"({stats.records_per_second:.0f} records/s)",
+            end='', file=sys.stderr, flush=True
+        )
+
+    prefix = args.prefix or os.path.splitext(os.path.basename(args.sdf))[0]
+    with open(args.sdf, 'r', encoding='utf-8', errors='replace') as fp:
+        stats = bulk_import(db, fp, args.batch_size, args.workers, prefix, report)
+    print(file=sys.stderr)
+
+    for index, name, error in stats.errors:
+        print(f"record {index + 1}{f' ({name})' if name else ''}: {error}", file=sys.stderr)
+    print(
+        f"Imported {stats.imported} of {stats.records} records ({stats.unchanged} unchanged) in {stats.seconds:.1f}s "
+        f"({stats.records_per_second:.0f} records/s)"
+    )
+    return 0 if not stats.errors else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
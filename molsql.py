@@ -1,19 +1,353 @@
 import sqlite3;
 import os;
+import json
+import heapq
+import hashlib
+import zlib
+import threading
+import time
+from array import array
+from collections import OrderedDict
 import molecule
+import metrics
 import MolDisplay
-from MolDisplay import Atom,Bond,Molecule
+from MolDisplay import Molecule
+
+
+class MoleculeCache:
+    # Bounded LRU of parsed molecules keyed by (name, generation). The generation is the counter
+    # stored in the database (see Database.generation), which every write bumps in its own
+    # transaction, so writes from other processes retire entries too.
+
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.generation = None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, name, generation):
+        with self.lock:
+            if generation != self.generation:
+                # Entries of any other generation are never looked up again.
+                self.generation = generation
+                self.entries.clear()
+                return None
+            key = (name, generation)
+            mol = self.entries.get(key)
+            if mol is not None:
+                self.entries.move_to_end(key)
+            return mol
+
+    def put(self, name, generation, mol):
+        with self.lock:
+            # A load that started before a newer generation was seen must not repopulate the cache.
+            if generation != self.generation:
+                return
+            self.entries[(name, generation)] = mol
+            self.entries.move_to_end((name, generation))
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def invalidate(self):
+        with self.lock:
+            self.generation = None
+            self.entries.clear()
+
+
+mol_cache = MoleculeCache()
+
+
+class ElementStyles:
+    # Immutable snapshot of the Elements table in the shapes MolDisplay needs.
+
+    def __init__(self, version, rows):
+        self.version = version
+        self.radius = {}
+        self.element_name = {}
+        self.gradients = OrderedDict()
+        # Same styles in C form for the native renderer; radius_text keeps Python's formatting.
+        self.palette = molecule.palette()
+
+        for code, name, colour1, colour2, colour3, radius in rows:
+            self.radius[code] = radius
+            self.element_name[code] = name
+            self.palette.add(code, float(radius), f"{radius}", f"{name}")
+            self.gradients[code] = """
+            <radialGradient id="%s" cx="-50%%" cy="-50%%" r="220%%" fx="20%%" fy="20%%">
+            <stop offset="0%%" stop-color="#%s"/>
+            <stop offset="50%%" stop-color="#%s"/>
+            <stop offset="100%%" stop-color="#%s"/>
+            </radialGradient>""" % (name, colour1, colour2, colour3)
+
+    def render_context(self, width=1000, height=1000, lod=None):
+        return MolDisplay.RenderContext(self.radius, self.element_name, self.gradients, width, height, self.palette, lod)
+
+    def defs(self, elements=None):
+        # Only emit gradients for the given element codes, in table order.
+        if elements is None:
+            return "".join(self.gradients.values())
+        return "".join(g for code, g in self.gradients.items() if code in elements)
+
+
+class ElementStyleCache:
+    # Holder for the last ElementStyles read; reloaded when Database.style_version moves past it.
+
+    def __init__(self):
+        self.styles = None
+
+    def invalidate(self):
+        self.styles = None
+
+
+style_cache = ElementStyleCache()
+
+# SQLite allows a single writer; serialize writes in-process instead of spinning on SQLITE_BUSY.
+write_lock = threading.RLock()
+
+DB_PATH = 'molecules.db'
+
+
+ATOMIC_MASS = {
+    "H": 1.008, "He": 4.0026, "Li": 6.94, "Be": 9.0122, "B": 10.81, "C": 12.011,
+    "N": 14.007, "O": 15.999, "F": 18.998, "Ne": 20.180, "Na": 22.990, "Mg": 24.305,
+    "Al": 26.982, "Si": 28.085, "P": 30.974, "S": 32.06, "Cl": 35.45, "Ar": 39.948,
+    "K": 39.098, "Ca": 40.078, "Br": 79.904, "I": 126.90
+}
+
+def make_formula(atom_counts):
+    if not atom_counts:
+        return ""
+
+    parts = []
+    if "C" in atom_counts:
+        count = atom_counts["C"]
+        parts.append("C" if count == 1 else f"C{count}")
+    if "H" in atom_counts:
+        count = atom_counts["H"]
+        parts.append("H" if count == 1 else f"H{count}")
+
+    for element in sorted(k for k in atom_counts if k not in ("C", "H")):
+        count = atom_counts[element]
+        parts.append(element if count == 1 else f"{element}{count}")
+
+    return "".join(parts)
+
+
+class Descriptors:
+    # Per-molecule summary stored in MoleculeDescriptors at ingest, so /analyze and the
+    # library listing never have to load geometry.
+
+    def __init__(self, atom_count, bond_count, element_counts, bond_orders):
+        self.atom_count = atom_count
+        self.bond_count = bond_count
+        self.element_counts = element_counts
+        self.bond_orders = bond_orders
+        self.formula = make_formula(element_counts)
+        self.molar_mass = 0.0
+        self.unknown = []
+        for element, count in element_counts.items():
+            if element in ATOMIC_MASS:
+                self.molar_mass += ATOMIC_MASS[element] * count
+            else:
+                self.unknown.append(element)
+        self.unknown.sort()
+
+    @classmethod
+    def from_geometry(cls, atom_no, bond_no, elements, bonds):
+        # Straight from the packed blobs: 3-byte element codes and (a1, a2, epairs) uint32 triples.
+        element_counts = {}
+        for i in range(0, len(elements), 3):
+            code = bytes(elements[i:i + 3]).rstrip(b'\0').decode('ascii', errors='replace')
+            element_counts[code] = element_counts.get(code, 0) + 1
+
+        bond_orders = {}
+        for epairs in array('I', bytes(bonds))[2::3]:
+            key = str(epairs)
+            bond_orders[key] = bond_orders.get(key, 0) + 1
+        return cls(atom_no, bond_no, element_counts, bond_orders)
+
+    @classmethod
+    def from_row(cls, atom_count, bond_count, element_counts, bond_orders):
+        return cls(atom_count, bond_count, json.loads(element_counts), json.loads(bond_orders))
+
+    def row(self):
+        return (
+            self.formula, self.atom_count, self.bond_count, self.molar_mass,
+            json.dumps(self.element_counts), json.dumps(self.bond_orders),
+        )
+
+    def as_dict(self, name):
+        return {
+            "name": name,
+            "formula": self.formula,
+            "atom_count": self.atom_count,
+            "bond_count": self.bond_count,
+            "element_counts": self.element_counts,
+            "bond_order_distribution": self.bond_orders,
+            "molar_mass": round(self.molar_mass, 3),
+            "unknown_mass_elements": self.unknown,
+        }
+
+
+FINGERPRINT_BITS = 1024
+
+def _count_features(features, name, count):
+    # A feature present n times sets a bit for every power of two up to n, so similar counts share bits.
+    threshold = 1
+    while threshold <= count:
+        features.add(f"{name}>={threshold}")
+        threshold *= 2
+
+
+class Fingerprint:
+    # Hashed bitset of element counts, bonded pairs and two-bond paths, stored in MoleculeFingerprints
+    # and compared by Tanimoto score.
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.bit_count = bits.bit_count()
+
+    @classmethod
+    def from_geometry(cls, atom_no, elements, bonds):
+        codes = [
+            bytes(elements[i:i + 3]).rstrip(b'\0').decode('ascii', errors='replace')
+            for i in range(0, len(elements), 3)
+        ]
+        triples = array('I', bytes(bonds))
+        neighbours = [[] for _ in range(atom_no)]
+
+        counts = {}
+        for code in codes:
+            counts[code] = counts.get(code, 0) + 1
+        for i in range(0, len(triples), 3):
+            a1, a2, epairs = triples[i], triples[i + 1], triples[i + 2]
+            if a1 >= atom_no or a2 >= atom_no:
+                continue
+            neighbours[a1].append((a2, epairs))
+            neighbours[a2].append((a1, epairs))
+            pair = "-".join(sorted((codes[a1], codes[a2])))
+            key = f"{pair}:{epairs}"
+            counts[key] = counts.get(key, 0) + 1
+
+        # Paths a-b-c through every atom b, written in the direction that sorts first.
+        for centre, bonded in enumerate(neighbours):
+            for i in range(len(bonded)):
+                for j in range(i + 1, len(bonded)):
+                    (left, order1), (right, order2) = bonded[i], bonded[j]
+                    forward = f"{codes[left]}{order1}{codes[centre]}{order2}{codes[right]}"
+                    backward = f"{codes[right]}{order2}{codes[centre]}{order1}{codes[left]}"
+                    key = min(forward, backward)
+                    counts[key] = counts.get(key, 0) + 1
+
+        features = set()
+        for name, count in counts.items():
+            _count_features(features, name, count)
+
+        bits = 0
+        for feature in features:
+            bits |= 1 << (zlib.crc32(feature.encode('utf-8')) % FINGERPRINT_BITS)
+        return cls(bits)
+
+    @classmethod
+    def from_blob(cls, blob):
+        return cls(int.from_bytes(blob, 'little'))
+
+    def blob(self):
+        return self.bits.to_bytes(FINGERPRINT_BITS // 8, 'little')
+
+    def row(self):
+        return (self.bit_count, self.blob())
+
+    def tanimoto(self, bits, bit_count):
+        common = (self.bits & bits).bit_count()
+        union = self.bit_count + bit_count - common
+        return common / union if union else 0.0
+
+
+def content_hash(elements, coords, bonds):
+    # Hash of the canonical geometry: coordinates rounded to SDF precision and bonds as sorted
+    # (low, high, epairs) triples, so an identical re-upload hashes the same whatever its bond order.
+    canonical_coords = array('d', [round(value, 4) + 0.0 for value in array('d', bytes(coords))])
+    triples = array('I', bytes(bonds))
+    canonical_bonds = array('I')
+    for a1, a2, epairs in sorted(
+        (min(triples[i], triples[i + 1]), max(triples[i], triples[i + 1]), triples[i + 2])
+        for i in range(0, len(triples), 3)
+    ):
+        canonical_bonds.extend((a1, a2, epairs))
+
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (bytes(elements), canonical_coords.tobytes(), canonical_bonds.tobytes()):
+        digest.update(len(part).to_bytes(8, 'little'))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class PackedMolecule:
+    # A parsed molecule reduced to its MoleculeGeometry blobs and descriptors; cheap to pickle between processes.
+
+    def __init__(self, name, atom_no, bond_no, elements, coords, bonds):
+        self.name = name
+        self.atom_no = atom_no
+        self.bond_no = bond_no
+        self.elements = elements
+        self.coords = coords
+        self.bonds = bonds
+        self.descriptors = Descriptors.from_geometry(atom_no, bond_no, elements, bonds)
+        self.fingerprint = Fingerprint.from_geometry(atom_no, elements, bonds)
+        self.content_hash = content_hash(elements, coords, bonds)
+
+    @classmethod
+    def from_molecule(cls, name, mol):
+        elements, coords, bonds = mol.pack()
+        return cls(name, mol.atom_no, mol.bond_no, elements, coords, bonds)
+
+    def geometry_row(self):
+        return (self.atom_no, self.bond_no, self.elements, self.coords, self.bonds)
+
+
+# /molecules sort keys mapped to indexed columns.
+MOLECULE_SORTS = {
+    'name': 'Molecules.NAME',
+    'formula': 'MoleculeDescriptors.FORMULA',
+    'atoms': 'MoleculeDescriptors.ATOM_COUNT',
+    'mass': 'MoleculeDescriptors.MOLAR_MASS',
+}
+
+
+class DatabasePool:
+    # One Database (and so one SQLite connection) per worker thread.
+    # sqlite3 connections cannot be shared across threads, so each worker lazily opens its own.
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def get(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = Database()
+            self.local.db = db
+        return db
 
 
 class Database: 
     
     def __init__(self, reset=False):
-        if reset == True and os.path.exists('molecules.db'): 
-            os.remove('molecules.db')
+        if reset == True and os.path.exists(DB_PATH): 
+            # WAL mode keeps side files next to the database; stale ones would corrupt a fresh DB.
+            for path in (DB_PATH, DB_PATH + '-wal', DB_PATH + '-shm'):
+                if os.path.exists(path):
+                    os.remove(path)
+            mol_cache.invalidate()
+            style_cache.invalidate()
 
-        self.conn = sqlite3.connect('molecules.db')
+        self.conn = sqlite3.connect(DB_PATH, timeout=30)
         self.cursor = self.conn.cursor()
 
+        # WAL lets readers on other connections proceed while a write is in progress.
+        self.cursor.execute("PRAGMA journal_mode=WAL")
+        self.cursor.execute("PRAGMA synchronous=NORMAL")
+
     def create_tables(self):
         self.cursor.execute("""
                 CREATE TABLE IF NOT EXISTS Elements (
@@ -53,6 +387,10 @@ class Database:
             NAME TEXT UNIQUE NOT NULL
             )
         """)
+        # Added after the first release; older databases get the column here and a backfill at startup.
+        columns = [row[1] for row in self.cursor.execute("PRAGMA table_info(Molecules)").fetchall()]
+        if 'CONTENT_HASH' not in columns:
+            self.cursor.execute("ALTER TABLE Molecules ADD COLUMN CONTENT_HASH TEXT")
 
         self.cursor.execute("""
             CREATE TABLE IF NOT EXISTS MoleculeAtom (
@@ -73,13 +411,122 @@ class Database:
             FOREIGN KEY(BOND_ID) REFERENCES Bonds(BOND_ID)
             )
         """)
+        # The primary keys cover lookups by molecule; these cover lookups by atom or bond.
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS MoleculeAtomAtom ON MoleculeAtom (ATOM_ID)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS MoleculeBondBond ON MoleculeBond (BOND_ID)")
+
+        # Compact layout: one row per molecule with packed element codes (3 bytes each),
+        # xyz doubles and (a1, a2, epairs) uint32 triples with 0-based atom indices.
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS MoleculeGeometry (
+            MOLECULE_ID INTEGER PRIMARY KEY NOT NULL,
+            ATOM_NO INTEGER NOT NULL,
+            BOND_NO INTEGER NOT NULL,
+            ELEMENTS BLOB NOT NULL,
+            COORDS BLOB NOT NULL,
+            BONDS BLOB NOT NULL,
+            FOREIGN KEY(MOLECULE_ID) REFERENCES Molecules(MOLECULE_ID)
+            )
+        """)
+
+        # Descriptors computed once at ingest; counts are JSON objects in first-seen order.
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS MoleculeDescriptors (
+            MOLECULE_ID INTEGER PRIMARY KEY NOT NULL,
+            FORMULA TEXT NOT NULL,
+            ATOM_COUNT INTEGER NOT NULL,
+            BOND_COUNT INTEGER NOT NULL,
+            MOLAR_MASS REAL NOT NULL,
+            ELEMENT_COUNTS TEXT NOT NULL,
+            BOND_ORDERS TEXT NOT NULL,
+            FOREIGN KEY(MOLECULE_ID) REFERENCES Molecules(MOLECULE_ID)
+            )
+        """)
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS DescriptorsFormula ON MoleculeDescriptors (FORMULA)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS DescriptorsAtomCount ON MoleculeDescriptors (ATOM_COUNT)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS DescriptorsMolarMass ON MoleculeDescriptors (MOLAR_MASS)")
+
+        # Similarity index; BIT_COUNT bounds the Tanimoto score, so searches only visit nearby counts.
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS MoleculeFingerprints (
+            MOLECULE_ID INTEGER PRIMARY KEY NOT NULL,
+            BIT_COUNT INTEGER NOT NULL,
+            BITS BLOB NOT NULL,
+            FOREIGN KEY(MOLECULE_ID) REFERENCES Molecules(MOLECULE_ID)
+            )
+        """)
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS FingerprintsBitCount ON MoleculeFingerprints (BIT_COUNT)")
+
+        # Trajectories share one molecule's topology; each frame is one encoded coordinate block
+        # (see trajectory.FrameCodec). FRAME_NO only counts committed frames.
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS Trajectories (
+            TRAJECTORY_ID INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            NAME TEXT UNIQUE NOT NULL,
+            MOLECULE_ID INTEGER NOT NULL,
+            ATOM_NO INTEGER NOT NULL,
+            FRAME_NO INTEGER NOT NULL,
+            ENCODING TEXT NOT NULL,
+            KEYFRAME_INTERVAL INTEGER NOT NULL,
+            FOREIGN KEY(MOLECULE_ID) REFERENCES Molecules(MOLECULE_ID)
+            )
+        """)
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS TrajectoriesMolecule ON Trajectories (MOLECULE_ID)")
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS TrajectoryFrames (
+            TRAJECTORY_ID INTEGER NOT NULL,
+            FRAME_INDEX INTEGER NOT NULL,
+            COORDS BLOB NOT NULL,
+            PRIMARY KEY (TRAJECTORY_ID, FRAME_INDEX),
+            FOREIGN KEY(TRAJECTORY_ID) REFERENCES Trajectories(TRAJECTORY_ID)
+            )
+        """)
+
+        # One row counting writes to molecules, shared by every process using the file. It starts
+        # from the clock so a recreated database does not repeat the generations of the old one.
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS Generation (
+            ID INTEGER PRIMARY KEY CHECK (ID = 0),
+            VALUE INTEGER NOT NULL
+            )
+        """)
+        self.cursor.execute("INSERT OR IGNORE INTO Generation VALUES (0, ?)", (time.time_ns(),))
+
+        # The same for writes to Elements, so every process notices a style edit made by another.
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS StyleVersion (
+            ID INTEGER PRIMARY KEY CHECK (ID = 0),
+            VALUE INTEGER NOT NULL
+            )
+        """)
+        self.cursor.execute("INSERT OR IGNORE INTO StyleVersion VALUES (0, ?)", (time.time_ns(),))
         self.conn.commit()
 
+    def generation(self):
+        # Changes with every committed write to molecules, from any process.
+        return self.cursor.execute("SELECT VALUE FROM Generation WHERE ID = 0").fetchone()[0]
+
+    def _bump_generation(self):
+        # Called inside the write's transaction, so readers never see the new rows under the old value.
+        self.cursor.execute("UPDATE Generation SET VALUE = VALUE + 1 WHERE ID = 0")
+
+    def style_version(self):
+        return self.cursor.execute("SELECT VALUE FROM StyleVersion WHERE ID = 0").fetchone()[0]
+
     def __setitem__ (self, table, values ):
         insert_placeholders =",".join(["?"] * len(values))
         sql = f"INSERT OR REPLACE INTO {table} VALUES ({insert_placeholders})"
-        self.cursor.execute(sql, values)
-        self.conn.commit()
+        with write_lock:
+            try:
+                self.cursor.execute(sql, values)
+                if table == 'Elements':
+                    self.cursor.execute("UPDATE StyleVersion SET VALUE = VALUE + 1 WHERE ID = 0")
+                else:
+                    self._bump_generation()
+                self.conn.commit()
+            except:
+                self.conn.rollback()
+                raise
 
     def add_atom( self, molname, atom ):
         # Insert the atom into the Atoms table
@@ -119,77 +566,176 @@ class Database:
             return
 
         molecule_id = row[0]
-        atom_ids = [x[0] for x in self.cursor.execute(
-            "SELECT ATOM_ID FROM MoleculeAtom WHERE MOLECULE_ID = ?", (molecule_id,)
-        ).fetchall()]
-        bond_ids = [x[0] for x in self.cursor.execute(
-            "SELECT BOND_ID FROM MoleculeBond WHERE MOLECULE_ID = ?", (molecule_id,)
-        ).fetchall()]
+        self._delete_legacy_rows(molecule_id)
+        self.cursor.execute("DELETE FROM MoleculeGeometry WHERE MOLECULE_ID = ?", (molecule_id,))
+        self.cursor.execute("DELETE FROM MoleculeDescriptors WHERE MOLECULE_ID = ?", (molecule_id,))
+        self.cursor.execute("DELETE FROM MoleculeFingerprints WHERE MOLECULE_ID = ?", (molecule_id,))
+        # Frames only make sense against the topology they were recorded with.
+        self.cursor.execute("""
+            DELETE FROM TrajectoryFrames WHERE TRAJECTORY_ID IN (SELECT TRAJECTORY_ID FROM Trajectories WHERE MOLECULE_ID = ?)
+        """, (molecule_id,))
+        self.cursor.execute("DELETE FROM Trajectories WHERE MOLECULE_ID = ?", (molecule_id,))
+        self.cursor.execute("DELETE FROM Molecules WHERE MOLECULE_ID = ?", (molecule_id,))
 
+    def _delete_legacy_rows(self, molecule_id):
+        # Set-based deletes driven by the (MOLECULE_ID, ...) primary keys; no ID lists in Python.
+        self.cursor.execute("""
+            DELETE FROM Atoms WHERE ATOM_ID IN (SELECT ATOM_ID FROM MoleculeAtom WHERE MOLECULE_ID = ?)
+        """, (molecule_id,))
+        self.cursor.execute("""
+            DELETE FROM Bonds WHERE BOND_ID IN (SELECT BOND_ID FROM MoleculeBond WHERE MOLECULE_ID = ?)
+        """, (molecule_id,))
         self.cursor.execute("DELETE FROM MoleculeAtom WHERE MOLECULE_ID = ?", (molecule_id,))
         self.cursor.execute("DELETE FROM MoleculeBond WHERE MOLECULE_ID = ?", (molecule_id,))
 
-        if atom_ids:
-            placeholders = ",".join(["?"] * len(atom_ids))
-            self.cursor.execute(f"DELETE FROM Atoms WHERE ATOM_ID IN ({placeholders})", atom_ids)
-        if bond_ids:
-            placeholders = ",".join(["?"] * len(bond_ids))
-            self.cursor.execute(f"DELETE FROM Bonds WHERE BOND_ID IN ({placeholders})", bond_ids)
-
-        self.cursor.execute("DELETE FROM Molecules WHERE MOLECULE_ID = ?", (molecule_id,))
-
     def add_molecule(self, name, fp):
         mol = Molecule()
         mol.parse(fp)
         if mol.atom_no == 0:
             raise ValueError("SDF did not contain any atoms")
 
-        try:
-            self.cursor.execute("BEGIN")
-            self._delete_molecule_if_exists(name)
-            self.cursor.execute("INSERT INTO Molecules (NAME) VALUES (?)", (name,))
+        return self.add_packed_molecules([PackedMolecule.from_molecule(name, mol)]) > 0
 
-            for i in range(mol.atom_no):
-                self.add_atom(name, Atom(mol.get_atom(i)))
-            for i in range(mol.bond_no):
-                self.add_bond(name, Bond(mol.get_bond(i)))
+    def add_packed_molecules(self, records):
+        # Insert or replace a batch of molecules in one transaction with batched statements.
+        # Records whose content hash matches the stored molecule of the same name are skipped
+        # without a write; returns how many were written.
+        with write_lock:
+            try:
+                # Take the write lock up front so readers never see a half-replaced molecule.
+                self.cursor.execute("BEGIN IMMEDIATE")
+                changed = []
+                for record in records:
+                    row = self.cursor.execute(
+                        "SELECT CONTENT_HASH FROM Molecules WHERE NAME = ?", (record.name,)
+                    ).fetchone()
+                    if row is not None and row[0] == record.content_hash:
+                        continue
+                    changed.append(record)
+                if not changed:
+                    self.conn.rollback()
+                    return 0
+                records = changed
 
-            self.conn.commit()
-        except:
-            self.conn.rollback()
-            raise
+                for record in records:
+                    self._delete_molecule_if_exists(record.name)
 
-    def load_mol (self, name ):
+                self.cursor.executemany(
+                    "INSERT INTO Molecules (NAME, CONTENT_HASH) VALUES (?, ?)",
+                    [(record.name, record.content_hash) for record in records]
+                )
+                self.cursor.executemany("""
+                    INSERT INTO MoleculeGeometry (MOLECULE_ID, ATOM_NO, BOND_NO, ELEMENTS, COORDS, BONDS)
+                    SELECT MOLECULE_ID, ?, ?, ?, ?, ? FROM Molecules WHERE NAME = ?
+                """, [record.geometry_row() + (record.name,) for record in records])
+                self.cursor.executemany("""
+                    INSERT INTO MoleculeDescriptors
+                        (MOLECULE_ID, FORMULA, ATOM_COUNT, BOND_COUNT, MOLAR_MASS, ELEMENT_COUNTS, BOND_ORDERS)
+                    SELECT MOLECULE_ID, ?, ?, ?, ?, ?, ? FROM Molecules WHERE NAME = ?
+                """, [record.descriptors.row() + (record.name,) for record in records])
+                self.cursor.executemany("""
+                    INSERT INTO MoleculeFingerprints (MOLECULE_ID, BIT_COUNT, BITS)
+                    SELECT MOLECULE_ID, ?, ? FROM Molecules WHERE NAME = ?
+                """, [record.fingerprint.row() + (record.name,) for record in records])
+                self._bump_generation()
+                self.conn.commit()
+            except:
+                self.conn.rollback()
+                raise
+            return len(records)
 
-        atom_results = self.cursor.execute("""
-            SELECT * 
+    def load_mol(self, name):
+        # Serve a private copy of the cached parse so callers are free to rotate it.
+        # Read the generation before loading so a concurrent write can only make this key stale.
+        generation = self.generation()
+        mol = mol_cache.get(name, generation)
+        if mol is None:
+            metrics.cache_lookups.inc('molecule', 'miss')
+            with metrics.timed('db'):
+                mol = self._read_mol(name)
+            mol_cache.put(name, generation, mol)
+        else:
+            metrics.cache_lookups.inc('molecule', 'hit')
+        return mol.copy()
+
+    def molecule_size(self, name):
+        # Atoms + bonds, read from the geometry row without unpacking it.
+        row = self.cursor.execute("""
+            SELECT ATOM_NO + BOND_NO
             FROM Molecules
-            JOIN MoleculeAtom ON Molecules.MOLECULE_ID = MoleculeAtom.MOLECULE_ID
+            LEFT JOIN MoleculeGeometry ON Molecules.MOLECULE_ID = MoleculeGeometry.MOLECULE_ID
+            WHERE Molecules.NAME = ?
+        """, (name,)).fetchone()
+        if row is None:
+            raise ValueError(f"Molecule '{name}' not found")
+        if row[0] is None:
+            # Still in the legacy tables
+            mol = self.load_mol(name)
+            return mol.atom_no + mol.bond_no
+        return row[0]
+
+    def _store_geometry(self, molecule_id, mol):
+        elements, coords, bonds = mol.pack()
+        self.cursor.execute(
+            "INSERT OR REPLACE INTO MoleculeGeometry VALUES (?, ?, ?, ?, ?, ?)",
+            (molecule_id, mol.atom_no, mol.bond_no, elements, coords, bonds)
+        )
+
+    def _read_mol(self, name):
+        # A single keyed lookup; molecules stored before MoleculeGeometry fall back to the legacy tables.
+        row = self.cursor.execute("""
+            SELECT Molecules.MOLECULE_ID, ATOM_NO, BOND_NO, ELEMENTS, COORDS, BONDS
+            FROM Molecules
+            LEFT JOIN MoleculeGeometry ON Molecules.MOLECULE_ID = MoleculeGeometry.MOLECULE_ID
+            WHERE Molecules.NAME = ?
+        """, (name,)).fetchone()
+
+        if row is None:
+            raise ValueError(f"Molecule '{name}' not found")
+
+        metrics.rows_read.inc('geometry')
+        molecule_id, atom_no, bond_no, elements, coords, bonds = row
+        if elements is None:
+            return self._read_legacy_mol(molecule_id, name)
+        if atom_no == 0:
+            raise ValueError(f"Molecule '{name}' not found")
+
+        mol = Molecule()
+        mol.reserve(atom_no, bond_no)
+        if mol.unpack(elements, coords, bonds) != 0:
+            raise ValueError(f"Corrupt geometry for molecule '{name}'")
+        return mol
+
+    def _read_legacy_mol(self, molecule_id, name):
+
+        atom_results = self.cursor.execute("""
+            SELECT Atoms.ELEMENT_CODE, Atoms.X, Atoms.Y, Atoms.Z
+            FROM MoleculeAtom
             JOIN Atoms ON MoleculeAtom.ATOM_ID = Atoms.ATOM_ID
-            JOIN Elements ON Atoms.ELEMENT_CODE = Elements.ELEMENT_CODE
-            WHERE Molecules.NAME =?
+            WHERE MoleculeAtom.MOLECULE_ID = ?
             ORDER BY Atoms.ATOM_ID ASC
-        """, (name,)).fetchall()
+        """, (molecule_id,)).fetchall()
 
 
         bond_results = self.cursor.execute("""
-            SELECT * 
-            FROM Molecules 
-            JOIN MoleculeBond ON Molecules.MOLECULE_ID = MoleculeBond.MOLECULE_ID
+            SELECT Bonds.A1, Bonds.A2, Bonds.EPAIRS
+            FROM MoleculeBond
             JOIN Bonds ON MoleculeBond.BOND_ID = Bonds.BOND_ID
-            WHERE Molecules.NAME = ? 
+            WHERE MoleculeBond.MOLECULE_ID = ?
             ORDER BY Bonds.BOND_ID ASC
-        """,(name,)).fetchall()
+        """,(molecule_id,)).fetchall()
+        metrics.rows_read.inc('legacy', amount=len(atom_results) + len(bond_results))
 
         if not atom_results:
             raise ValueError(f"Molecule '{name}' not found")
 
         mol = Molecule()
-        for i in range (len(atom_results)):
+        mol.reserve(len(atom_results), len(bond_results))
+        for element, x, y, z in atom_results:
             #Appending Atom
-            mol.append_atom(atom_results[i][5], atom_results[i][6], atom_results[i][7], atom_results[i][8])
+            mol.append_atom(element, x, y, z)
         
-        raw_bonds = [(row[5], row[6], row[7]) for row in bond_results]
+        raw_bonds = bond_results
         if raw_bonds:
             max_idx = max(max(a1, a2) for a1, a2, _ in raw_bonds)
             min_idx = min(min(a1, a2) for a1, a2, _ in raw_bonds)
@@ -208,54 +754,339 @@ class Database:
                 mol.append_bond(a1, a2, epairs)
         
         return mol
+
+    def migrate_geometry(self):
+        # Move molecules still stored as per-atom/per-bond rows into MoleculeGeometry.
+        # Bond indices are normalized to 0-based on the way through _read_legacy_mol.
+        legacy = self.cursor.execute("""
+            SELECT Molecules.MOLECULE_ID, Molecules.NAME
+            FROM Molecules
+            LEFT JOIN MoleculeGeometry ON Molecules.MOLECULE_ID = MoleculeGeometry.MOLECULE_ID
+            WHERE MoleculeGeometry.MOLECULE_ID IS NULL
+        """).fetchall()
+
+        migrated = 0
+        for molecule_id, name in legacy:
+            try:
+                mol = self._read_legacy_mol(molecule_id, name)
+            except ValueError:
+                # Leave unreadable rows alone; load_mol keeps reporting them as before.
+                continue
+
+            with write_lock:
+                try:
+                    self.cursor.execute("BEGIN IMMEDIATE")
+                    self._store_geometry(molecule_id, mol)
+                    self._delete_legacy_rows(molecule_id)
+                    self._bump_generation()
+                    self.conn.commit()
+                except:
+                    self.conn.rollback()
+                    raise
+            migrated += 1
+        return migrated
         
-    def radius(self):
-        sql = "SELECT * FROM Elements"
+    def backfill_derived(self, batch_size=500):
+        # Fill MoleculeDescriptors, MoleculeFingerprints and Molecules.CONTENT_HASH for molecules
+        # stored before they existed, straight from the geometry blobs.
+        def missing_from(table):
+            return f"""
+                SELECT MoleculeGeometry.MOLECULE_ID
+                FROM MoleculeGeometry
+                LEFT JOIN {table} ON MoleculeGeometry.MOLECULE_ID = {table}.MOLECULE_ID
+                WHERE {table}.MOLECULE_ID IS NULL
+            """
 
-        self.cursor.execute(sql)
-        rows = self.cursor.fetchall()
+        derived = [
+            (
+                missing_from("MoleculeDescriptors"),
+                "INSERT OR REPLACE INTO MoleculeDescriptors VALUES (?, ?, ?, ?, ?, ?, ?)",
+                lambda molecule_id, atom_no, bond_no, elements, coords, bonds:
+                    (molecule_id,) + Descriptors.from_geometry(atom_no, bond_no, elements, bonds).row(),
+            ),
+            (
+                missing_from("MoleculeFingerprints"),
+                "INSERT OR REPLACE INTO MoleculeFingerprints VALUES (?, ?, ?)",
+                lambda molecule_id, atom_no, bond_no, elements, coords, bonds:
+                    (molecule_id,) + Fingerprint.from_geometry(atom_no, elements, bonds).row(),
+            ),
+            (
+                """
+                SELECT MoleculeGeometry.MOLECULE_ID
+                FROM MoleculeGeometry
+                JOIN Molecules ON MoleculeGeometry.MOLECULE_ID = Molecules.MOLECULE_ID
+                WHERE Molecules.CONTENT_HASH IS NULL
+                """,
+                "UPDATE Molecules SET CONTENT_HASH = ? WHERE MOLECULE_ID = ?",
+                lambda molecule_id, atom_no, bond_no, elements, coords, bonds:
+                    (content_hash(elements, coords, bonds), molecule_id),
+            ),
+        ]
 
-        #Mapping to row indices with values needed
-        radius_dict = {row[1]: row[6] for row in rows}
+        filled = 0
+        for missing_sql, write_sql, compute in derived:
+            missing = [row[0] for row in self.cursor.execute(missing_sql).fetchall()]
 
-        return radius_dict
-    
-    def element_name(self):
-        query = "SELECT ELEMENT_CODE, ELEMENT_NAME FROM Elements"
+            for start in range(0, len(missing), batch_size):
+                batch = missing[start:start + batch_size]
+                placeholders = ",".join(["?"] * len(batch))
+                # Read and write under one write transaction, so a molecule deleted or replaced
+                # since the scan above is skipped rather than given orphaned derived rows.
+                with write_lock:
+                    try:
+                        self.cursor.execute("BEGIN IMMEDIATE")
+                        rows = self.cursor.execute(f"""
+                            SELECT MOLECULE_ID, ATOM_NO, BOND_NO, ELEMENTS, COORDS, BONDS
+                            FROM MoleculeGeometry WHERE MOLECULE_ID IN ({placeholders})
+                        """, batch).fetchall()
+                        self.cursor.executemany(write_sql, [compute(*row) for row in rows])
+                        self.conn.commit()
+                    except:
+                        self.conn.rollback()
+                        raise
+                filled += len(rows)
+        return filled
 
-        self.cursor.execute(query)
+    @metrics.stage('db')
+    def describe(self, name):
+        # One keyed lookup of the stored descriptors.
+        row = self.cursor.execute("""
+            SELECT ATOM_COUNT, BOND_COUNT, ELEMENT_COUNTS, BOND_ORDERS
+            FROM Molecules
+            JOIN MoleculeDescriptors ON Molecules.MOLECULE_ID = MoleculeDescriptors.MOLECULE_ID
+            WHERE Molecules.NAME = ?
+        """, (name,)).fetchone()
+        if row is None:
+            raise ValueError(f"Molecule '{name}' not found")
+        return Descriptors.from_row(*row)
 
-        rows = self.cursor.fetchall()
+    @metrics.stage('db')
+    def list_molecules(self, offset=0, limit=100, sort='name', descending=False, formula=None,
+                       min_atoms=None, max_atoms=None, min_mass=None, max_mass=None):
+        # One page of the library with its total; every filter and sort key is backed by an index.
+        clauses = []
+        params = []
+        if formula:
+            clauses.append("MoleculeDescriptors.FORMULA = ?")
+            params.append(formula)
+        if min_atoms is not None:
+            clauses.append("MoleculeDescriptors.ATOM_COUNT >= ?")
+            params.append(min_atoms)
+        if max_atoms is not None:
+            clauses.append("MoleculeDescriptors.ATOM_COUNT <= ?")
+            params.append(max_atoms)
+        if min_mass is not None:
+            clauses.append("MoleculeDescriptors.MOLAR_MASS >= ?")
+            params.append(min_mass)
+        if max_mass is not None:
+            clauses.append("MoleculeDescriptors.MOLAR_MASS <= ?")
+            params.append(max_mass)
+        where = ("WHERE " + " AND ".join(clauses)) if clauses else ""
 
-        #Mapping to row indices with values needed
-        element_dict = {row[0]: row[1] for row in rows}
+        order = MOLECULE_SORTS.get(sort, MOLECULE_SORTS['name'])
+        direction = "DESC" if descending else "ASC"
+        joined = """
+            FROM Molecules
+            JOIN MoleculeDescriptors ON Molecules.MOLECULE_ID = MoleculeDescriptors.MOLECULE_ID
+        """
 
-        return element_dict
+        total = self.cursor.execute(f"SELECT COUNT(*) {joined} {where}", params).fetchone()[0]
+        rows = self.cursor.execute(f"""
+            SELECT Molecules.NAME, FORMULA, ATOM_COUNT, BOND_COUNT, MOLAR_MASS {joined} {where}
+            ORDER BY {order} {direction}, Molecules.NAME {direction}
+            LIMIT ? OFFSET ?
+        """, params + [limit, offset]).fetchall()
 
-    def radial_gradients(self):
-        #Retrieve data from the Elements table
-        sql =  "SELECT ELEMENT_NAME, COLOUR1, COLOUR2, COLOUR3 FROM Elements"
+        metrics.rows_read.inc('listing', amount=len(rows))
+        molecules = [
+            {"name": name, "formula": formula, "atom_count": atoms, "bond_count": bonds, "molar_mass": round(mass, 3)}
+            for name, formula, atoms, bonds, mass in rows
+        ]
+        return total, molecules
 
-        self.cursor.execute(sql)
-        
-        rows = self.cursor.fetchall()
+    def _digest_rows(self, where, params):
+        rows = self.cursor.execute(f"""
+            SELECT Molecules.NAME, CONTENT_HASH, ELEMENT_COUNTS
+            FROM Molecules
+            LEFT JOIN MoleculeDescriptors ON Molecules.MOLECULE_ID = MoleculeDescriptors.MOLECULE_ID
+            {where}
+        """, params).fetchall()
+        return [
+            (name, digest, sorted(json.loads(counts)) if counts is not None else None)
+            for name, digest, counts in rows
+        ]
 
-        gradients= ""
-        for row in rows:
-            element_name,colour1,colour2,colour3 = row
+    def molecule_digests(self, after='', limit=1000):
+        # (name, content hash, element codes) in name order, one page after `after`. Enough to tell
+        # whether something derived from a molecule's geometry is still current without loading it.
+        return self._digest_rows("WHERE Molecules.NAME > ? ORDER BY Molecules.NAME LIMIT ?", (after, limit))
 
-            gradient_svg = """
-            <radialGradient id="%s" cx="-50%%" cy="-50%%" r="220%%" fx="20%%" fy="20%%">
-            <stop offset="0%%" stop-color="#%s"/>
-            <stop offset="50%%" stop-color="#%s"/>
-            <stop offset="100%%" stop-color="#%s"/>
-            </radialGradient>""" % (element_name, colour1, colour2, colour3)
-            gradients += gradient_svg
+    def molecule_digest(self, name):
+        rows = self._digest_rows("WHERE Molecules.NAME = ?", (name,))
+        if not rows:
+            raise ValueError(f"Molecule '{name}' not found")
+        return rows[0]
 
-        return gradients
-        
+    def fingerprint(self, name):
+        row = self.cursor.execute("""
+            SELECT BITS FROM Molecules
+            JOIN MoleculeFingerprints ON Molecules.MOLECULE_ID = MoleculeFingerprints.MOLECULE_ID
+            WHERE Molecules.NAME = ?
+        """, (name,)).fetchone()
+        if row is None:
+            raise ValueError(f"Molecule '{name}' not found")
+        return Fingerprint.from_blob(row[0])
 
+    @metrics.stage('db')
+    def search_similar(self, query, k=10, min_score=0.0, exclude=None):
+        # Top-k Tanimoto matches. A molecule with b bits scores at most min(a, b) / max(a, b) against a
+        # query with a bits, so bit counts are visited outward from a, best bound first, until no
+        # remaining count can beat the current k-th score. Returns (results, molecules scored).
+        a = query.bit_count
+        if a == 0 or k <= 0:
+            return [], 0
+        highest = self.cursor.execute("SELECT MAX(BIT_COUNT) FROM MoleculeFingerprints").fetchone()[0] or 0
 
+        best = []
+        scored = 0
+        down, up = a, a + 1
+        while down > 0 or up <= highest:
+            down_bound = down / a if down > 0 else 0.0
+            up_bound = a / up if up <= highest else 0.0
+            bound = max(down_bound, up_bound)
+            if bound < min_score or (len(best) >= k and bound <= best[0][0]):
+                break
 
+            if down_bound >= up_bound:
+                count, down = down, down - 1
+            else:
+                count, up = up, up + 1
 
-    
+            for name, bits in self.cursor.execute("""
+                SELECT Molecules.NAME, BITS FROM MoleculeFingerprints
+                JOIN Molecules ON Molecules.MOLECULE_ID = MoleculeFingerprints.MOLECULE_ID
+                WHERE BIT_COUNT = ?
+            """, (count,)):
+                if name == exclude:
+                    continue
+                scored += 1
+                score = query.tanimoto(int.from_bytes(bits, 'little'), count)
+                if score < min_score:
+                    continue
+                if len(best) < k:
+                    heapq.heappush(best, (score, name))
+                elif (score, name) > best[0]:
+                    heapq.heapreplace(best, (score, name))
+
+        metrics.rows_read.inc('fingerprints', amount=scored)
+        return sorted(best, key=lambda match: (-match[0], match[1])), scored
+
+    def create_trajectory(self, name, molecule_name, atom_no, encoding, keyframe_interval):
+        # Replaces any trajectory of the same name; frames are added afterwards in batches.
+        with write_lock:
+            try:
+                self.cursor.execute("BEGIN IMMEDIATE")
+                self._delete_trajectory_if_exists(name)
+                row = self.cursor.execute("SELECT MOLECULE_ID FROM Molecules WHERE NAME = ?", (molecule_name,)).fetchone()
+                if row is None:
+                    raise ValueError(f"Molecule '{molecule_name}' not found")
+                self.cursor.execute("""
+                    INSERT INTO Trajectories (NAME, MOLECULE_ID, ATOM_NO, FRAME_NO, ENCODING, KEYFRAME_INTERVAL)
+                    VALUES (?, ?, ?, 0, ?, ?)
+                """, (name, row[0], atom_no, encoding, keyframe_interval))
+                trajectory_id = self.cursor.lastrowid
+                self.conn.commit()
+            except:
+                self.conn.rollback()
+                raise
+        return trajectory_id
+
+    def add_trajectory_frames(self, trajectory_id, frames):
+        # frames: (index, blob) pairs continuing the trajectory; committed together.
+        with write_lock:
+            try:
+                self.cursor.execute("BEGIN IMMEDIATE")
+                self.cursor.executemany(
+                    "INSERT INTO TrajectoryFrames (TRAJECTORY_ID, FRAME_INDEX, COORDS) VALUES (?, ?, ?)",
+                    [(trajectory_id, index, blob) for index, blob in frames]
+                )
+                self.cursor.execute("""
+                    UPDATE Trajectories SET FRAME_NO = (SELECT COUNT(*) FROM TrajectoryFrames WHERE TRAJECTORY_ID = ?)
+                    WHERE TRAJECTORY_ID = ?
+                """, (trajectory_id, trajectory_id))
+                self.conn.commit()
+            except:
+                self.conn.rollback()
+                raise
+
+    def _delete_trajectory_if_exists(self, name):
+        self.cursor.execute(
+            "DELETE FROM TrajectoryFrames WHERE TRAJECTORY_ID IN (SELECT TRAJECTORY_ID FROM Trajectories WHERE NAME = ?)",
+            (name,)
+        )
+        self.cursor.execute("DELETE FROM Trajectories WHERE NAME = ?", (name,))
+
+    def delete_trajectory(self, name):
+        with write_lock:
+            try:
+                self.cursor.execute("BEGIN IMMEDIATE")
+                self._delete_trajectory_if_exists(name)
+                self.conn.commit()
+            except:
+                self.conn.rollback()
+                raise
+
+    def _trajectory_rows(self, where, params):
+        rows = self.cursor.execute(f"""
+            SELECT TRAJECTORY_ID, Trajectories.NAME, Molecules.NAME, ATOM_NO, FRAME_NO, ENCODING, KEYFRAME_INTERVAL
+            FROM Trajectories
+            JOIN Molecules ON Trajectories.MOLECULE_ID = Molecules.MOLECULE_ID
+            {where}
+            ORDER BY Trajectories.NAME
+        """, params).fetchall()
+        keys = ("id", "name", "molecule", "atom_no", "frame_no", "encoding", "keyframe_interval")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def trajectory(self, name):
+        rows = self._trajectory_rows("WHERE Trajectories.NAME = ?", (name,))
+        if not rows:
+            raise ValueError(f"Trajectory '{name}' not found")
+        return rows[0]
+
+    def trajectories(self):
+        return self._trajectory_rows("", ())
+
+    def trajectory_frames(self, trajectory_id, start, end):
+        # Encoded frames with start <= index < end, in order; callers page through long trajectories.
+        return self.cursor.execute("""
+            SELECT FRAME_INDEX, COORDS FROM TrajectoryFrames
+            WHERE TRAJECTORY_ID = ? AND FRAME_INDEX >= ? AND FRAME_INDEX < ?
+            ORDER BY FRAME_INDEX
+        """, (trajectory_id, start, end)).fetchall()
+
+    def element_styles(self):
+        # Read the version before the rows so a concurrent edit can only make this snapshot stale.
+        version = self.style_version()
+        styles = style_cache.styles
+        if styles is None or styles.version != version:
+            metrics.cache_lookups.inc('styles', 'miss')
+            with metrics.timed('styles'):
+                rows = self.cursor.execute("""
+                    SELECT ELEMENT_CODE, ELEMENT_NAME, COLOUR1, COLOUR2, COLOUR3, RADIUS
+                    FROM Elements
+                """).fetchall()
+                styles = ElementStyles(version, rows)
+            metrics.rows_read.inc('elements', amount=len(rows))
+            style_cache.styles = styles
+        else:
+            metrics.cache_lookups.inc('styles', 'hit')
+        return styles
+
+    def radius(self):
+        return dict(self.element_styles().radius)
+
+    def element_name(self):
+        return dict(self.element_styles().element_name)
+
+    def radial_gradients(self):
+        return self.element_styles().defs()
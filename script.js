@@ -1,4 +1,11 @@
 $(document).ready(function() {
+    // Same cut-over as the server's default --lod-over.
+    const LOCAL_RENDER_LIMIT = 5000;
+    // Renders with more atoms + bonds than this use server-side picking instead of per-node handlers.
+    const PICK_LIMIT = 2000;
+    // Playback rate requested from /trajectories/<name>/stream.
+    const TRAJECTORY_FPS = 15;
+
     const state = {
         rotation: { x: 0, y: 0, z: 0 },
         drag: {
@@ -14,6 +21,23 @@ $(document).ready(function() {
             queued: false,
             requestId: 0,
         },
+        geometry: {
+            name: null,
+            data: null,
+            loading: null,
+            frame: null,
+        },
+        listing: {
+            offset: 0,
+            limit: 100,
+            total: 0,
+        },
+        trajectory: {
+            info: null,
+            source: null,
+            frame: null,
+            coords: null,
+        },
         selectedAtomIndex: null,
     };
 
@@ -38,6 +62,8 @@ $(document).ready(function() {
             data: data,
             success: function() {
                 loadElements();
+                // Styles are part of the geometry payload, so fetch it again.
+                clearGeometry();
                 if ($('#molecule-select').val()) {
                     requestDisplay();
                 }
@@ -54,6 +80,9 @@ $(document).ready(function() {
         if (fileInput.files.length > 0) {
             const formData = new FormData();
             formData.append('molname', molName);
+            if ($('#library-toggle').is(':checked')) {
+                formData.append('library', '1');
+            }
             formData.append('sdf_file', fileInput.files[0]);
 
             $.ajax({
@@ -63,14 +92,30 @@ $(document).ready(function() {
                 processData: false,
                 contentType: false,
                 success: function(res) {
-                    resetRotation();
-                    state.selectedAtomIndex = null;
-                    setSelectionInfo('Click an atom to inspect its neighborhood.');
-                    loadMolecules(res.name).done(function() {
-                        requestDisplay();
-                        loadAnalytics(res.name);
+                    // The server ingests in the background; follow the job until it settles.
+                    waitForJob(res.job, function(job) {
+                        if (job.state !== 'done') {
+                            const detail = job.error || (job.errors.length ? job.errors[0].error : '');
+                            alert('Upload failed: ' + detail);
+                            return;
+                        }
+                        const name = job.records === 1 ? res.name : null;
+                        clearGeometry();
+                        resetRotation();
+                        state.selectedAtomIndex = null;
+                        setSelectionInfo('Click an atom to inspect its neighborhood.');
+                        loadMolecules(name).done(function() {
+                            if (name) {
+                                requestDisplay();
+                                loadAnalytics(name);
+                            }
+                        });
+                        if (job.records === 1) {
+                            alert(job.unchanged ? 'Molecule already stored with identical geometry' : 'Molecule uploaded successfully');
+                        } else {
+                            alert(`Imported ${job.imported} of ${job.records} molecules (${job.unchanged} unchanged, ${job.failed} failed)`);
+                        }
                     });
-                    alert('Molecule uploaded successfully');
                 },
                 error: function(err) {
                     const detail = err.responseText ? `\n${err.responseText}` : '';
@@ -80,12 +125,56 @@ $(document).ready(function() {
         }
     });
 
+    $('#molecule-filter-form').submit(function(e) {
+        e.preventDefault();
+        state.listing.offset = 0;
+        loadMolecules();
+    });
+
+    $('#molecule-sort').change(function() {
+        state.listing.offset = 0;
+        loadMolecules();
+    });
+
+    $('#molecule-prev').on('click', function() {
+        state.listing.offset = Math.max(0, state.listing.offset - state.listing.limit);
+        loadMolecules();
+    });
+
+    $('#molecule-next').on('click', function() {
+        if (state.listing.offset + state.listing.limit < state.listing.total) {
+            state.listing.offset += state.listing.limit;
+            loadMolecules();
+        }
+    });
+
+    $('#molecule-gallery').on('click', '.gallery-item', function() {
+        $('#molecule-select').val($(this).attr('data-name')).trigger('change');
+    });
+
+    $('#similar-list').on('click', '.similar-link', function() {
+        const name = $(this).attr('data-name');
+        loadMolecules(name).done(function() {
+            $('#molecule-select').trigger('change');
+        });
+    });
+
     $('#molecule-select').change(function() {
         resetRotation();
         state.selectedAtomIndex = null;
         setSelectionInfo('Click an atom to inspect its neighborhood.');
+        stopTrajectory();
         requestDisplay();
         loadAnalytics($('#molecule-select').val());
+        loadTrajectory($('#molecule-select').val());
+    });
+
+    $('#trajectory-play').on('click', function() {
+        playTrajectory();
+    });
+
+    $('#trajectory-stop').on('click', function() {
+        stopTrajectory();
     });
 
     $('#reset-view-btn').on('click', function() {
@@ -93,6 +182,10 @@ $(document).ready(function() {
         requestDisplay();
     });
 
+    $('#local-render-toggle, #lod-toggle').change(function() {
+        requestDisplay();
+    });
+
     bindDragRotate();
 
     function loadElements() {
@@ -111,19 +204,79 @@ $(document).ready(function() {
         });
     }
 
+    function waitForJob(jobId, done) {
+        $.getJSON(`/jobs/${jobId}`, function(job) {
+            if (job.state === 'queued' || job.state === 'running') {
+                $('#upload-status').text(`Importing... ${Math.round(job.progress * 100)}%`);
+                setTimeout(function() { waitForJob(jobId, done); }, 500);
+                return;
+            }
+            $('#upload-status').text('');
+            done(job);
+        }).fail(function() {
+            $('#upload-status').text('');
+            alert('Lost track of the upload job');
+        });
+    }
+
+    function listingQuery() {
+        const query = {
+            offset: state.listing.offset,
+            limit: state.listing.limit,
+            sort: $('#molecule-sort').val(),
+        };
+        const formula = $('#filter-formula').val().trim();
+        const minAtoms = $('#filter-min-atoms').val();
+        const maxAtoms = $('#filter-max-atoms').val();
+        if (formula) query.formula = formula;
+        if (minAtoms) query.min_atoms = minAtoms;
+        if (maxAtoms) query.max_atoms = maxAtoms;
+        return query;
+    }
+
     function loadMolecules(selectedName = null) {
-        return $.getJSON('/molecules', function(data) {
+        // The server pages and filters the library; only one page is ever in the dropdown.
+        return $.getJSON('/molecules', listingQuery(), function(data) {
             const select = $('#molecule-select');
             const currentVal = select.val();
+            const names = data.molecules.map(mol => mol.name);
+            state.listing.total = data.total;
+
             select.empty().append('<option value="">-- Choose one --</option>');
-            data.forEach(name => {
+            // Keep the current or newly uploaded molecule selectable even when it is not on this page.
+            [selectedName, currentVal].forEach(name => {
+                if (name && !names.includes(name)) {
+                    names.unshift(name);
+                }
+            });
+            names.forEach(name => {
                 const selected = (name === currentVal) ? 'selected' : '';
                 select.append(`<option value="${name}" ${selected}>${name}</option>`);
             });
 
-            if (selectedName && data.includes(selectedName)) {
+            if (selectedName) {
                 select.val(selectedName);
             }
+
+            const first = data.total ? data.offset + 1 : 0;
+            const last = data.offset + data.molecules.length;
+            $('#molecule-page-info').text(`${first}-${last} of ${data.total}`);
+            $('#molecule-prev').prop('disabled', data.offset === 0);
+            $('#molecule-next').prop('disabled', last >= data.total);
+            showGallery(data.molecules);
+        });
+    }
+
+    function showGallery(molecules) {
+        // Thumbnails come from the server's disk cache; lazy loading only fetches the visible ones.
+        const gallery = $('#molecule-gallery');
+        gallery.empty();
+        molecules.forEach(mol => {
+            $('<button type="button" class="gallery-item"></button>')
+                .attr('data-name', mol.name)
+                .attr('title', `${mol.name} (${mol.formula})`)
+                .append($('<img loading="lazy" alt="">').attr('src', `/thumbnail?name=${encodeURIComponent(mol.name)}`))
+                .appendTo(gallery);
         });
     }
 
@@ -134,6 +287,16 @@ $(document).ready(function() {
     }
 
     function scheduleDisplay() {
+        if (localRenderReady($('#molecule-select').val())) {
+            // Coalesce drag events into at most one local render per animation frame.
+            if (state.geometry.frame === null) {
+                state.geometry.frame = requestAnimationFrame(function() {
+                    state.geometry.frame = null;
+                    requestDisplay();
+                });
+            }
+            return;
+        }
         state.render.queued = true;
         requestDisplay();
     }
@@ -146,6 +309,29 @@ $(document).ready(function() {
             return;
         }
 
+        const haveGeometry = state.geometry.data !== null && state.geometry.name === molName;
+        if ($('#local-render-toggle').is(':checked') && window.fetch && window.TextDecoder &&
+            !(haveGeometry && tooLargeForLocal(state.geometry.data))) {
+            if (localRenderReady(molName)) {
+                showSvg(renderLocal(playingGeometry(state.geometry.data)));
+                return;
+            }
+            loadGeometry(molName).then(function() {
+                if ($('#molecule-select').val() === molName) {
+                    requestDisplay();
+                }
+            }).catch(function() {
+                // Older servers or a bad payload: render on the server instead.
+                $('#local-render-toggle').prop('checked', false);
+                requestDisplay();
+            });
+            return;
+        }
+
+        requestRemoteDisplay(molName);
+    }
+
+    function requestRemoteDisplay(molName) {
         if (state.render.inFlight) {
             state.render.queued = true;
             return;
@@ -155,23 +341,23 @@ $(document).ready(function() {
         state.render.queued = false;
         const requestId = ++state.render.requestId;
 
+        // GET so the browser can revalidate frames it has already seen (ETag / 304).
         $.ajax({
-            type: 'POST',
+            type: 'GET',
             url: '/display',
             data: {
                 name: molName,
                 phi_x: Math.round(state.rotation.x),
                 phi_y: Math.round(state.rotation.y),
-                phi_z: Math.round(state.rotation.z)
+                phi_z: Math.round(state.rotation.z),
+                lod: $('#lod-toggle').is(':checked') ? 1 : 0
             },
             dataType: 'text',
             success: function(svg) {
                 if (requestId !== state.render.requestId) {
                     return;
                 }
-                $('#svg-container').html(svg);
-                bindSvgInteractions();
-                applySelection();
+                showSvg(svg);
             },
             error: function(err) {
                 const msg = err.responseText || err.statusText;
@@ -187,6 +373,188 @@ $(document).ready(function() {
         });
     }
 
+    function showSvg(svg) {
+        $('#svg-container').html(svg);
+        bindSvgInteractions();
+        applySelection();
+    }
+
+    function clearGeometry() {
+        state.geometry.name = null;
+        state.geometry.data = null;
+        state.geometry.loading = null;
+    }
+
+    function localRenderReady(molName) {
+        return $('#local-render-toggle').is(':checked') &&
+            state.geometry.data !== null && state.geometry.name === molName &&
+            !tooLargeForLocal(state.geometry.data);
+    }
+
+    function tooLargeForLocal(geometry) {
+        // Huge molecules go through the server's simplified (LOD) render instead of one DOM node per object.
+        return $('#lod-toggle').is(':checked') && geometry.atomNo + geometry.bondNo > LOCAL_RENDER_LIMIT;
+    }
+
+    function loadGeometry(molName) {
+        if (state.geometry.loading && state.geometry.name === molName) {
+            return state.geometry.loading;
+        }
+
+        state.geometry.name = molName;
+        state.geometry.data = null;
+        const loading = fetch('/geometry', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/x-www-form-urlencoded' },
+            body: new URLSearchParams({ name: molName })
+        }).then(function(res) {
+            if (!res.ok) {
+                throw new Error(res.statusText);
+            }
+            return res.arrayBuffer();
+        }).then(function(buffer) {
+            if (state.geometry.loading === loading) {
+                state.geometry.data = decodeGeometry(buffer);
+            }
+        });
+        loading.catch(function() {
+            if (state.geometry.loading === loading) {
+                clearGeometry();
+            }
+        });
+        state.geometry.loading = loading;
+        return loading;
+    }
+
+    function decodeGeometry(buffer) {
+        // Layout written by encode_geometry() in server.py (little-endian, 4-byte aligned sections).
+        const view = new DataView(buffer);
+        const magic = String.fromCharCode(view.getUint8(0), view.getUint8(1), view.getUint8(2), view.getUint8(3));
+        if (magic !== 'MVG1') {
+            throw new Error('Unexpected geometry format');
+        }
+        const atomNo = view.getUint32(4, true);
+        const bondNo = view.getUint32(8, true);
+        const styleLength = view.getUint32(12, true);
+
+        let offset = 16;
+        const styles = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, offset, styleLength)));
+        offset += styleLength;
+        const coords = new Float32Array(buffer, offset, atomNo * 3);
+        offset += atomNo * 12;
+        const bonds = new Uint32Array(buffer, offset, bondNo * 2);
+        offset += bondNo * 8;
+        const elements = new Uint16Array(buffer, offset, atomNo);
+        offset += atomNo * 2;
+        const epairs = new Uint8Array(buffer, offset, bondNo);
+
+        return { atomNo, bondNo, styles, coords, bonds, elements, epairs };
+    }
+
+    function rotationMatrix(phiX, phiY, phiZ) {
+        // Rz * Ry * Rx, the same composition as molrotate() in mol.c.
+        const rad = Math.PI / 180;
+        const cx = Math.cos(phiX * rad), sx = Math.sin(phiX * rad);
+        const cy = Math.cos(phiY * rad), sy = Math.sin(phiY * rad);
+        const cz = Math.cos(phiZ * rad), sz = Math.sin(phiZ * rad);
+        return [
+            [cz * cy, cz * sy * sx - sz * cx, cz * sy * cx + sz * sx],
+            [sz * cy, sz * sy * sx + cz * cx, sz * sy * cx - cz * sx],
+            [-sy, cy * sx, cy * cx]
+        ];
+    }
+
+    function renderLocal(geometry) {
+        // Mirrors the server renderer: rotate about the centroid, fit to the canvas,
+        // draw atoms and bonds back to front with the same markup as /display.
+        const width = 1000, height = 1000;
+        const n = geometry.atomNo;
+        const styles = geometry.styles.elements;
+        const m = rotationMatrix(state.rotation.x, state.rotation.y, state.rotation.z);
+
+        let cx = 0, cy = 0, cz = 0;
+        for (let i = 0; i < n; i++) {
+            cx += geometry.coords[3 * i];
+            cy += geometry.coords[3 * i + 1];
+            cz += geometry.coords[3 * i + 2];
+        }
+        if (n) {
+            cx /= n; cy /= n; cz /= n;
+        }
+
+        const xs = new Float64Array(n), ys = new Float64Array(n), zs = new Float64Array(n);
+        let minX = Infinity, maxX = -Infinity, minY = Infinity, maxY = -Infinity, maxR = 0;
+        for (let i = 0; i < n; i++) {
+            const x = geometry.coords[3 * i] - cx;
+            const y = geometry.coords[3 * i + 1] - cy;
+            const z = geometry.coords[3 * i + 2] - cz;
+            xs[i] = m[0][0] * x + m[0][1] * y + m[0][2] * z + cx;
+            ys[i] = m[1][0] * x + m[1][1] * y + m[1][2] * z + cy;
+            zs[i] = m[2][0] * x + m[2][1] * y + m[2][2] * z + cz;
+            minX = Math.min(minX, xs[i]);
+            maxX = Math.max(maxX, xs[i]);
+            minY = Math.min(minY, ys[i]);
+            maxY = Math.max(maxY, ys[i]);
+            maxR = Math.max(maxR, styles[geometry.elements[i]].radius);
+        }
+
+        //Scale the molecule to fill 90% of the canvas, leaving room for the outermost atoms
+        let scale = 100.0, offsetX = width / 2.0, offsetY = height / 2.0;
+        if (n) {
+            const scaleX = (0.9 * width - 2.0 * maxR) / Math.max(maxX - minX, 1e-6);
+            const scaleY = (0.9 * height - 2.0 * maxR) / Math.max(maxY - minY, 1e-6);
+            scale = Math.min(Math.max(20.0, Math.min(scaleX, scaleY)), 180.0);
+            offsetX = width / 2.0 - ((minX + maxX) / 2.0) * scale;
+            offsetY = height / 2.0 - ((minY + maxY) / 2.0) * scale;
+        }
+
+        //Atoms sort before bonds at equal depth, like the server
+        const order = [];
+        for (let i = 0; i < n; i++) {
+            order.push({ z: zs[i], atom: i });
+        }
+        for (let i = 0; i < geometry.bondNo; i++) {
+            const a1 = geometry.bonds[2 * i], a2 = geometry.bonds[2 * i + 1];
+            order.push({ z: (zs[a1] + zs[a2]) / 2.0, bond: i });
+        }
+        order.sort((a, b) => a.z - b.z);
+
+        const parts = [
+            `<svg version="1.1" width="${width}" height="${height}" viewBox="0 0 ${width} ${height}" ` +
+            'preserveAspectRatio="xMidYMid meet" xmlns="http://www.w3.org/2000/svg">' +
+            `<defs>${geometry.styles.defs}</defs>`
+        ];
+        order.forEach(item => {
+            if (item.bond === undefined) {
+                const i = item.atom;
+                const style = styles[geometry.elements[i]];
+                parts.push(
+                    `  <circle class="atom" data-atom-index="${i}" data-element="${style.code}" ` +
+                    `cx="${(xs[i] * scale + offsetX).toFixed(2)}" cy="${(ys[i] * scale + offsetY).toFixed(2)}" ` +
+                    `r="${style.radius}" fill="url(#${style.name === null ? 'None' : style.name})"/>\n`
+                );
+                return;
+            }
+
+            const i = item.bond;
+            const a1 = geometry.bonds[2 * i], a2 = geometry.bonds[2 * i + 1];
+            const len = Math.hypot(xs[a2] - xs[a1], ys[a2] - ys[a1]);
+            const dx = (xs[a2] - xs[a1]) / len, dy = (ys[a2] - ys[a1]) / len;
+            const x1 = xs[a1] * scale + offsetX, y1 = ys[a1] * scale + offsetY;
+            const x2 = xs[a2] * scale + offsetX, y2 = ys[a2] * scale + offsetY;
+            const points = [
+                [x1 + dy * 10, y1 - dx * 10], [x1 - dy * 10, y1 + dx * 10],
+                [x2 - dy * 10, y2 + dx * 10], [x2 + dy * 10, y2 - dx * 10]
+            ].map(p => `${p[0].toFixed(2)},${p[1].toFixed(2)}`).join(' ');
+            parts.push(
+                `  <polygon class="bond" data-bond-index="${i}" data-a1="${a1}" data-a2="${a2}" ` +
+                `data-epairs="${geometry.epairs[i]}" points="${points}" fill="#16a34a"/>\n`
+            );
+        });
+        parts.push('</svg>');
+        return parts.join('');
+    }
+
     function loadAnalytics(molName) {
         if (!molName) {
             setAnalyticsEmpty();
@@ -210,6 +578,125 @@ $(document).ready(function() {
                 setAnalyticsError();
             }
         });
+        loadSimilar(molName);
+    }
+
+    function loadSimilar(molName) {
+        $.getJSON('/search', { name: molName, k: 5 }, function(data) {
+            const list = $('#similar-list');
+            list.empty();
+            if (!data.results.length) {
+                list.text('-');
+                return;
+            }
+            data.results.forEach(match => {
+                $('<a class="similar-link"></a>')
+                    .text(`${match.name} (${match.score.toFixed(2)})`)
+                    .attr('data-name', match.name)
+                    .appendTo(list);
+            });
+        }).fail(function() {
+            $('#similar-list').text('error');
+        });
+    }
+
+    function loadTrajectory(molName) {
+        state.trajectory.info = null;
+        $('#trajectory-controls').prop('hidden', true);
+        $('#trajectory-frame').text('');
+        if (!molName) {
+            return;
+        }
+        $.getJSON(`/trajectories/${encodeURIComponent(molName)}`, function(info) {
+            if ($('#molecule-select').val() !== molName) {
+                return;
+            }
+            state.trajectory.info = info;
+            $('#trajectory-frame').text(`${info.frame_no} frames`);
+            $('#trajectory-controls').prop('hidden', false);
+        });
+    }
+
+    function playTrajectory() {
+        const info = state.trajectory.info;
+        if (!info || state.trajectory.source) {
+            return;
+        }
+
+        // Frames only carry coordinates, so playback draws them with the browser renderer.
+        $('#local-render-toggle').prop('checked', true);
+        loadGeometry(info.molecule).then(function() {
+            if (state.trajectory.info !== info || state.trajectory.source) {
+                return;
+            }
+            const source = new EventSource(
+                `/trajectories/${encodeURIComponent(info.name)}/stream?fps=${TRAJECTORY_FPS}&loop=1`
+            );
+            source.addEventListener('frame', function(e) {
+                const geometry = state.geometry.data;
+                const coords = decodeFrame(e.data);
+                if (!geometry || coords.length !== geometry.atomNo * 3) {
+                    return;
+                }
+                state.trajectory.coords = coords;
+                $('#trajectory-frame').text(`Frame ${Number(e.lastEventId) + 1} / ${info.frame_no}`);
+                // Draw at most once per animation frame if events arrive faster than the browser paints.
+                if (state.trajectory.frame === null) {
+                    state.trajectory.frame = requestAnimationFrame(function() {
+                        state.trajectory.frame = null;
+                        if (state.trajectory.source === source && state.geometry.data === geometry) {
+                            showSvg(renderLocal(playingGeometry(geometry)));
+                        }
+                    });
+                }
+            });
+            source.addEventListener('end', stopTrajectory);
+            source.onerror = function() {
+                // Refused (e.g. 503 when too many streams play) or dropped for good.
+                if (source.readyState === EventSource.CLOSED && state.trajectory.source === source) {
+                    stopTrajectory();
+                    $('#trajectory-frame').text('Playback unavailable');
+                }
+            };
+            state.trajectory.source = source;
+        }).catch(function() {
+            $('#trajectory-frame').text('Playback unavailable');
+        });
+    }
+
+    function playingGeometry(geometry) {
+        // The current frame drawn over the stored structure; the /geometry payload itself is left untouched.
+        const coords = state.trajectory.coords;
+        if (!coords || coords.length !== geometry.atomNo * 3) {
+            return geometry;
+        }
+        return Object.assign({}, geometry, { coords: coords });
+    }
+
+    function stopTrajectory() {
+        const shown = state.trajectory.coords !== null;
+        state.trajectory.coords = null;
+        if (state.trajectory.source) {
+            state.trajectory.source.close();
+            state.trajectory.source = null;
+        }
+        if (state.trajectory.frame !== null) {
+            cancelAnimationFrame(state.trajectory.frame);
+            state.trajectory.frame = null;
+        }
+        if (shown) {
+            requestDisplay();
+        }
+    }
+
+    function decodeFrame(data) {
+        // float32 little-endian x, y, z per atom, base64 encoded by send_trajectory() in server.py.
+        const binary = atob(data);
+        const bytes = new Uint8Array(binary.length);
+        for (let i = 0; i < binary.length; i++) {
+            bytes[i] = binary.charCodeAt(i);
+        }
+        return new Float32Array(bytes.buffer);
     }
 
     function setAnalyticsEmpty() {
@@ -219,6 +706,7 @@ $(document).ready(function() {
         $('#stat-bonds').text('-');
         $('#stat-elements').text('-');
         $('#stat-bond-orders').text('-');
+        $('#similar-list').text('-');
     }
 
     function setAnalyticsError() {
@@ -228,6 +716,7 @@ $(document).ready(function() {
         $('#stat-bonds').text('error');
         $('#stat-elements').text('error');
         $('#stat-bond-orders').text('error');
+        $('#similar-list').text('error');
     }
 
     function formatCounts(counts) {
@@ -295,6 +784,10 @@ $(document).ready(function() {
 
         const atoms = svg.find('.atom');
         const bonds = svg.find('.bond');
+        if (atoms.length + bonds.length > PICK_LIMIT || svg.find('.bond-lod').length) {
+            bindPicking(svg);
+            return;
+        }
         const atomElementByIndex = {};
 
         atoms.each(function() {
@@ -341,6 +834,77 @@ $(document).ready(function() {
         });
     }
 
+    function bindPicking(svg) {
+        // Large renders: ask the server's spatial index what is under the cursor instead of
+        // relying on DOM hit-testing across thousands of nodes. One hover request is in flight
+        // at a time; only the newest mouse position is sent next.
+        const pick = { inFlight: false, next: null, hovering: false };
+
+        function requestPick(e, onResult) {
+            const point = svg[0].createSVGPoint();
+            point.x = e.clientX;
+            point.y = e.clientY;
+            const canvas = point.matrixTransform(svg[0].getScreenCTM().inverse());
+            return $.ajax({
+                type: 'POST',
+                url: '/pick',
+                data: {
+                    name: $('#molecule-select').val(),
+                    phi_x: Math.round(state.rotation.x),
+                    phi_y: Math.round(state.rotation.y),
+                    phi_z: Math.round(state.rotation.z),
+                    x: canvas.x,
+                    y: canvas.y
+                },
+                dataType: 'json',
+                success: onResult
+            });
+        }
+
+        function sendHover() {
+            const e = pick.next;
+            pick.next = null;
+            pick.inFlight = true;
+            requestPick(e, function(hit) {
+                if (!pick.hovering || !hit.kind) {
+                    hideTooltip();
+                } else if (hit.kind === 'atom') {
+                    showTooltip(e, `Atom ${hit.index + 1}: ${hit.element}`);
+                } else {
+                    showTooltip(e, `Bond ${hit.index + 1}: ${hit.elements[0]}${hit.a1 + 1} - ${hit.elements[1]}${hit.a2 + 1} (Order ${hit.epairs})`);
+                }
+            }).always(function() {
+                pick.inFlight = false;
+                if (pick.next) {
+                    sendHover();
+                }
+            });
+        }
+
+        svg.on('mousemove', function(e) {
+            if (state.drag.active) return;
+            pick.hovering = true;
+            pick.next = e;
+            if (!pick.inFlight) {
+                sendHover();
+            }
+        }).on('mouseleave', function() {
+            pick.hovering = false;
+            pick.next = null;
+            hideTooltip();
+        }).on('click', function(e) {
+            if (state.drag.moved) return;
+            requestPick(e, function(hit) {
+                if (hit.kind === 'atom') {
+                    state.selectedAtomIndex = (state.selectedAtomIndex === hit.index) ? null : hit.index;
+                } else {
+                    state.selectedAtomIndex = null;
+                }
+                applySelection();
+            });
+        });
+    }
+
     function applySelection() {
         const svg = $('#svg-container svg');
         const atoms = svg.find('.atom');
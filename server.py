@@ -1,77 +1,886 @@
 from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, OrderedDict
+import argparse
+import base64
+import email.message
+import email.parser
+import email.utils
+import gzip
+import hashlib
+import math
+import threading
+import time
 import sys
-import io
 import urllib
 import json
+import zlib
 import os
-import cgi
+import struct
+import tempfile
+from array import array
+import metrics
 import molsql
+import molimport
 import MolDisplay
+import thumbnail
+import trajectory
 
 # Publicly accessible files
 public_files = ['/index.html', '/script.js', '/style.css']
 
-# Initialize Database
-db = molsql.Database(reset=False)
-db.create_tables()
+CONTENT_TYPES = {'.html': 'text/html', '.js': 'application/javascript', '.css': 'text/css'}
 
-ATOMIC_MASS = {
-    "H": 1.008, "He": 4.0026, "Li": 6.94, "Be": 9.0122, "B": 10.81, "C": 12.011,
-    "N": 14.007, "O": 15.999, "F": 18.998, "Ne": 20.180, "Na": 22.990, "Mg": 24.305,
-    "Al": 26.982, "Si": 28.085, "P": 30.974, "S": 32.06, "Cl": 35.45, "Ar": 39.948,
-    "K": 39.098, "Ca": 40.078, "Br": 79.904, "I": 126.90
+# Bodies smaller than this are not worth a gzip round trip.
+GZIP_MIN_SIZE = 256
+
+# Initialize Database; request handlers each get their worker thread's own connection.
+startup_db = molsql.Database(reset=False)
+startup_db.create_tables()
+startup_db.migrate_geometry()
+startup_db.backfill_derived()
+pool = molsql.DatabasePool()
+
+def encode_geometry(mol, styles):
+    # Compact little-endian payload for client-side rendering:
+    #   'MVG1', uint32 atom_no, uint32 bond_no, uint32 style JSON length (padded to 4 bytes),
+    #   style JSON, float32 xyz[atom_no * 3], uint32 a1/a2[bond_no * 2],
+    #   uint16 element index[atom_no], uint8 epairs[bond_no]
+    elements, coords, bonds = mol.pack()
+
+    codes = []
+    code_index = {}
+    element_index = array('H')
+    for i in range(0, len(elements), 3):
+        code = elements[i:i + 3].rstrip(b'\0').decode('ascii', errors='replace')
+        if code not in code_index:
+            code_index[code] = len(codes)
+            codes.append(code)
+        element_index.append(code_index[code])
+
+    xyz = array('f', array('d', coords))
+    triples = array('I', bonds)
+    pairs = array('I', [0]) * (2 * mol.bond_no)
+    pairs[0::2] = triples[0::3]
+    pairs[1::2] = triples[1::3]
+    epairs = array('B', triples[2::3]).tobytes()
+
+    if sys.byteorder == 'big':
+        for data in (xyz, pairs, element_index):
+            data.byteswap()
+
+    style_json = json.dumps({
+        "elements": [
+            {"code": code, "name": styles.element_name.get(code), "radius": styles.radius.get(code, 0)}
+            for code in codes
+        ],
+        "defs": styles.defs(set(codes)),
+    }).encode('utf-8')
+    style_json += b' ' * (-len(style_json) % 4)
+
+    return b''.join([
+        b'MVG1', struct.pack('<III', mol.atom_no, mol.bond_no, len(style_json)), style_json,
+        xyz.tobytes(), pairs.tobytes(), element_index.tobytes(), epairs,
+    ])
+
+class Payload:
+    # A response body with its strong validator and, when it pays off, a gzip-encoded copy.
+    # The ETag hashes the bytes, so identical bodies keep their tag across restarts. A version
+    # (e.g. the database generation a frame was rendered at) is prefixed to it when given.
+
+    def __init__(self, body, content_type, last_modified=None, version=None):
+        self.body = body
+        self.content_type = content_type
+        self.last_modified = last_modified
+        digest = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.etag = '"%s"' % (digest if version is None else f"{version}-{digest}")
+        self.gzipped = None
+        if len(body) >= GZIP_MIN_SIZE:
+            with metrics.timed('gzip'):
+                gzipped = gzip.compress(body, compresslevel=6, mtime=0)
+            if len(gzipped) < len(body):
+                self.gzipped = gzipped
+
+    @property
+    def size(self):
+        return len(self.body) + (len(self.gzipped) if self.gzipped is not None else 0)
+
+class StaticFiles:
+    # Public files preloaded into memory; a file is re-read only when its mtime changes,
+    # and its mtime is checked at most once per check_interval seconds.
+
+    def __init__(self, paths, check_interval=1.0):
+        self.check_interval = check_interval
+        self.files = {path: None for path in paths}
+        self.lock = threading.Lock()
+        for path in paths:
+            self.get(path)
+
+    def get(self, path):
+        if path not in self.files:
+            return None
+
+        now = time.monotonic()
+        with self.lock:
+            entry = self.files[path]
+        if entry is not None and now - entry[0] < self.check_interval:
+            return entry[2]
+
+        file_path = path[1:]
+        try:
+            mtime = os.stat(file_path).st_mtime_ns
+            if entry is not None and entry[1] == mtime:
+                payload = entry[2]
+            else:
+                with open(file_path, 'rb') as f:
+                    content = f.read()
+                content_type = CONTENT_TYPES.get(os.path.splitext(file_path)[1], 'application/octet-stream')
+                payload = Payload(content, content_type, last_modified=mtime // 1000000000)
+        except OSError:
+            payload = None
+            mtime = None
+
+        with self.lock:
+            self.files[path] = (now, mtime, payload) if payload is not None else None
+        return payload
+
+
+static_files = StaticFiles(public_files)
+
+class FrameCache:
+    # Rendered /display bodies keyed by (name, molecule generation, style version, angles).
+    # Writes from any process bump the generation stored in the database (Database.generation),
+    # and style edits bump the style version, so stale frames are never looked up again and
+    # simply age out. Bounded by total body size with LRU eviction.
+
+    def __init__(self, budget=64 * 1024 * 1024):
+        self.budget = budget
+        self.size = 0
+        self.entries = OrderedDict()
+        self.views = Counter()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            frame = self.entries.get(key)
+            if frame is not None:
+                self.entries.move_to_end(key)
+            return frame
+
+    def put(self, key, body, version=None):
+        frame = Payload(body, 'image/svg+xml', version=version)
+        if frame.size > self.budget:
+            return frame
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            self.entries[key] = frame
+            self.size += frame.size
+            while self.size > self.budget:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.size
+        return frame
+
+    def viewed(self, name, lod=False):
+        with self.lock:
+            self.views[(name, lod)] += 1
+
+    def most_viewed(self, count):
+        # (name, lod) pairs, as requested by clients.
+        with self.lock:
+            return [view for view, _ in self.views.most_common(count)]
+
+
+frame_cache = FrameCache()
+metrics.registry.gauge('molview_frame_cache_bytes', "Bytes held by the /display frame cache", lambda: frame_cache.size)
+metrics.registry.gauge('molview_frame_cache_entries', "Frames held by the /display frame cache", lambda: len(frame_cache.entries))
+
+# Degrees to snap /display angles to before rendering and caching; 0 renders exact angles.
+angle_step = 0
+
+def finite_floats(params, names):
+    # Parsed query or form values, 0 when absent. float() also accepts nan and inf, which no angle
+    # or canvas position can be, so those raise ValueError like any other malformed number.
+    values = [float(params.get(name, [0])[0]) for name in names]
+    if not all(math.isfinite(value) for value in values):
+        raise ValueError("Expected finite numbers")
+    return values
+
+def quantize_angle(angle):
+    if not angle_step:
+        return angle
+    return (round(angle / angle_step) * angle_step) % 360
+
+# Molecules with more atoms + bonds than this are streamed by /display instead of cached.
+stream_threshold = 20000
+
+# Level-of-detail rendering for /display?lod=1 on molecules with more atoms + bonds than lod_threshold.
+lod_threshold = 5000
+lod_options = MolDisplay.LevelOfDetail(budget=10000, merge_far=0.25)
+
+class RenderSessions:
+    # Recent MolDisplay.RenderSessions, so consecutive /display frames of a dragged molecule repair
+    # the previous frame's depth order instead of sorting from scratch. Each session renders one
+    # frame at a time; a request that finds it busy renders on its own instead of waiting.
+
+    def __init__(self, size=8):
+        self.size = size
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.sessions.get(key)
+            if entry is not None:
+                self.sessions.move_to_end(key)
+            return entry
+
+    def add(self, key, session):
+        with self.lock:
+            entry = self.sessions.setdefault(key, (threading.Lock(), session))
+            self.sessions.move_to_end(key)
+            while len(self.sessions) > self.size:
+                self.sessions.popitem(last=False)
+            return entry
+
+render_sessions = RenderSessions()
+
+def frame_cacheable(size, lod):
+    # Whether /display caches frames of a molecule with this many atoms + bonds: those above
+    # stream_threshold are streamed unless a level-of-detail render keeps them small.
+    return size <= stream_threshold or (lod and size > lod_threshold)
+
+def display_frame(db, name, phi_x, phi_y, phi_z, stream=False, lod=False):
+    # Returns the SVG Payload, rendering only on a cache miss. Raises ValueError for unknown molecules.
+    # With stream=True, molecules above stream_threshold come back as an SVG chunk generator instead.
+    # With lod=True, molecules above lod_threshold get a culled, budgeted render (see LevelOfDetail).
+    # Full renders of molecules above stream_threshold never enter a RenderSession or the frame cache.
+    angles = (quantize_angle(phi_x), quantize_angle(phi_y), quantize_angle(phi_z))
+    # Read the generation before loading so a concurrent write can only make this key stale.
+    generation = db.generation()
+    styles = db.element_styles()
+    key = (name, generation, styles.version, angles, lod)
+
+    frame = frame_cache.get(key)
+    metrics.note('frame_cache', 'hit' if frame is not None else 'miss')
+    metrics.cache_lookups.inc('frame', 'hit' if frame is not None else 'miss')
+    if frame is None:
+        # Sized before any session is looked up, so a session made for some other request can never
+        # turn a streamed molecule into a cached one.
+        size = db.molecule_size(name)
+        simplified = lod and size > lod_threshold
+        if not frame_cacheable(size, lod):
+            mol = db.load_mol(name)
+            mol.rotate(*angles)
+            if stream:
+                return mol.svg_chunks(styles.render_context())
+            return Payload(mol.svg(styles.render_context()).encode('utf-8'), 'image/svg+xml', version=generation)
+
+        session_key = (name, generation, styles.version, lod)
+        entry = render_sessions.get(session_key)
+        metrics.cache_lookups.inc('session', 'hit' if entry is not None else 'miss')
+        if entry is None:
+            context = styles.render_context(lod=lod_options) if simplified else styles.render_context()
+            entry = render_sessions.add(session_key, MolDisplay.RenderSession(db.load_mol(name), context))
+
+        lock, session = entry
+        if lock.acquire(blocking=False):
+            try:
+                svg = session.svg(*angles)
+            finally:
+                lock.release()
+        else:
+            mol = db.load_mol(name)
+            mol.rotate(*angles)
+            svg = mol.svg(session.context)
+        frame = frame_cache.put(key, svg.encode('utf-8'), version=generation)
+    return frame
+
+def pick_frame(db, name, phi_x, phi_y, phi_z, x, y):
+    # (rotated molecule, hit) for canvas point (x, y) of the /display frame at these angles.
+    # Raises ValueError for unknown molecules.
+    angles = (quantize_angle(phi_x), quantize_angle(phi_y), quantize_angle(phi_z))
+    generation = db.generation()
+    styles = db.element_styles()
+
+    # Clicks on the current frame of a session /display already keeps reuse its rotation and pick
+    # grid. Picking never starts a session: hovering must not pin a large molecule in memory.
+    for lod in (False, True):
+        entry = render_sessions.get((name, generation, styles.version, lod))
+        if entry is not None:
+            lock, session = entry
+            if lock.acquire(blocking=False):
+                try:
+                    return session.pick_at(x, y, *angles)
+                finally:
+                    lock.release()
+            break
+    mol = db.load_mol(name)
+    mol.rotate(*angles)
+    return mol, mol.pick_at(styles.render_context(), x, y)
+
+def warm_frames(top, interval=60):
+    # Background job: pre-render an x/y angle grid for the most viewed molecules, with the lod
+    # setting clients asked for. Grid points land on the quantization step so warmed frames are the
+    # ones clients hit; molecules that are streamed instead of cached are skipped.
+    db = pool.get()
+    step = angle_step * max(1, round(30 / angle_step)) if angle_step else 30
+    grid = [(x, y, 0) for x in range(0, 360, step) for y in range(0, 360, step)]
+    while True:
+        for name, lod in frame_cache.most_viewed(top):
+            try:
+                if not frame_cacheable(db.molecule_size(name), lod):
+                    continue
+                for angles in grid:
+                    display_frame(db, name, *angles, lod=lod)
+            except ValueError:
+                continue
+        time.sleep(interval)
+
+# Uploads are parsed and stored in the background; /upload only spools the file to disk.
+ingest_queue = molimport.IngestQueue(pool.get, workers=0)
+
+# Gallery thumbnails live on disk under content-derived keys; see thumbnail.py.
+thumbnail_cache = thumbnail.ThumbnailCache()
+thumbnail_builder = thumbnail.ThumbnailBuilder(pool.get, thumbnail_cache, workers=0)
+
+# Each trajectory stream holds a worker thread for as long as it plays, so only a few may run at once.
+trajectory_streams = threading.BoundedSemaphore(4)
+MAX_STREAM_FPS = 60
+
+# Largest non-file form field accepted in a multipart upload.
+FORM_FIELD_LIMIT = 64 * 1024
+
+def read_multipart(rfile, length, content_type, file_field, spool, chunk_size=64 * 1024):
+    # Stream a multipart/form-data body. The part named file_field is copied into spool as it
+    # arrives; other fields are returned as strings. Memory stays at about one chunk.
+    header = email.message.Message()
+    header['Content-Type'] = content_type
+    boundary = header.get_param('boundary')
+    if not boundary:
+        raise ValueError("Missing multipart boundary")
+
+    # Treat the body as if it began with CRLF so every delimiter, including the first, looks the same.
+    delimiter = b'\r\n--' + boundary.encode('latin-1')
+    remaining = length
+    buffer = b'\r\n'
+
+    def fill():
+        nonlocal remaining, buffer
+        if remaining <= 0:
+            raise ValueError("Multipart body ended early")
+        data = rfile.read(min(chunk_size, remaining))
+        if not data:
+            raise ValueError("Multipart body ended early")
+        remaining -= len(data)
+        buffer += data
+
+    def read_until(marker, sink, limit=None):
+        # Pass everything before marker to sink and drop the marker itself.
+        nonlocal buffer
+        written = 0
+        while True:
+            index = buffer.find(marker)
+            if index >= 0:
+                data, buffer = buffer[:index], buffer[index + len(marker):]
+            else:
+                keep = len(marker) - 1
+                data, buffer = buffer[:len(buffer) - keep], buffer[len(buffer) - keep:]
+            if sink is not None and data:
+                written += len(data)
+                if limit is not None and written > limit:
+                    raise ValueError("Form field too large")
+                sink(data)
+            if index >= 0:
+                return
+            fill()
+
+    fields = {}
+    file_size = None
+    read_until(delimiter, None)
+    while True:
+        while len(buffer) < 2:
+            fill()
+        if buffer.startswith(b'--'):
+            break
+        read_until(b'\r\n', None)
+
+        headers = []
+        read_until(b'\r\n\r\n', headers.append, limit=FORM_FIELD_LIMIT)
+        part = email.parser.BytesHeaderParser().parsebytes(b''.join(headers) + b'\r\n\r\n')
+        name = part.get_param('name', header='content-disposition')
+
+        if name == file_field and file_size is None:
+            start = spool.tell()
+            read_until(delimiter, spool.write)
+            file_size = spool.tell() - start
+        else:
+            value = []
+            read_until(delimiter, value.append, limit=FORM_FIELD_LIMIT)
+            if name is not None:
+                fields[name] = b''.join(value).decode('utf-8', errors='replace')
+
+    # Drain any epilogue so the connection stays usable.
+    while remaining > 0:
+        data = rfile.read(min(chunk_size, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+    return fields, file_size
+
+
+# Route labels for /metrics; other paths share 'other' so stray URLs cannot add series.
+METRIC_ROUTES = set(public_files) | {
+    '/', '/molecules', '/search', '/elements', '/display', '/geometry', '/pick', '/analyze', '/add',
+    '/upload', '/thumbnail', '/thumbnails', '/trajectories', '/metrics',
 }
 
-def make_formula(atom_counts):
-    if not atom_counts:
-        return ""
+def route_label(path):
+    path = urllib.parse.urlsplit(path).path
+    if path in METRIC_ROUTES:
+        return path
+    if path.startswith('/jobs/'):
+        return '/jobs/<id>'
+    if path.startswith('/trajectories/'):
+        return '/trajectories/<name>/stream' if path.endswith('/stream') else '/trajectories/<name>'
+    return 'other'
+
+request_seconds = metrics.registry.histogram(
+    'molview_request_duration_seconds', "Request handling time, including writing the body", metrics.LATENCY_BUCKETS,
+    ('method', 'route')
+)
+requests_total = metrics.registry.counter('molview_requests_total', "Requests by response status", ('method', 'route', 'status'))
+response_size = metrics.registry.histogram(
+    'molview_response_size_bytes', "Bytes sent per response, headers included", metrics.SIZE_BUCKETS, ('route',)
+)
+bytes_out = metrics.registry.counter('molview_response_bytes_total', "Bytes sent, headers included", ('route',))
+
+class MeteredWriter:
+    # Wraps a handler's wfile to count the bytes sent and time the socket writes.
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.sent = 0
+
+    def write(self, data):
+        with metrics.timed('write'):
+            written = self.raw.write(data)
+        self.sent += len(data)
+        return written
 
-    parts = []
-    if "C" in atom_counts:
-        count = atom_counts["C"]
-        parts.append("C" if count == 1 else f"C{count}")
-    if "H" in atom_counts:
-        count = atom_counts["H"]
-        parts.append("H" if count == 1 else f"H{count}")
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
 
-    for element in sorted(k for k in atom_counts if k not in ("C", "H")):
-        count = atom_counts[element]
-        parts.append(element if count == 1 else f"{element}{count}")
+class PooledHTTPServer(ThreadingMixIn, HTTPServer):
+    # Hands each connection to a fixed pool of worker threads so a slow /upload
+    # cannot stall /display, while keeping one SQLite connection per worker.
+    daemon_threads = True
+    request_queue_size = 128
 
-    return "".join(parts)
+    def __init__(self, server_address, handler_class, workers=8):
+        super().__init__(server_address, handler_class)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='molview')
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
 
 class Server(BaseHTTPRequestHandler):
+    def setup(self):
+        super().setup()
+        self.wfile = MeteredWriter(self.wfile)
+
+    def handle_one_request(self):
+        # Stages timed while the request runs end up in its Server-Timing header and in /metrics.
+        self.status = None
+        sent = self.wfile.sent
+        timing = metrics.begin()
+        try:
+            super().handle_one_request()
+        finally:
+            metrics.end()
+            if self.status is not None:
+                method = self.command or '-'
+                route = route_label(getattr(self, 'path', ''))
+                size = self.wfile.sent - sent
+                request_seconds.observe(timing.elapsed, method, route)
+                requests_total.inc(method, route, str(self.status))
+                response_size.observe(size, route)
+                bytes_out.inc(route, amount=size)
+
+    def send_response(self, code, message=None):
+        self.status = code
+        super().send_response(code, message)
+
+    def end_headers(self):
+        timing = metrics.current()
+        if timing is not None:
+            self.send_header('Server-Timing', timing.header())
+        super().end_headers()
+
+    def accepts_gzip(self):
+        for item in self.headers.get('Accept-Encoding', '').split(','):
+            coding, _, params = item.partition(';')
+            if coding.strip().lower() in ('gzip', 'x-gzip', '*'):
+                params = params.strip().replace(' ', '')
+                try:
+                    return not params.startswith('q=') or float(params[2:]) > 0
+                except ValueError:
+                    return False
+        return False
+
+    def not_modified(self, etag, last_modified):
+        # If-None-Match wins over If-Modified-Since when both are sent.
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [t.strip() for t in if_none_match.split(',')]
+            return etag in tags or '*' in tags
+
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since and last_modified is not None:
+            try:
+                return last_modified <= email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def send_payload(self, payload, cache_control='no-cache'):
+        # Picks the gzip or identity representation; each gets its own strong ETag.
+        body = payload.body
+        etag = payload.etag
+        if payload.gzipped is not None and self.accepts_gzip():
+            body = payload.gzipped
+            etag = etag[:-1] + '-gzip"'
+
+        not_modified = self.not_modified(etag, payload.last_modified)
+        self.send_response(304 if not_modified else 200)
+        if not not_modified:
+            self.send_header('Content-type', payload.content_type)
+            self.send_header('Content-length', len(body))
+            if body is payload.gzipped:
+                self.send_header('Content-Encoding', 'gzip')
+        self.send_header('ETag', etag)
+        if payload.last_modified is not None:
+            self.send_header('Last-Modified', email.utils.formatdate(payload.last_modified, usegmt=True))
+        self.send_header('Cache-Control', cache_control)
+        if payload.gzipped is not None:
+            self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        if not not_modified:
+            self.wfile.write(body)
+
+    def send_stream(self, chunks, content_type):
+        # Write the body as it is produced: chunked for HTTP/1.1 clients, close-delimited for
+        # HTTP/1.0. Streamed bodies are not cached, so gzip runs through a single compressor.
+        chunked = self.request_version == 'HTTP/1.1'
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if self.accepts_gzip() else None
+        if chunked:
+            self.protocol_version = 'HTTP/1.1'
+
+        self.send_response(200)
+        self.send_header('Content-type', content_type)
+        self.send_header('Cache-Control', 'no-store')
+        if compressor is not None:
+            self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Vary', 'Accept-Encoding')
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+        def write(data):
+            if not data:
+                return
+            if chunked:
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            else:
+                self.wfile.write(data)
+
+        for chunk in chunks:
+            data = chunk.encode('utf-8')
+            write(compressor.compress(data) if compressor is not None else data)
+        if compressor is not None:
+            write(compressor.flush())
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    def send_trajectory(self, db, name, params):
+        # Server-sent events: an 'info' event, one 'frame' event per frame (base64 float32 little-endian
+        # x, y, z per atom) paced to `fps`, then 'end'. Frames are decoded a window at a time from the
+        # database, so a stream's memory does not depend on the trajectory's length.
+        try:
+            fps = min(MAX_STREAM_FPS, max(1.0, float(params.get('fps', [10])[0])))
+            start = max(0, int(params.get('start', [0])[0]))
+            # EventSource reconnects resume after the last frame the client saw.
+            last_event = self.headers.get('Last-Event-ID')
+            if last_event:
+                start = int(last_event) + 1
+        except ValueError:
+            self.send_error(400, "Invalid stream parameters")
+            return
+        loop = params.get('loop', ['0'])[0] == '1'
+
+        try:
+            reader = trajectory.TrajectoryReader(db, name)
+        except ValueError as e:
+            self.send_error(404, str(e))
+            return
+
+        if not trajectory_streams.acquire(blocking=False):
+            self.send_error(503, "Too many trajectory streams")
+            return
+        try:
+            self.send_response(200)
+            self.send_header('Content-type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-store')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+
+            info = {key: value for key, value in reader.info.items() if key != 'id'}
+            info.update(fps=fps, start=start, loop=loop)
+            self.wfile.write(f"event: info\ndata: {json.dumps(info)}\n\n".encode('utf-8'))
+
+            interval = 1.0 / fps
+            deadline = time.monotonic()
+            while True:
+                for index, coords in reader.frames(start):
+                    xyz = array('f', coords)
+                    if sys.byteorder == 'big':
+                        xyz.byteswap()
+                    data = base64.b64encode(xyz.tobytes()).decode('ascii')
+                    self.wfile.write(f"id: {index}\nevent: frame\ndata: {data}\n\n".encode('ascii'))
+
+                    deadline += interval
+                    delay = deadline - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    else:
+                        # Behind schedule (slow client or disk): carry on from now instead of bursting.
+                        deadline = time.monotonic()
+                if not loop or reader.info['frame_no'] == 0:
+                    break
+                start = 0
+            self.wfile.write(b"event: end\ndata: {}\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            trajectory_streams.release()
+
+    def send_display(self, db, params):
+        mol_name = params.get('name', [None])[0]
+        if not mol_name:
+            self.send_error(400, "Molecule name required")
+            return
+
+        try:
+            phi_x, phi_y, phi_z = finite_floats(params, ('phi_x', 'phi_y', 'phi_z'))
+        except ValueError:
+            self.send_error(400, "Invalid rotation angles")
+            return
+
+        try:
+            lod = params.get('lod', ['0'])[0] == '1'
+            frame = display_frame(db, mol_name, phi_x, phi_y, phi_z, stream=True, lod=lod)
+        except ValueError as e:
+            self.send_error(404, str(e))
+            return
+        frame_cache.viewed(mol_name, lod)
+
+        if isinstance(frame, Payload):
+            self.send_payload(frame)
+        else:
+            self.send_stream(frame, 'image/svg+xml')
+
+    def receive_upload(self, content_length):
+        content_type = self.headers.get('Content-Type', '')
+        if not content_type.startswith('multipart/form-data'):
+            self.send_error(400, "Expected multipart/form-data")
+            return
+
+        spool = tempfile.TemporaryFile()
+        try:
+            fields, file_size = read_multipart(self.rfile, content_length, content_type, 'sdf_file', spool)
+        except Exception as e:
+            spool.close()
+            self.close_connection = True
+            self.send_error(400, str(e))
+            return
+
+        mol_name = fields.get('molname', '').strip()
+        if not mol_name:
+            spool.close()
+            self.send_error(400, "Missing molecule name")
+            return
+        if file_size is None:
+            spool.close()
+            self.send_error(400, "Missing SDF file")
+            return
+
+        library = fields.get('library', '') == '1'
+        try:
+            job = ingest_queue.submit(mol_name, spool, file_size, library)
+        except:
+            spool.close()
+            raise
+        self.send_response(202)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Location', f'/jobs/{job.id}')
+        self.end_headers()
+        self.wfile.write(json.dumps({'status': 'queued', 'name': mol_name, 'library': library, 'job': job.id}).encode('utf-8'))
+
     def do_GET(self):
+        db = pool.get()
+        url = urllib.parse.urlsplit(self.path)
+
         if self.path == '/':
             self.path = '/index.html'
 
         if self.path in public_files:
-            file_path = self.path[1:]
-            if os.path.exists(file_path):
-                self.send_response(200)
-                if file_path.endswith('.html'):
-                    self.send_header('Content-type', 'text/html')
-                elif file_path.endswith('.js'):
-                    self.send_header('Content-type', 'application/javascript')
-                elif file_path.endswith('.css'):
-                    self.send_header('Content-type', 'text/css')
-                
-                with open(file_path, 'rb') as f:
-                    content = f.read()
-                self.send_header('Content-length', len(content))
-                self.end_headers()
-                self.wfile.write(content)
+            # Served from memory; revalidated with ETag / Last-Modified.
+            payload = static_files.get(self.path)
+            if payload is not None:
+                self.send_payload(payload)
             else:
                 self.send_error(404, 'File Not Found')
         
-        elif self.path == '/molecules':
-            # List all molecules
-            molecules = db.cursor.execute("SELECT NAME FROM Molecules").fetchall()
-            molecule_list = [row[0] for row in molecules]
+        elif url.path == '/molecules':
+            # One page of the library, filtered and sorted from MoleculeDescriptors.
+            params = urllib.parse.parse_qs(url.query)
+
+            def number(key, kind, default=None):
+                value = params.get(key, [None])[0]
+                return kind(value) if value not in (None, '') else default
+
+            try:
+                offset = max(0, number('offset', int, 0))
+                limit = min(1000, max(1, number('limit', int, 100)))
+                total, molecules = db.list_molecules(
+                    offset, limit,
+                    sort=params.get('sort', ['name'])[0],
+                    descending=params.get('order', ['asc'])[0] == 'desc',
+                    formula=params.get('formula', [None])[0],
+                    min_atoms=number('min_atoms', int),
+                    max_atoms=number('max_atoms', int),
+                    min_mass=number('min_mass', float),
+                    max_mass=number('max_mass', float),
+                )
+            except ValueError:
+                self.send_error(400, "Invalid listing parameters")
+                return
+
+            response = {"total": total, "offset": offset, "limit": limit, "molecules": molecules}
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(response).encode('utf-8'))
+
+        elif url.path.startswith('/jobs/'):
+            # Progress of a background upload started by POST /upload.
+            job = ingest_queue.get(url.path[len('/jobs/'):])
+            if job is None:
+                self.send_error(404, "Unknown job")
+                return
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.send_header('Cache-Control', 'no-store')
+            self.end_headers()
+            self.wfile.write(json.dumps(job.as_dict()).encode('utf-8'))
+
+        elif url.path == '/search':
+            # Top-k most similar stored molecules by fingerprint Tanimoto score.
+            params = urllib.parse.parse_qs(url.query)
+            mol_name = params.get('name', [None])[0]
+            if not mol_name:
+                self.send_error(400, "Molecule name required")
+                return
+
+            try:
+                k = min(100, max(1, int(params.get('k', [10])[0])))
+                min_score = float(params.get('min_score', [0])[0])
+            except ValueError:
+                self.send_error(400, "Invalid search parameters")
+                return
+
+            try:
+                query = db.fingerprint(mol_name)
+            except ValueError as e:
+                self.send_error(404, str(e))
+                return
+
+            matches, scored = db.search_similar(query, k, min_score, exclude=mol_name)
+            response = {
+                "name": mol_name,
+                "results": [{"name": name, "score": round(score, 4)} for score, name in matches],
+                "scored": scored,
+            }
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(response).encode('utf-8'))
+
+        elif url.path == '/metrics':
+            body = metrics.registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-length', len(body))
+            self.send_header('Cache-Control', 'no-store')
+            self.end_headers()
+            self.wfile.write(body)
+
+        elif url.path == '/thumbnail':
+            # A molecule's gallery thumbnail, served from the disk cache and rendered there on a miss.
+            mol_name = urllib.parse.parse_qs(url.query).get('name', [None])[0]
+            if not mol_name:
+                self.send_error(400, "Molecule name required")
+                return
+            try:
+                _, body = thumbnail.cached_thumbnail(db, mol_name, thumbnail_cache)
+            except ValueError as e:
+                self.send_error(404, str(e))
+                return
+            self.send_payload(Payload(body, 'image/svg+xml'))
+
+        elif url.path == '/thumbnails':
+            # Progress of the last background rebuild started by POST /thumbnails.
+            stats = thumbnail_builder.stats
+            response = stats.as_dict() if stats is not None else {"state": "idle"}
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.send_header('Cache-Control', 'no-store')
+            self.end_headers()
+            self.wfile.write(json.dumps(response).encode('utf-8'))
+
+        elif url.path == '/trajectories':
+            trajectories = [
+                {key: value for key, value in info.items() if key != 'id'} for info in db.trajectories()
+            ]
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(trajectories).encode('utf-8'))
+
+        elif url.path.startswith('/trajectories/'):
+            # /trajectories/<name> describes a trajectory; /trajectories/<name>/stream plays it.
+            name = urllib.parse.unquote(url.path[len('/trajectories/'):])
+            if name.endswith('/stream'):
+                self.send_trajectory(db, name[:-len('/stream')], urllib.parse.parse_qs(url.query))
+                return
+            try:
+                info = db.trajectory(name)
+            except ValueError as e:
+                self.send_error(404, str(e))
+                return
+            del info['id']
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
             self.end_headers()
-            self.wfile.write(json.dumps(molecule_list).encode('utf-8'))
+            self.wfile.write(json.dumps(info).encode('utf-8'))
 
         elif self.path == '/elements':
             # List all elements
@@ -81,11 +890,20 @@ class Server(BaseHTTPRequestHandler):
             self.end_headers()
             self.wfile.write(json.dumps(elements).encode('utf-8'))
 
+        elif url.path == '/display':
+            # Same as POST /display, but browsers keep the result and revalidate it with If-None-Match.
+            self.send_display(db, urllib.parse.parse_qs(url.query))
+
         else:
             self.send_error(404, 'Not Found')
 
     def do_POST(self):
+        db = pool.get()
         content_length = int(self.headers.get('Content-Length', 0))
+        if self.path == '/upload':
+            # Streamed straight to disk instead of being read into memory like the small form posts below.
+            self.receive_upload(content_length)
+            return
         body = self.rfile.read(content_length)
 
         if self.path == '/add':
@@ -108,75 +926,76 @@ class Server(BaseHTTPRequestHandler):
             except Exception as e:
                 self.send_error(400, str(e))
 
-        elif self.path == '/upload':
-            try:
-                content_type = self.headers.get('Content-Type', '')
-                if not content_type.startswith('multipart/form-data'):
-                    self.send_error(400, "Expected multipart/form-data")
-                    return
-
-                form = cgi.FieldStorage(
-                    fp=io.BytesIO(body),
-                    headers=self.headers,
-                    environ={
-                        "REQUEST_METHOD": "POST",
-                        "CONTENT_TYPE": content_type,
-                    },
-                )
+        elif self.path == '/display':
+            # Get SVG for a molecule with rotation; repeated frames come from the frame cache.
+            self.send_display(db, urllib.parse.parse_qs(body.decode('utf-8')))
 
-                mol_name = form.getfirst('molname', '').strip()
-                if not mol_name:
-                    self.send_error(400, "Missing molecule name")
-                    return
+        elif self.path == '/geometry':
+            # Raw geometry for the browser to rotate and draw locally; fetched once per selection.
+            postvars = urllib.parse.parse_qs(body.decode('utf-8'))
+            mol_name = postvars.get('name', [None])[0]
+            if not mol_name:
+                self.send_error(400, "Molecule name required")
+                return
 
-                if 'sdf_file' not in form or not getattr(form['sdf_file'], 'file', None):
-                    self.send_error(400, "Missing SDF file")
-                    return
+            try:
+                mol = db.load_mol(mol_name)
+            except ValueError as e:
+                self.send_error(404, str(e))
+                return
 
-                sdf_content = form['sdf_file'].file.read().decode('utf-8', errors='replace')
-                db.add_molecule(mol_name, io.StringIO(sdf_content))
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({'status': 'success', 'name': mol_name}).encode('utf-8'))
-            except Exception as e:
-                self.send_error(500, str(e))
+            payload = encode_geometry(mol, db.element_styles())
+            self.send_response(200)
+            self.send_header('Content-type', 'application/octet-stream')
+            self.send_header('Content-length', len(payload))
+            self.end_headers()
+            self.wfile.write(payload)
 
-        elif self.path == '/display':
-            # Get SVG for a molecule with rotation
+        elif self.path == '/pick':
+            # Atom or bond under a canvas point of the /display frame for the same angles.
             postvars = urllib.parse.parse_qs(body.decode('utf-8'))
             mol_name = postvars.get('name', [None])[0]
-            phi_x = int(postvars.get('phi_x', [0])[0])
-            phi_y = int(postvars.get('phi_y', [0])[0])
-            phi_z = int(postvars.get('phi_z', [0])[0])
-
-            if mol_name:
-                try:
-                    mol = db.load_mol(mol_name)
-                except ValueError as e:
-                    self.send_error(404, str(e))
-                    return
-
-                # Apply rotations in Python and recompute bond geometry.
-                mol.rotate(phi_x, phi_y, phi_z)
-                
-                # Update radii and names for display
-                MolDisplay.radius = db.radius()
-                MolDisplay.element_name = db.element_name()
-                MolDisplay.header = (
-                    '<svg version="1.1" width="1000" height="1000" viewBox="0 0 1000 1000" preserveAspectRatio="xMidYMid meet" '
-                    'xmlns="http://www.w3.org/2000/svg"><defs>'
-                    + db.radial_gradients()
-                    + '</defs>'
-                )
-                
-                svg_content = mol.svg()
-                self.send_response(200)
-                self.send_header('Content-type', 'image/svg+xml')
-                self.end_headers()
-                self.wfile.write(svg_content.encode('utf-8'))
-            else:
+            if not mol_name:
                 self.send_error(400, "Molecule name required")
+                return
+            try:
+                *angles, x, y = finite_floats(postvars, ('phi_x', 'phi_y', 'phi_z', 'x', 'y'))
+            except ValueError:
+                self.send_error(400, "Invalid rotation angles or position")
+                return
+
+            try:
+                mol, hit = pick_frame(db, mol_name, *angles, x, y)
+            except ValueError as e:
+                self.send_error(404, str(e))
+                return
+
+            response = {"kind": None}
+            if hit is not None and hit[0] == 'atom':
+                response = {"kind": "atom", "index": hit[1], "element": mol.get_atom(hit[1]).element}
+            elif hit is not None:
+                bond = mol.get_bond(hit[1])
+                response = {
+                    "kind": "bond", "index": hit[1], "a1": bond.a1, "a2": bond.a2, "epairs": bond.epairs,
+                    "elements": [mol.get_atom(bond.a1).element, mol.get_atom(bond.a2).element],
+                }
+
+            payload = json.dumps(response).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.send_header('Content-length', len(payload))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        elif self.path == '/thumbnails':
+            # Render every missing thumbnail in the background; prune=1 also drops unused files.
+            postvars = urllib.parse.parse_qs(body.decode('utf-8'))
+            stats, started = thumbnail_builder.start(prune=postvars.get('prune', ['0'])[0] == '1')
+            self.send_response(202 if started else 409)
+            self.send_header('Content-type', 'application/json')
+            self.send_header('Location', '/thumbnails')
+            self.end_headers()
+            self.wfile.write(json.dumps(stats.as_dict()).encode('utf-8'))
 
         elif self.path == '/analyze':
             postvars = urllib.parse.parse_qs(body.decode('utf-8'))
@@ -186,40 +1005,11 @@ class Server(BaseHTTPRequestHandler):
                 return
 
             try:
-                mol = db.load_mol(mol_name)
+                response = db.describe(mol_name).as_dict(mol_name)
             except ValueError as e:
                 self.send_error(404, str(e))
                 return
 
-            atom_counts = {}
-            for i in range(mol.atom_no):
-                atom = mol.get_atom(i)
-                atom_counts[atom.element] = atom_counts.get(atom.element, 0) + 1
-
-            bond_orders = {}
-            for i in range(mol.bond_no):
-                bond = mol.get_bond(i)
-                key = str(int(bond.epairs))
-                bond_orders[key] = bond_orders.get(key, 0) + 1
-
-            molar_mass = 0.0
-            unknown = []
-            for element, count in atom_counts.items():
-                if element in ATOMIC_MASS:
-                    molar_mass += ATOMIC_MASS[element] * count
-                else:
-                    unknown.append(element)
-
-            response = {
-                "name": mol_name,
-                "formula": make_formula(atom_counts),
-                "atom_count": mol.atom_no,
-                "bond_count": mol.bond_no,
-                "element_counts": atom_counts,
-                "bond_order_distribution": bond_orders,
-                "molar_mass": round(molar_mass, 3),
-                "unknown_mass_elements": sorted(unknown),
-            }
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
             self.end_headers()
@@ -229,7 +1019,35 @@ class Server(BaseHTTPRequestHandler):
             self.send_error(404, 'Not Found')
 
 if __name__ == '__main__':
-    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
-    httpd = HTTPServer(('localhost', port), Server)
-    print(f"Server starting on port {port}...")
+    parser = argparse.ArgumentParser(description="MolView HTTP server")
+    parser.add_argument('port', nargs='?', type=int, default=8080)
+    parser.add_argument('workers', nargs='?', type=int, default=8)
+    parser.add_argument('--frame-cache-mb', type=int, default=64, help="memory budget for rendered /display frames")
+    parser.add_argument('--angle-step', type=int, default=0, help="snap /display angles to this many degrees (0 = exact)")
+    parser.add_argument('--stream-over', type=int, default=20000, metavar='N', help="stream /display for molecules with more than N atoms + bonds")
+    parser.add_argument('--lod-over', type=int, default=5000, metavar='N', help="simplify /display?lod=1 renders of molecules with more than N atoms + bonds")
+    parser.add_argument('--lod-budget', type=int, default=10000, metavar='N', help="most atoms + bonds drawn in a simplified render (0 = no limit)")
+    parser.add_argument('--ingest-workers', type=int, default=0, metavar='N', help="parser processes for multi-record uploads (0 parses in the ingest thread)")
+    parser.add_argument('--thumbnail-dir', default='thumbnails', help="thumbnail cache directory (shared with thumbnail.py)")
+    parser.add_argument('--thumbnail-workers', type=int, default=0, metavar='N', help="render processes for POST /thumbnails (0 renders in a background thread)")
+    parser.add_argument('--max-streams', type=int, default=4, metavar='N', help="most concurrent trajectory streams (each holds a worker thread)")
+    parser.add_argument('--warm', type=int, default=0, metavar='N', help="pre-render an angle grid for the N most viewed molecules")
+    args = parser.parse_args()
+
+    port = args.port
+    workers = args.workers
+    frame_cache.budget = args.frame_cache_mb * 1024 * 1024
+    angle_step = args.angle_step
+    stream_threshold = args.stream_over
+    lod_threshold = args.lod_over
+    lod_options.budget = args.lod_budget
+    ingest_queue.workers = args.ingest_workers or 0
+    thumbnail_cache.root = args.thumbnail_dir
+    thumbnail_builder.workers = args.thumbnail_workers or 0
+    trajectory_streams = threading.BoundedSemaphore(max(1, args.max_streams))
+    if args.warm > 0:
+        threading.Thread(target=warm_frames, args=(args.warm,), daemon=True).start()
+
+    httpd = PooledHTTPServer(('localhost', port), Server, workers=workers)
+    print(f"Server starting on port {port} with {workers} workers...")
     httpd.serve_forever()
@@ -0,0 +1,70 @@
+import io
+import math
+import unittest
+import MolDisplay
+from MolDisplay import Molecule
+
+# Build libmol.so and _molecule.so with make first; run with python -m unittest.
+
+
+def sdf(atoms, bonds=()):
+    lines = ['test', '  molview', '', f"{len(atoms):3d}{len(bonds):3d}  0  0  0  0  0  0  0  0999 V2000"]
+    for x, y, z, element in atoms:
+        lines.append(f"{x:>10}{y:>10}{z:>10} {element:<3} 0  0  0  0  0  0  0  0  0  0  0  0")
+    for a1, a2, epairs in bonds:
+        lines.append(f"{a1:3d}{a2:3d}{epairs:3d}  0  0  0  0")
+    lines.append('M  END')
+    return '\n'.join(lines) + '\n'
+
+
+WATER = [('0.0000', '0.0000', '0.0000', 'O'), ('0.9572', '0.0000', '0.0000', 'H'), ('-0.2400', '0.9266', '0.0000', 'H')]
+
+
+class ParseTest(unittest.TestCase):
+    def test_non_finite_coordinates_rejected(self):
+        # No bond block, so an accepted file would go on to perceive_bonds over the bad point.
+        for value in ('inf', '-inf', 'nan'):
+            atoms = WATER[:1] + [(value, '0.0000', '0.0000', 'H')] + WATER[2:]
+            with self.assertRaisesRegex(ValueError, 'non-finite'):
+                Molecule().parse(io.StringIO(sdf(atoms)))
+
+    def test_split_parser_rejects_non_finite_coordinates(self):
+        text = 'test\n\n\n2 0\n0 0 0 O\nnan 0 0 H\n'
+        with self.assertRaisesRegex(ValueError, 'Non-finite'):
+            Molecule().parse_split(io.StringIO(text))
+
+    def test_perceives_bonds(self):
+        mol = Molecule().parse(io.StringIO(sdf(WATER)))
+        self.assertEqual((mol.atom_no, mol.bond_no), (3, 2))
+
+
+class PickTest(unittest.TestCase):
+    def setUp(self):
+        self.mol = Molecule().parse(io.StringIO(sdf(WATER, [(1, 2, 1), (1, 3, 1)])))
+        self.context = MolDisplay.RenderContext()
+
+    def centre(self, mol, index):
+        # Canvas position of atom index, fitted the way svg() fits it.
+        view = MolDisplay.molecule.svg_view(self.context.width, self.context.height)
+        mol.svg_body(self.context.native_palette(), view)
+        atom = mol.get_atom(index)
+        return atom.x * view.scale + view.offsetx, atom.y * view.scale + view.offsety
+
+    def test_non_finite_rotation_returns(self):
+        for angle in (math.nan, math.inf):
+            mol = self.mol.copy()
+            mol.rotate(angle, 0, 0)
+            mol.pick_at(self.context, 500, 500)
+
+    def test_cached_grid_follows_rotation(self):
+        # The grid built by the first pick must be dropped when the atoms move.
+        self.assertIsNotNone(self.mol.pick_at(self.context, *self.centre(self.mol, 1)))
+        self.mol.rotate(0, 0, 90)
+        fresh = self.mol.copy()
+        for index in range(self.mol.atom_no):
+            x, y = self.centre(fresh, index)
+            self.assertEqual(self.mol.pick_at(self.context, x, y), fresh.pick_at(self.context, x, y))
+
+
+if __name__ == '__main__':
+    unittest.main()
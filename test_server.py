@@ -0,0 +1,62 @@
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# Starts server.py against an empty database in a temporary directory.
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+class ServerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with socket.socket() as s:
+            s.bind(('localhost', 0))
+            cls.port = s.getsockname()[1]
+        cls.directory = tempfile.TemporaryDirectory()
+        env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+        cls.server = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'server.py'), str(cls.port)],
+            cwd=cls.directory.name, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        for _ in range(100):
+            try:
+                socket.create_connection(('localhost', cls.port)).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.terminate()
+        cls.server.wait()
+        cls.directory.cleanup()
+
+    def status(self, path, form=None):
+        data = urllib.parse.urlencode(form).encode('utf-8') if form is not None else None
+        try:
+            with urllib.request.urlopen(f'http://localhost:{self.port}{path}', data, timeout=10) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def test_display_rejects_non_finite_angles(self):
+        for value in ('nan', 'inf', '-inf', 'x'):
+            self.assertEqual(self.status(f'/display?name=water&phi_x={value}'), 400)
+        self.assertEqual(self.status('/display?name=water&phi_x=30'), 404)
+
+    def test_pick_rejects_non_finite_input(self):
+        for field in ('phi_x', 'phi_y', 'phi_z', 'x', 'y'):
+            for value in ('nan', 'inf', '-inf'):
+                self.assertEqual(self.status('/pick', {'name': 'water', field: value}), 400)
+        self.assertEqual(self.status('/pick', {'name': 'water', 'phi_x': 30, 'x': 500, 'y': 500}), 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
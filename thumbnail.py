@@ -0,0 +1,301 @@
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+import molsql
+import MolDisplay
+
+# Displayed size in pixels; the drawing keeps the regular 1000x1000 viewBox and is scaled down.
+THUMBNAIL_SIZE = 160
+# Part of every key; bump it when thumbnail rendering changes so old files are not served.
+THUMBNAIL_FORMAT = 1
+# Above this many atoms + bonds thumbnails use a budgeted level-of-detail render.
+THUMBNAIL_LOD_OVER = 2000
+thumbnail_lod = MolDisplay.LevelOfDetail(budget=2000, merge_far=0.25)
+
+
+def element_codes(elements):
+    # Distinct element codes of a packed elements blob, decoded like Descriptors.from_geometry.
+    return sorted({
+        bytes(elements[i:i + 3]).rstrip(b'\0').decode('ascii', errors='replace')
+        for i in range(0, len(elements), 3)
+    })
+
+
+def thumbnail_key(content_hash, codes, styles, size=THUMBNAIL_SIZE):
+    # Covers everything that shapes a thumbnail: the geometry, the styles of the elements it uses and
+    # the size. Changing a molecule or one element's style only gives the affected molecules new keys.
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{THUMBNAIL_FORMAT}:{size}:{content_hash}".encode('utf-8'))
+    for code in codes:
+        style = [code, styles.radius.get(code), styles.element_name.get(code), styles.gradients.get(code)]
+        digest.update(json.dumps(style).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def render_thumbnail(mol, styles, size=THUMBNAIL_SIZE):
+    # Returns (key, svg bytes). The key is derived from the molecule actually drawn.
+    elements, coords, bonds = mol.pack()
+    key = thumbnail_key(molsql.content_hash(elements, coords, bonds), element_codes(elements), styles, size)
+
+    lod = thumbnail_lod if mol.atom_no + mol.bond_no > THUMBNAIL_LOD_OVER else None
+    context = styles.render_context(lod=lod)
+    svg = mol.svg(context).replace(
+        f'width="{context.width}" height="{context.height}"', f'width="{size}" height="{size}"', 1
+    )
+    return key, svg.encode('utf-8')
+
+
+class ThumbnailCache:
+    # SVG files named by thumbnail key under root/<first two hex digits>/. A file never goes stale in
+    # place; changed molecules or styles get new keys, and prune() removes the files nothing uses.
+
+    def __init__(self, root='thumbnails'):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key + '.svg')
+
+    def has(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, body):
+        # Written under a temporary name and renamed, so readers never see a partial file.
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(body)
+            os.replace(temp_path, path)
+        except:
+            os.unlink(temp_path)
+            raise
+
+    def prune(self, live):
+        removed = 0
+        for directory, _, files in os.walk(self.root):
+            for file in files:
+                key, ext = os.path.splitext(file)
+                if ext == '.svg' and key not in live:
+                    os.remove(os.path.join(directory, file))
+                    removed += 1
+        return removed
+
+
+def cached_thumbnail(db, name, cache, size=THUMBNAIL_SIZE):
+    # (key, svg bytes) for one molecule, rendered and stored on a cache miss.
+    # Raises ValueError for unknown molecules.
+    _, digest, codes = db.molecule_digest(name)
+    styles = db.element_styles()
+    if digest is not None and codes is not None:
+        key = thumbnail_key(digest, codes, styles, size)
+        body = cache.get(key)
+        if body is not None:
+            return key, body
+
+    key, body = render_thumbnail(db.load_mol(name), styles, size)
+    cache.put(key, body)
+    return key, body
+
+
+class ThumbnailStats:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.finished = None
+        self.state = 'running'
+        self.molecules = 0
+        self.current = 0
+        self.rendered = 0
+        self.pruned = 0
+        self.errors = []
+        self.error = None
+
+    @property
+    def seconds(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    def as_dict(self):
+        stats = {
+            "state": self.state,
+            "molecules": self.molecules,
+            "current": self.current,
+            "rendered": self.rendered,
+            "pruned": self.pruned,
+            "failed": len(self.errors),
+            "seconds": round(self.seconds, 3),
+            # A failing library should not turn every poll into a huge response.
+            "errors": [{"name": n, "error": e} for n, e in self.errors[:20]],
+        }
+        if self.error is not None:
+            stats["error"] = self.error
+        return stats
+
+
+# Each pool process opens its own database connection once (see _init_worker).
+_worker = None
+
+
+def _init_worker(root, size):
+    global _worker
+    _worker = (molsql.Database(), ThumbnailCache(root), size)
+
+
+def _render_named(name):
+    # Runs in a worker process.
+    db, cache, size = _worker
+    return _render_one(db, cache, size, name)
+
+
+def _render_one(db, cache, size, name):
+    # Render and store one thumbnail, or report why it failed.
+    try:
+        key, body = render_thumbnail(db.load_mol(name), db.element_styles(), size)
+        cache.put(key, body)
+        return name, key, None
+    except Exception as e:
+        return name, None, str(e) or type(e).__name__
+
+
+def build_thumbnails(db, cache, size=THUMBNAIL_SIZE, workers=None, prune=False, batch_size=500,
+                     progress=None, stats=None):
+    # Incremental rebuild: molecules whose current key already has a file are skipped without loading
+    # geometry, and the rest are rendered across a process pool, batch_size names at a time.
+    stats = stats or ThumbnailStats()
+    styles = db.element_styles()
+    live = set()
+
+    def stale():
+        after = ''
+        while True:
+            page = db.molecule_digests(after, batch_size)
+            if not page:
+                return
+            for name, digest, codes in page:
+                stats.molecules += 1
+                if digest is not None and codes is not None:
+                    key = thumbnail_key(digest, codes, styles, size)
+                    if cache.has(key):
+                        live.add(key)
+                        stats.current += 1
+                        continue
+                yield name
+            after = page[-1][0]
+
+    def batches():
+        names = stale()
+        while True:
+            batch = list(itertools.islice(names, batch_size))
+            if not batch:
+                return
+            yield batch
+
+    def record(results):
+        for name, key, error in results:
+            if error is None:
+                live.add(key)
+                stats.rendered += 1
+            else:
+                stats.errors.append((name, error))
+        if progress:
+            progress(stats)
+
+    if workers == 0:
+        for batch in batches():
+            record([_render_one(db, cache, size, name) for name in batch])
+    else:
+        # Builds also run on a server thread (ThumbnailBuilder); a fork server keeps the threaded
+        # process from being forked directly.
+        context = multiprocessing.get_context('forkserver')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                                 initargs=(cache.root, size)) as pool:
+            chunksize = max(1, batch_size // (4 * (workers or os.cpu_count() or 1)))
+            for batch in batches():
+                record(pool.map(_render_named, batch, chunksize=chunksize))
+
+    if prune:
+        stats.pruned = cache.prune(live)
+    stats.finished = time.monotonic()
+    stats.state = 'done'
+    return stats
+
+
+class ThumbnailBuilder:
+    # Runs build_thumbnails on a background thread for the server, one build at a time.
+
+    def __init__(self, connect, cache, size=THUMBNAIL_SIZE, workers=None):
+        self.connect = connect
+        self.cache = cache
+        self.size = size
+        self.workers = workers
+        self.stats = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self, prune=False):
+        # Returns (stats, started); a build already running is reported instead of starting another.
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return self.stats, False
+            self.stats = ThumbnailStats()
+            self.thread = threading.Thread(target=self._run, args=(self.stats, prune), daemon=True)
+            self.thread.start()
+            return self.stats, True
+
+    def _run(self, stats, prune):
+        try:
+            build_thumbnails(self.connect(), self.cache, self.size, self.workers, prune, stats=stats)
+        except Exception as e:
+            stats.error = str(e) or type(e).__name__
+            stats.finished = time.monotonic()
+            stats.state = 'failed'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render SVG thumbnails for the molecules in molecules.db")
+    parser.add_argument('--cache-dir', default='thumbnails', help="thumbnail cache directory (shared with server.py)")
+    parser.add_argument('--size', type=int, default=THUMBNAIL_SIZE, help="thumbnail width and height in pixels")
+    parser.add_argument('--workers', type=int, default=None, help="render processes (0 renders in-process)")
+    parser.add_argument('--batch-size', type=int, default=500, help="molecules per batch handed to the pool")
+    parser.add_argument('--prune', action='store_true', help="delete cached thumbnails no molecule uses any more")
+    args = parser.parse_args(argv)
+
+    db = molsql.Database()
+    db.create_tables()
+    db.backfill_derived()
+
+    def report(stats):
+        print(
+            f"\r{stats.molecules} molecules, {stats.rendered} rendered, {stats.current} current, "
+            f"{len(stats.errors)} failed",
+            end='', file=sys.stderr, flush=True
+        )
+
+    stats = build_thumbnails(db, ThumbnailCache(args.cache_dir), args.size, args.workers, args.prune, args.batch_size, report)
+    print(file=sys.stderr)
+
+    for name, error in stats.errors:
+        print(f"{name}: {error}", file=sys.stderr)
+    print(
+        f"Rendered {stats.rendered} of {stats.molecules} thumbnails ({stats.current} already current, "
+        f"{stats.pruned} pruned) in {stats.seconds:.1f}s"
+    )
+    return 0 if not stats.errors else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
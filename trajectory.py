@@ -0,0 +1,172 @@
+import argparse
+import io
+import os
+import sys
+import zlib
+from array import array
+import molimport
+import molsql
+from MolDisplay import Molecule
+
+# Delta frames hold coordinates as integers in units of 1e-4 angstrom, the precision of an SDF coordinate.
+COORD_SCALE = 10000
+# A frame is x, y, z per atom as native doubles, the layout of Molecule.pack() coordinates.
+FRAME_ATOM_SIZE = 3 * array('d').itemsize
+
+
+class FrameCodec:
+    # 'raw' frames are the float64 xyz block, as in MoleculeGeometry. 'delta' frames are quantized to
+    # COORD_SCALE and zlib-compressed: every keyframe_interval-th frame holds absolute values and the
+    # rest hold the change from the frame before, so small motions compress to a few bits per atom.
+    # Both directions must run in frame order, decoding from a keyframe on (see keyframe_before).
+
+    def __init__(self, atom_no, encoding='delta', keyframe_interval=50):
+        if encoding not in ('raw', 'delta'):
+            raise ValueError(f"Unknown frame encoding '{encoding}'")
+        self.atom_no = atom_no
+        self.encoding = encoding
+        self.keyframe_interval = max(1, keyframe_interval)
+        self.previous = None
+        self.previous_index = None
+
+    def keyframe_before(self, index):
+        if self.encoding == 'raw':
+            return index
+        return index - index % self.keyframe_interval
+
+    def encode(self, index, coords):
+        coords = bytes(coords)
+        if len(coords) != self.atom_no * FRAME_ATOM_SIZE:
+            raise ValueError("Frame does not match the trajectory's atom count")
+        if self.encoding == 'raw':
+            return coords
+
+        quantized = array('i', [round(value * COORD_SCALE) for value in array('d', coords)])
+        if index % self.keyframe_interval == 0:
+            block = quantized
+        elif self.previous_index == index - 1:
+            block = array('i', [value - last for value, last in zip(quantized, self.previous)])
+        else:
+            raise ValueError("Delta frames must be encoded in order")
+        self.previous = quantized
+        self.previous_index = index
+        return zlib.compress(block.tobytes(), 6)
+
+    def decode(self, index, blob):
+        # Returns the frame's coordinates as array('d') of x, y, z per atom.
+        if self.encoding == 'raw':
+            return array('d', bytes(blob))
+
+        block = array('i', zlib.decompress(blob))
+        if index % self.keyframe_interval == 0:
+            quantized = block
+        elif self.previous_index == index - 1:
+            quantized = array('i', [last + value for last, value in zip(self.previous, block)])
+        else:
+            raise ValueError("Delta frames must be decoded in order from a keyframe")
+        self.previous = quantized
+        self.previous_index = index
+        return array('d', [value / COORD_SCALE for value in quantized])
+
+
+def read_frames(fp):
+    # (index, molecule) for each record of a multi-record SDF, parsed one at a time.
+    for index, _, text in molimport.read_records(fp):
+        mol = Molecule()
+        mol.parse(io.StringIO(text))
+        if mol.atom_no == 0:
+            raise ValueError(f"record {index + 1} did not contain any atoms")
+        yield index, mol
+
+
+def import_trajectory(db, name, fp, encoding='delta', keyframe_interval=50, batch_size=200, progress=None):
+    # Store the first record as molecule `name` (the shared topology) and every record's coordinates
+    # as one frame. Records must list the same elements in the same order; bonds come from the first.
+    frames = read_frames(fp)
+    first = next(frames, None)
+    if first is None:
+        raise ValueError("SDF did not contain any records")
+    _, mol = first
+    elements, coords, _ = mol.pack()
+
+    db.add_packed_molecules([molsql.PackedMolecule.from_molecule(name, mol)])
+    trajectory_id = db.create_trajectory(name, name, mol.atom_no, encoding, keyframe_interval)
+    codec = FrameCodec(mol.atom_no, encoding, keyframe_interval)
+
+    batch = [(0, codec.encode(0, coords))]
+    stored = 0
+    try:
+        for index, frame in frames:
+            frame_elements, frame_coords, _ = frame.pack()
+            if frame_elements != elements:
+                raise ValueError(f"record {index + 1} does not share the first record's atoms")
+            batch.append((index, codec.encode(index, frame_coords)))
+            if len(batch) >= batch_size:
+                db.add_trajectory_frames(trajectory_id, batch)
+                stored += len(batch)
+                batch = []
+                if progress:
+                    progress(stored)
+        if batch:
+            db.add_trajectory_frames(trajectory_id, batch)
+            stored += len(batch)
+    except Exception:
+        db.delete_trajectory(name)
+        raise
+    return db.trajectory(name)
+
+
+class TrajectoryReader:
+    # Decoded frames of a stored trajectory, fetched `window` frames per query so memory stays flat
+    # however long the trajectory is.
+
+    def __init__(self, db, name, window=32):
+        self.db = db
+        self.info = db.trajectory(name)
+        self.window = window
+
+    def frames(self, start=0, end=None):
+        # (index, array('d') coords) from start up to end (exclusive), in order.
+        info = self.info
+        end = info['frame_no'] if end is None else min(end, info['frame_no'])
+        codec = FrameCodec(info['atom_no'], info['encoding'], info['keyframe_interval'])
+        position = codec.keyframe_before(start)
+        while position < end:
+            stop = min(position + self.window, end)
+            for index, blob in self.db.trajectory_frames(info['id'], position, stop):
+                coords = codec.decode(index, blob)
+                if index >= start:
+                    yield index, coords
+            position = stop
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import a multi-record SDF (conformers or MD frames) as a trajectory")
+    parser.add_argument('sdf', help="SDF file; one record per frame, all with the same atoms")
+    parser.add_argument('--name', default=None, help="trajectory and topology molecule name (default: file name)")
+    parser.add_argument('--encoding', choices=['delta', 'raw'], default='delta', help="frame storage")
+    parser.add_argument('--keyframe-interval', type=int, default=50, help="absolute frame every N frames (delta encoding)")
+    parser.add_argument('--batch-size', type=int, default=200, help="frames per insert transaction")
+    args = parser.parse_args(argv)
+
+    db = molsql.Database()
+    db.create_tables()
+
+    def report(frames):
+        print(f"\r{frames} frames", end='', file=sys.stderr, flush=True)
+
+    name = args.name or os.path.splitext(os.path.basename(args.sdf))[0]
+    try:
+        with open(args.sdf, 'r', encoding='utf-8', errors='replace') as fp:
+            info = import_trajectory(db, name, fp, args.encoding, args.keyframe_interval, args.batch_size, report)
+    except ValueError as e:
+        print(file=sys.stderr)
+        print(f"{args.sdf}: {e}", file=sys.stderr)
+        return 1
+    print(file=sys.stderr)
+    print(f"Stored {info['frame_no']} frames of {info['atom_no']} atoms as '{info['name']}' ({info['encoding']})")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())